@@ -0,0 +1,104 @@
+"""
+Compare two reports of benchmarks.run and flag regressions.
+
+A metric regresses when it is worse than the baseline by more than the
+threshold: lower throughput, higher latency percentiles, time to first token,
+error count or peak RSS. Exits with status 1 if any metric regressed.
+
+    python -m benchmarks.compare base.json new.json --threshold 0.1
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# (path in a phase report, higher is better)
+PHASE_METRICS = [
+    (("throughput",), True),
+    (("items_per_second",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p95"), False),
+    (("latency_ms", "p99"), False),
+    (("first_token_ms", "p50"), False),
+    (("first_token_ms", "p95"), False),
+    (("first_token_ms", "p99"), False),
+]
+
+
+def _get(report: Dict, path: Tuple[str, ...]) -> Optional[float]:
+    for key in path:
+        if not isinstance(report, dict) or key not in report:
+            return None
+        report = report[key]
+    return report
+
+
+def compare(
+    base: Dict, new: Dict, threshold: float
+) -> Iterator[Tuple[str, float, float, float, bool]]:
+    """(metric, base, new, relative change, regressed) of the metrics of both runs"""
+
+    def row(name: str, old, value, higher_is_better: bool):
+        if old is None or value is None:
+            return None
+        change = (value - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        return name, old, value, change, worse > threshold
+
+    rows = []
+    for phase, report in base["phases"].items():
+        if phase not in new["phases"]:
+            continue
+        for path, higher_is_better in PHASE_METRICS:
+            rows.append(
+                row(
+                    f"{phase}.{'.'.join(path)}",
+                    _get(report, path),
+                    _get(new["phases"][phase], path),
+                    higher_is_better,
+                )
+            )
+        old_errors, errors = report["errors"], new["phases"][phase]["errors"]
+        rows.append((f"{phase}.errors", old_errors, errors, 0.0, errors > old_errors))
+    rows.append(row("peak_rss_mb", base["peak_rss_mb"], new["peak_rss_mb"], False))
+    return (r for r in rows if r is not None)
+
+
+def format_table(rows: List[Tuple[str, float, float, float, bool]]) -> str:
+    width = max([len(r[0]) for r in rows] + [6])
+    lines = [f"{'metric':<{width}}  {'base':>12}  {'new':>12}  {'change':>8}"]
+    for name, old, value, change, regressed in rows:
+        mark = "  REGRESSION" if regressed else ""
+        lines.append(
+            f"{name:<{width}}  {old:>12.3f}  {value:>12.3f}  {change:>+8.1%}{mark}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("base", type=str, help="Report of the baseline run")
+    parser.add_argument("new", type=str, help="Report of the run to check")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative change tolerated before a metric counts as a regression",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    base = json.loads(Path(args.base).read_text())
+    new = json.loads(Path(args.new).read_text())
+    if base.get("config") != new.get("config"):
+        print("Warning: the runs were made with different configs\n", file=sys.stderr)
+    rows = list(compare(base, new, args.threshold))
+    print(format_table(rows))
+    regressions = [r[0] for r in rows if r[4]]
+    if regressions:
+        print(f"\n{len(regressions)} regressions: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,361 @@
+"""
+Offline evaluation of retrieval quality and generation cost.
+
+Sweeps top_k, score_threshold and the RAG_PROMPT modes over a labeled
+question set against an existing knowledge base, with the settings of
+RAG_ROOT. Retrieval runs in batches (recall@k, MRR, hit rate), generation
+runs in parallel when --generate is given (tokens, time to first token,
+latency and answer match). Prints a sweep table and the cheapest setting
+meeting the quality bar.
+
+The question set is a jsonl file, one question per line:
+
+    {"query": "...", "relevant_files": ["a.pdf"], "answers": ["..."]}
+
+A retrieved context is relevant if its id is in ``relevant_ids`` or its
+file name in ``relevant_files``. ``answers`` are optional, an answer matches
+if it contains one of them.
+
+    cd libs
+    python -m benchmarks.evaluate questions.jsonl --kb-name default \\
+        --collection-name history_rag --top-k 3 5 10 --generate \\
+        --min-recall 0.8 --output sweep.json
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import sys
+import time
+import unicodedata
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from benchmarks.run import summarize
+from rag.server.api_server.utils import map_collection_name
+from rag.server.chat.utils import construct_message, count_tokens
+from rag.server.kb.base import KBService, KBServiceFactory
+from rag.server.llm.base import LLMFactory
+from rag.server.models.kb_spec import Context
+from rag.settings import Settings
+
+
+class Question:
+    def __init__(self, data: Dict):
+        self.query: str = data["query"]
+        self.relevant_ids: Set = set(data.get("relevant_ids", []))
+        self.relevant_files: Set[str] = set(data.get("relevant_files", []))
+        self.answers: List[str] = [normalize(a) for a in data.get("answers", [])]
+
+    @property
+    def labeled(self) -> bool:
+        return bool(self.relevant_ids or self.relevant_files)
+
+    def relevant_keys(self, context: Context) -> Set:
+        """Labels a context satisfies, a file counts once whatever its chunks"""
+        keys = set()
+        if context.id in self.relevant_ids:
+            keys.add(("id", context.id))
+        if context.metadata.file_name in self.relevant_files:
+            keys.add(("file", context.metadata.file_name))
+        return keys
+
+    def n_relevant(self) -> int:
+        return len(self.relevant_ids) + len(self.relevant_files)
+
+
+def normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).lower().split())
+
+
+def load_questions(path: str) -> List[Question]:
+    with open(path, encoding="utf-8") as f:
+        return [Question(json.loads(line)) for line in f if line.strip()]
+
+
+def score_retrieval(questions: List[Question], results: List[List[Context]]) -> Dict:
+    recalls, ranks, hits = [], [], 0
+    for question, contexts in zip(questions, results):
+        if not question.labeled:
+            continue
+        found, first = set(), None
+        for rank, context in enumerate(contexts, 1):
+            keys = question.relevant_keys(context)
+            if keys and first is None:
+                first = rank
+            found |= keys
+        recalls.append(len(found) / question.n_relevant())
+        ranks.append(1 / first if first else 0.0)
+        hits += first is not None
+    n = len(recalls)
+    return {
+        "labeled": n,
+        "recall": round(sum(recalls) / n, 4) if n else None,
+        "mrr": round(sum(ranks) / n, 4) if n else None,
+        "hit_rate": round(hits / n, 4) if n else None,
+    }
+
+
+async def retrieve(
+    kb: KBService,
+    collection_name: str,
+    queries: List[str],
+    top_k: int,
+    score_threshold: float,
+    batch_size: int,
+    concurrency: int,
+) -> Tuple[List[List[Context]], List[float]]:
+    """Results of the queries, and the per-query latency of their batch"""
+    semaphore = asyncio.Semaphore(concurrency)
+    batches = [
+        queries[i : i + batch_size] for i in range(0, len(queries), batch_size)
+    ]
+
+    async def search(batch: List[str]):
+        async with semaphore:
+            start = time.perf_counter()
+            found = await kb.asearch_many(
+                batch, collection_name, top_k, score_threshold
+            )
+            return found, (time.perf_counter() - start) / len(batch)
+
+    results, latencies = [], []
+    for found, latency in await asyncio.gather(*[search(b) for b in batches]):
+        results += found
+        latencies += [latency] * len(found)
+    return results, latencies
+
+
+async def generate(
+    questions: List[Question],
+    results: List[List[Context]],
+    prompt_name: str,
+    model: str,
+    max_tokens: int,
+    concurrency: int,
+) -> Dict:
+    """Answer every question from its contexts, measure tokens and latency"""
+    prompt_template = Settings.prompt_settings.RAG_PROMPT[prompt_name]
+    llm = LLMFactory.get_llm_service(model)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(question: Question, contexts: List[Context]) -> Optional[Dict]:
+        messages = construct_message(question.query, [], contexts, prompt_template)
+        parts, usage, first_token = [], None, None
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                async for chunk in llm.astream_chat(
+                    messages, temperature=0, max_tokens=max_tokens
+                ):
+                    if chunk.content and first_token is None:
+                        first_token = time.perf_counter() - start
+                    parts.append(chunk.content)
+                    usage = chunk.usage or usage
+            except Exception as e:
+                print(
+                    f"{e.__class__.__name__}: Fail to answer {question.query}: {e}",
+                    file=sys.stderr,
+                )
+                return None
+            latency = time.perf_counter() - start
+        text = "".join(parts)
+        # platforms not reporting usage are estimated like the prompt budget
+        usage = usage or {
+            "prompt_tokens": sum(count_tokens(m["content"]) for m in messages),
+            "completion_tokens": count_tokens(text),
+        }
+        return {
+            "latency": latency,
+            "first_token": first_token,
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "match": (
+                any(a in normalize(text) for a in question.answers)
+                if question.answers
+                else None
+            ),
+        }
+
+    answers = await asyncio.gather(
+        *[answer(q, contexts) for q, contexts in zip(questions, results)]
+    )
+    done = [a for a in answers if a is not None]
+    matches = [a["match"] for a in done if a["match"] is not None]
+    n = len(done)
+
+    def mean(key: str) -> Optional[float]:
+        return round(sum(a[key] for a in done) / n, 1) if n else None
+
+    return {
+        "answered": n,
+        "errors": len(answers) - n,
+        "prompt_tokens": mean("prompt_tokens"),
+        "completion_tokens": mean("completion_tokens"),
+        "answer_match": round(sum(matches) / len(matches), 4) if matches else None,
+        "latency_ms": summarize([a["latency"] for a in done]),
+        "first_token_ms": summarize(
+            [a["first_token"] for a in done if a["first_token"] is not None]
+        ),
+    }
+
+
+async def sweep(args: argparse.Namespace, questions: List[Question]) -> List[Dict]:
+    kb = KBServiceFactory.get_kb_service_by_name(args.kb_name)
+    if kb is None:
+        raise ValueError(f"Knowledge base {args.kb_name} not found")
+    collection_name = map_collection_name(args.kb_name, args.collection_name)
+    queries = [q.query for q in questions]
+    # embed once up front, so every config is served by the embedding cache alike
+    await asyncio.to_thread(kb.embed_queries, queries)
+
+    rows = []
+    for top_k, score_threshold in itertools.product(args.top_k, args.score_threshold):
+        results, latencies = await retrieve(
+            kb,
+            collection_name,
+            queries,
+            top_k,
+            score_threshold,
+            args.batch_size,
+            args.concurrency,
+        )
+        retrieval = {
+            **score_retrieval(questions, results),
+            "contexts": round(sum(map(len, results)) / len(results), 2),
+            "latency_ms": summarize(latencies),
+        }
+        prompt_names = args.prompt_names if args.generate else [None]
+        for prompt_name in prompt_names:
+            row = {
+                "top_k": top_k,
+                "score_threshold": score_threshold,
+                "prompt_name": prompt_name,
+                "retrieval": retrieval,
+            }
+            if prompt_name is not None:
+                row["generation"] = await generate(
+                    questions,
+                    results,
+                    prompt_name,
+                    args.model,
+                    args.max_tokens,
+                    args.concurrency,
+                )
+            rows.append(row)
+            print(format_table([row], header=not rows[:-1]))
+    return rows
+
+
+def cost(row: Dict) -> float:
+    """Prompt tokens when generating, retrieval latency otherwise"""
+    if "generation" in row and row["generation"]["prompt_tokens"] is not None:
+        return row["generation"]["prompt_tokens"]
+    return row["retrieval"]["latency_ms"]["p95"] or 0.0
+
+
+def cheapest(
+    rows: List[Dict], min_recall: float = None, min_answer_match: float = None
+) -> Optional[Dict]:
+    """The cheapest row meeting the quality bar"""
+    passing = []
+    for row in rows:
+        recall = row["retrieval"]["recall"]
+        if min_recall is not None and (recall is None or recall < min_recall):
+            continue
+        if min_answer_match is not None:
+            match = row.get("generation", {}).get("answer_match")
+            if match is None or match < min_answer_match:
+                continue
+        passing.append(row)
+    return min(passing, key=cost, default=None)
+
+
+def format_table(rows: List[Dict], header: bool = True) -> str:
+    columns = [
+        ("prompt", 16, lambda r: r["prompt_name"] or "-"),
+        ("top_k", 5, lambda r: r["top_k"]),
+        ("thresh", 6, lambda r: r["score_threshold"]),
+        ("recall", 6, lambda r: r["retrieval"]["recall"]),
+        ("mrr", 6, lambda r: r["retrieval"]["mrr"]),
+        ("hit", 6, lambda r: r["retrieval"]["hit_rate"]),
+        ("ret_p95", 8, lambda r: r["retrieval"]["latency_ms"]["p95"]),
+        ("prompt_tok", 10, lambda r: r.get("generation", {}).get("prompt_tokens")),
+        ("compl_tok", 9, lambda r: r.get("generation", {}).get("completion_tokens")),
+        (
+            "ttft_p50",
+            8,
+            lambda r: r.get("generation", {}).get("first_token_ms", {}).get("p50"),
+        ),
+        (
+            "gen_p95",
+            8,
+            lambda r: r.get("generation", {}).get("latency_ms", {}).get("p95"),
+        ),
+        ("match", 6, lambda r: r.get("generation", {}).get("answer_match")),
+    ]
+    lines = []
+    if header:
+        lines.append("  ".join(f"{name:>{width}}" for name, width, _ in columns))
+    for row in rows:
+        cells = []
+        for _, width, get in columns:
+            value = get(row)
+            if value is None:
+                value = "-"
+            elif isinstance(value, float):
+                value = f"{value:.4g}"
+            cells.append(f"{value:>{width}}")
+        lines.append("  ".join(cells))
+    return "\n".join(lines)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("questions", type=str, help="Labeled question set, jsonl")
+    parser.add_argument("--kb-name", type=str, default="default")
+    parser.add_argument("--collection-name", type=str, default="history_rag")
+    parser.add_argument("--top-k", type=int, nargs="+", default=[3, 5, 10])
+    parser.add_argument("--score-threshold", type=float, nargs="+", default=[0.1])
+    parser.add_argument(
+        "--prompt-names",
+        type=str,
+        nargs="+",
+        default=list(Settings.prompt_settings.RAG_PROMPT),
+        help="RAG_PROMPT modes to generate with",
+    )
+    parser.add_argument(
+        "--generate", action="store_true", help="Also generate answers"
+    )
+    parser.add_argument(
+        "--model", type=str, default=Settings.model_settings.DEFAULT_LLM_NAME
+    )
+    parser.add_argument("--max-tokens", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=32, help="Queries per search")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--min-recall", type=float, help="Quality bar of retrieval")
+    parser.add_argument(
+        "--min-answer-match", type=float, help="Quality bar of the answers"
+    )
+    parser.add_argument("--output", type=str, help="Write the sweep to this file")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> List[Dict]:
+    try:
+        return await sweep(args, load_questions(args.questions))
+    finally:
+        await LLMFactory.aclose()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rows = asyncio.run(main(args))
+    best = cheapest(rows, args.min_recall, args.min_answer_match)
+    print("\nCheapest setting meeting the quality bar:")
+    print(format_table([best]) if best else "none")
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps({"rows": rows, "best": best}, indent=2, ensure_ascii=False)
+        )
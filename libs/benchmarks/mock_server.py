@@ -0,0 +1,188 @@
+"""
+Stand-in OpenAI compatible platform for the benchmarks.
+
+Embeddings are deterministic hashed bags of words, so texts sharing words
+are close and retrieval behaves like a real model on the synthetic corpus.
+Chat answers are fixed tokens, streamed at a configurable pace. Every
+endpoint can add latency to mimic a remote platform.
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import re
+import time
+from typing import List
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# words, or single CJK characters
+_TOKEN_RE = re.compile(r"[一-鿿]|[^\W_]+")
+
+
+def fake_embedding(text: str, dim: int) -> List[float]:
+    """Normalized bag of words hashed into ``dim`` buckets with random signs"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for token in _TOKEN_RE.findall(text.lower()):
+        digest = hashlib.md5(token.encode("utf-8")).digest()
+        index = int.from_bytes(digest[:4], "little") % dim
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    if norm == 0:
+        vector[0], norm = 1.0, 1.0
+    return (vector / norm).tolist()
+
+
+def count_tokens(text: str) -> int:
+    return len(_TOKEN_RE.findall(text))
+
+
+def create_mock_app(args: argparse.Namespace) -> FastAPI:
+    app = FastAPI(title="Mock OpenAI platform")
+
+    @app.get("/v1/models")
+    async def models():
+        return {
+            "object": "list",
+            "data": [
+                {"id": args.embed_model, "object": "model"},
+                {"id": args.chat_model, "object": "model"},
+            ],
+        }
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        texts = body["input"]
+        if isinstance(texts, str):
+            texts = [texts]
+        await asyncio.sleep(args.embed_latency + args.embed_item_latency * len(texts))
+        return {
+            "object": "list",
+            "model": body.get("model", args.embed_model),
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": fake_embedding(text, args.dim),
+                }
+                for i, text in enumerate(texts)
+            ],
+            "usage": {
+                "prompt_tokens": sum(count_tokens(t) for t in texts),
+                "total_tokens": sum(count_tokens(t) for t in texts),
+            },
+        }
+
+    @app.post("/v1/rerank")
+    async def rerank(request: Request):
+        body = await request.json()
+        await asyncio.sleep(args.embed_latency)
+        query = np.asarray(fake_embedding(body["query"], args.dim))
+        scores = [
+            float(np.dot(query, fake_embedding(doc, args.dim)))
+            for doc in body["documents"]
+        ]
+        order = sorted(range(len(scores)), key=lambda i: -scores[i])
+        return {"results": [{"index": i, "relevance_score": scores[i]} for i in order]}
+
+    @app.post("/v1/chat/completions")
+    async def chat(request: Request):
+        body = await request.json()
+        model = body.get("model", args.chat_model)
+        prompt_tokens = sum(count_tokens(m["content"]) for m in body["messages"])
+        tokens = [f"token{i} " for i in range(args.completion_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+        created = int(time.time())
+        if not body.get("stream"):
+            await asyncio.sleep(
+                args.chat_latency + args.token_interval * len(tokens)
+            )
+            return JSONResponse(
+                {
+                    "id": "mock",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {
+                                "role": "assistant",
+                                "content": "".join(tokens),
+                            },
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        def chunk(choices, **extra) -> str:
+            data = {
+                "id": "mock",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def stream():
+            await asyncio.sleep(args.chat_latency)
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(args.token_interval)
+                yield chunk(
+                    [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+                )
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            yield chunk([], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--embed-model", type=str, default="mock-embedding")
+    parser.add_argument("--chat-model", type=str, default="mock-chat")
+    parser.add_argument("--dim", type=int, default=256, help="Embedding dim")
+    parser.add_argument(
+        "--embed-latency", type=float, default=0.005, help="Seconds per request"
+    )
+    parser.add_argument(
+        "--embed-item-latency", type=float, default=0.0002, help="Seconds per text"
+    )
+    parser.add_argument(
+        "--chat-latency", type=float, default=0.05, help="Seconds to first token"
+    )
+    parser.add_argument(
+        "--token-interval", type=float, default=0.002, help="Seconds between tokens"
+    )
+    parser.add_argument("--completion-tokens", type=int, default=64)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=19199)
+    add_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    uvicorn.run(
+        create_mock_app(args), host=args.host, port=args.port, log_level="warning"
+    )
@@ -0,0 +1,461 @@
+"""
+End-to-end benchmark of the API server.
+
+Starts the mock platform (benchmarks.mock_server) and the app of
+``create_app`` as uvicorn subprocesses on a throwaway RAG_ROOT, ingests a
+synthetic corpus through /kb/add_context, then drives /kb/search and
+streaming /chat/kb_chat at the given concurrency. Throughput, latency
+percentiles, time to first token and the peak RSS of the server are printed
+as json, compare two reports with benchmarks.compare.
+
+    cd libs
+    python -m benchmarks.run --concurrency 16 --requests 500 --output base.json
+    python -m benchmarks.run --concurrency 16 --requests 500 --output new.json
+    python -m benchmarks.compare base.json new.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional
+
+import httpx
+from benchmarks.mock_server import add_arguments
+
+LIBS_ROOT = Path(__file__).resolve().parents[1]
+KB_NAME = "benchmark"
+COLLECTION_NAME = "benchmark"
+PHASES = ("add_context", "search", "kb_chat")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Linear interpolated percentile, ``q`` in [0, 100]"""
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * q / 100
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """Latency summary in milliseconds"""
+    if not values:
+        return {"mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    return {
+        "mean": round(1000 * sum(values) / len(values), 3),
+        "p50": round(1000 * percentile(values, 50), 3),
+        "p95": round(1000 * percentile(values, 95), 3),
+        "p99": round(1000 * percentile(values, 99), 3),
+        "max": round(1000 * max(values), 3),
+    }
+
+
+def peak_rss_mb(pid: int) -> Optional[float]:
+    """Peak RSS of a process and its children, Linux only"""
+    pids, total = [pid], 0
+    for task in Path(f"/proc/{pid}/task").glob("*/children"):
+        pids += [int(child) for child in task.read_text().split()]
+    for p in pids:
+        try:
+            status = Path(f"/proc/{p}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                total += int(line.split()[1])
+    return round(total / 1024, 1) if total else None
+
+
+class Corpus:
+    """Deterministic synthetic documents, queries are words of a random document"""
+
+    def __init__(self, size: int, doc_words: int, seed: int, vocab_size: int = 5000):
+        rng = random.Random(seed)
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        vocab = sorted(
+            {
+                "".join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+                for _ in range(vocab_size)
+            }
+        )
+        # zipf-like word frequencies, like natural text
+        weights = [1 / (rank + 1) for rank in range(len(vocab))]
+        self.docs = [
+            " ".join(rng.choices(vocab, weights, k=doc_words)) for _ in range(size)
+        ]
+        self.rng = rng
+
+    def contexts(self) -> List[Dict]:
+        return [
+            {
+                "metadata": {
+                    "series_name": "benchmark",
+                    "file_name": f"doc{i // 100}.txt",
+                    "title": f"doc {i}",
+                    "start_page": i,
+                    "end_page": i,
+                },
+                "content": doc,
+            }
+            for i, doc in enumerate(self.docs)
+        ]
+
+    def queries(self, n: int, unique: int = 0) -> List[str]:
+        """``n`` queries drawn from ``unique`` distinct ones, all distinct if 0"""
+        distinct = []
+        for _ in range(unique or n):
+            words = self.rng.choice(self.docs).split()
+            start = self.rng.randrange(max(len(words) - 6, 1))
+            distinct.append(" ".join(words[start : start + 6]))
+        return [distinct[i % len(distinct)] for i in range(n)]
+
+
+class Phase:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.first_token: List[float] = []
+        self.errors = 0
+        self.items = 0
+        self.duration = 0.0
+
+    def report(self) -> Dict:
+        requests = len(self.latencies)
+        report = {
+            "requests": requests,
+            "errors": self.errors,
+            "duration": round(self.duration, 3),
+            "throughput": round(requests / self.duration, 3) if self.duration else 0.0,
+            "latency_ms": summarize(self.latencies),
+        }
+        if self.items:
+            report["items"] = self.items
+            report["items_per_second"] = round(self.items / self.duration, 3)
+        if self.first_token:
+            report["first_token_ms"] = summarize(self.first_token)
+        return report
+
+
+async def drive(
+    phase: Phase,
+    payloads: Iterable,
+    send: Callable[[Phase, object], Awaitable[bool]],
+    concurrency: int,
+):
+    """Send payloads from ``concurrency`` workers, failures are counted as errors"""
+    payloads = iter(payloads)
+
+    async def worker():
+        for payload in payloads:
+            start = time.perf_counter()
+            try:
+                ok = await send(phase, payload)
+            except httpx.HTTPError:
+                ok = False
+            phase.latencies.append(time.perf_counter() - start)
+            if not ok:
+                phase.errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    phase.duration = time.perf_counter() - start
+
+
+async def post_json(client: httpx.AsyncClient, path: str, payload: Dict) -> bool:
+    response = await client.post(path, json=payload)
+    return response.status_code == 200 and response.json().get("code") == 200
+
+
+async def run_benchmark(args: argparse.Namespace, base_url: str) -> Dict[str, Phase]:
+    corpus = Corpus(args.contexts, args.doc_words, args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency)
+    timeout = httpx.Timeout(args.timeout)
+    phases = {}
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=timeout
+    ) as client:
+        kb = {"kb_name": KB_NAME, "collection_name": COLLECTION_NAME}
+        response = await client.post(
+            "/kb/create_kb",
+            json={
+                "kb_name": KB_NAME,
+                "vector_store_type": args.vs_type,
+                "embed_model": args.embed_model,
+            },
+        )
+        response.raise_for_status()
+        response = await client.post("/kb/create_collection", json=kb)
+        response.raise_for_status()
+
+        contexts = corpus.contexts()
+        batches = [
+            contexts[i : i + args.batch_size]
+            for i in range(0, len(contexts), args.batch_size)
+        ]
+
+        async def add_context(phase: Phase, batch: List[Dict]) -> bool:
+            ok = await post_json(client, "/kb/add_context", {**kb, "context": batch})
+            if ok:
+                phase.items += len(batch)
+            return ok
+
+        async def search(phase: Phase, query: str) -> bool:
+            return await post_json(
+                client, "/kb/search", {**kb, "query": query, "top_k": args.top_k}
+            )
+
+        async def kb_chat(phase: Phase, query: str) -> bool:
+            payload = {
+                **kb,
+                "query": query,
+                "top_k": args.top_k,
+                "score_threshold": 0,
+                "stream": True,
+                "model": args.chat_model,
+            }
+            start, ok = time.perf_counter(), False
+            async with client.stream("POST", "/chat/kb_chat", json=payload) as r:
+                if r.status_code != 200:
+                    return False
+                event = None
+                async for line in r.aiter_lines():
+                    if line.startswith("event:"):
+                        event = line[len("event:") :].strip()
+                    if event == "token" and not ok:
+                        phase.first_token.append(time.perf_counter() - start)
+                        ok = True
+                    if event == "error":
+                        return False
+            return ok
+
+        queries = corpus.queries(args.requests, args.unique_queries)
+        steps = {
+            "add_context": (batches, add_context),
+            "search": (queries, search),
+            "kb_chat": (queries, kb_chat),
+        }
+        for name in PHASES:
+            if name not in args.phases:
+                continue
+            payloads, send = steps[name]
+            phase = phases[name] = Phase(name)
+            if args.warmup and name != "add_context":
+                # queries of their own, so they do not warm the caches up
+                warmup = corpus.queries(args.warmup)
+                await drive(Phase(name), warmup, send, args.concurrency)
+            await drive(phase, payloads, send, args.concurrency)
+            print(
+                f"{name}: {len(phase.latencies)} requests in {phase.duration:.2f}s, "
+                f"{phase.errors} errors",
+                file=sys.stderr,
+            )
+    return phases
+
+
+def start_process(cmd: List[str], env: Dict[str, str], log) -> subprocess.Popen:
+    return subprocess.Popen(
+        cmd, cwd=LIBS_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process serving {url} exited with {process.returncode}")
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def stop_process(process: subprocess.Popen):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=LIBS_ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args: argparse.Namespace) -> Dict:
+    root = Path(args.root or tempfile.mkdtemp(prefix="rag-benchmark-"))
+    root.mkdir(parents=True, exist_ok=True)
+    mock_port, app_port = free_port(), free_port()
+    env = {**os.environ, "PYTHONPATH": str(LIBS_ROOT)}
+    mock_cmd = [
+        sys.executable,
+        "-m",
+        "benchmarks.mock_server",
+        "--port",
+        str(mock_port),
+        "--embed-model",
+        args.embed_model,
+        "--chat-model",
+        args.chat_model,
+        "--dim",
+        str(args.dim),
+        "--embed-latency",
+        str(args.embed_latency),
+        "--embed-item-latency",
+        str(args.embed_item_latency),
+        "--chat-latency",
+        str(args.chat_latency),
+        "--token-interval",
+        str(args.token_interval),
+        "--completion-tokens",
+        str(args.completion_tokens),
+    ]
+    platforms = [
+        {
+            "PLATFORM_NAME": "mock",
+            "PLATFORM_TYPE": "openai",
+            "API_BASE_URL": f"http://127.0.0.1:{mock_port}/v1",
+            "API_KEY": "EMPTY",
+            "LLM_MODELS": {args.chat_model: {}},
+            "EMBEDDING_MODELS": {args.embed_model: {"embed_size": args.dim}},
+            "RERANK_MODELS": {args.rerank_model: {}},
+        }
+    ]
+    app_env = {
+        **env,
+        "RAG_ROOT": str(root),
+        "MODEL_PLATFORMS": json.dumps(platforms),
+        "DEFAULT_EMBEDDING_MODEL": args.embed_model,
+        "DEFAULT_EMBEDDING_SIZE": str(args.dim),
+        "DEFAULT_LLM_NAME": args.chat_model,
+        "DEFAULT_RERANK_MODEL": args.rerank_model,
+        "DEFAULT_VS_TYPE": args.vs_type,
+        "WARMUP_KBS": "[]",
+    }
+    for item in args.set:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+    app_cmd = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "--factory",
+        "rag.server.api_server.app:create_app",
+        "--host",
+        "127.0.0.1",
+        "--port",
+        str(app_port),
+        "--workers",
+        str(args.workers),
+        "--log-level",
+        "warning",
+    ]
+
+    processes = []
+    log = open(root / "benchmark.log", "ab")
+    try:
+        mock = start_process(mock_cmd, env, log)
+        processes.append(mock)
+        wait_ready(f"http://127.0.0.1:{mock_port}/v1/models", mock)
+        app = start_process(app_cmd, app_env, log)
+        processes.append(app)
+        wait_ready(f"http://127.0.0.1:{app_port}/metrics", app)
+        phases = asyncio.run(run_benchmark(args, f"http://127.0.0.1:{app_port}"))
+        rss = peak_rss_mb(app.pid)
+    finally:
+        for process in reversed(processes):
+            stop_process(process)
+        log.close()
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+    config = {
+        k: v for k, v in vars(args).items() if k not in ("output", "root", "keep")
+    }
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "peak_rss_mb": rss,
+        "phases": {name: phase.report() for name, phase in phases.items()},
+    }
+
+
+def parse_args(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--phases", nargs="+", choices=PHASES, default=list(PHASES)
+    )
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--requests", type=int, default=200, help="Requests of search and kb_chat"
+    )
+    parser.add_argument(
+        "--unique-queries",
+        type=int,
+        default=0,
+        help="Distinct queries cycled through, 0 makes every query distinct",
+    )
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed requests")
+    parser.add_argument("--contexts", type=int, default=2000)
+    parser.add_argument("--doc-words", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--vs-type", type=str, default="numpy")
+    parser.add_argument("--rerank-model", type=str, default="mock-rerank")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="KEY=VALUE",
+        help="Settings of the server, passed as environment variables",
+    )
+    parser.add_argument("--root", type=str, help="RAG_ROOT, a temp dir by default")
+    parser.add_argument("--keep", action="store_true", help="Keep RAG_ROOT")
+    parser.add_argument("--output", type=str, help="Write the report to this file")
+    add_arguments(parser)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    report = main(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    print(text)
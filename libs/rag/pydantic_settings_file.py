@@ -4,13 +4,14 @@
 from __future__ import annotations
 
 import os
+import threading
 import typing as t
 from functools import cached_property
 from io import StringIO
 from pathlib import Path
 
 import ruamel.yaml
-from memoization import CachingAlgorithmFlag, cached
+from loguru import logger
 from pydantic import BaseModel, ConfigDict, Field, computed_field
 from pydantic_settings import (
     BaseSettings,
@@ -30,6 +31,7 @@ __all__ = [
     "computed_field",
     "cached_property",
     "settings_property",
+    "reload_settings",
 ]
 
 
@@ -266,36 +268,126 @@ class BaseFileSettings(BaseSettings):
 
 
 def _lazy_load_key(settings: BaseSettings):
+    """Class and (mtime, size) of each configuration file, None if missing"""
     keys = [settings.__class__]
     for n in ["env_file", "json_file", "yaml_file", "toml_file"]:
         key = None
         if file := settings.model_config.get(n):
-            if os.path.isfile(file) and os.path.getsize(file) > 0:
-                key = int(os.path.getmtime(file))
+            try:
+                stat = os.stat(file)
+            except OSError:
+                stat = None
+            if stat is not None and stat.st_size > 0:
+                key = (stat.st_mtime_ns, stat.st_size)
         keys.append(key)
     return tuple(keys)
 
 
 _T = t.TypeVar("_T", bound=BaseFileSettings)
 
+SETTINGS_RELOAD_INTERVAL = float(os.environ.get("SETTINGS_RELOAD_INTERVAL", 2.0))
 
-@cached(
-    max_size=1,
-    algorithm=CachingAlgorithmFlag.LRU,
-    thread_safe=True,
-    custom_key_maker=_lazy_load_key,
-)
-def _cached_settings(settings: _T) -> _T:
+
+class _SettingsHolder(t.Generic[_T]):
     """
-    the sesstings is cached, and refreshed when configuration files changed
+    The current instance of a settings class. A reload builds a new instance
+    and swaps it in, so readers never see a half-initialized one.
     """
-    if settings.auto_reload:
-        settings.__init__()
-    return settings
+
+    def __init__(self, settings: _T):
+        self.current = settings
+        self.key = _lazy_load_key(settings)
+
+    def reload_if_changed(self) -> bool:
+        key = _lazy_load_key(self.current)
+        if key == self.key or not self.current.auto_reload:
+            return False
+        self.key = key
+        try:
+            settings = self.current.__class__()
+        except Exception as e:
+            # keep serving the previous settings until the file is fixed
+            logger.error(
+                f"{e.__class__.__name__}: Fail to reload "
+                f"{self.current.__class__.__name__}: {e}"
+            )
+            return False
+        self.current = settings
+        logger.info(f"Reloaded {settings.__class__.__name__}")
+        return True
+
+
+class _SettingsWatcher:
+    """Poll the configuration files of settings and reload the changed ones"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._holders: t.List[_SettingsHolder] = []
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: t.Optional[threading.Thread] = None
+
+    def register(self, holder: _SettingsHolder):
+        with self._lock:
+            self._holders.append(holder)
+        self.start()
+
+    def check(self):
+        """Reload the settings whose files changed since the last check"""
+        with self._lock:
+            holders = list(self._holders)
+        for holder in holders:
+            holder.reload_if_changed()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: Settings watcher: {e}")
+
+    def start(self):
+        with self._lock:
+            if self.interval <= 0 or (self._thread and self._thread.is_alive()):
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="settings-watcher", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _after_fork(self):
+        # threads do not survive a fork, the child starts its own watcher
+        self._lock = threading.Lock()
+        self._thread = None
+        if self._holders:
+            self.start()
+
+
+settings_watcher = _SettingsWatcher(SETTINGS_RELOAD_INTERVAL)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=settings_watcher._after_fork)
+
+
+def reload_settings():
+    """Reload the changed settings now instead of at the next watcher poll"""
+    settings_watcher.check()
 
 
 def settings_property(settings: _T):
+    """
+    Property serving the current instance of settings: reads are a plain
+    attribute lookup, the background watcher swaps in a new instance when the
+    configuration files change (every SETTINGS_RELOAD_INTERVAL seconds, 0 to
+    disable hot reload).
+    """
+    holder = _SettingsHolder(settings)
+    settings_watcher.register(holder)
+
     def wrapper(self) -> _T:
-        return _cached_settings(settings)
+        return holder.current
 
     return property(wrapper)
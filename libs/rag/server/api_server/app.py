@@ -1,4 +1,5 @@
 import argparse
+from contextlib import asynccontextmanager
 
 import uvicorn
 from fastapi import FastAPI
@@ -6,10 +7,32 @@ from fastapi.middleware.cors import CORSMiddleware
 from rag import __version__
 from rag.server.api_server.chat_routes import chat_router
 from rag.server.api_server.kb_routers import kb_router
+from rag.server.kb.jobs import job_manager
+from rag.server.kb.kb_pool import kb_pool
+from rag.server.llm.base import LLMFactory
+from rag.server.llm.embed_cache import embed_cache
+from rag.server.metrics import MetricsMiddleware, metrics
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    kb_pool.warmup(Settings.kb_settings.WARMUP_KBS)
+    job_manager.start()
+    yield
+    job_manager.shutdown()
+    kb_pool.close()
+    await LLMFactory.aclose()
+    embed_cache.close()
+    # drain the background log writers
+    await logger.complete()
 
 
 def create_app():
-    app = FastAPI(title="RAG API", version=__version__)
+    app = FastAPI(title="RAG API", version=__version__, lifespan=lifespan)
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["*"],
@@ -17,9 +40,11 @@ def create_app():
         allow_methods=["*"],
         allow_headers=["*"],
     )
+    app.add_middleware(MetricsMiddleware)
 
     app.include_router(chat_router)
     app.include_router(kb_router)
+    app.get("/metrics", include_in_schema=False)(metrics)
     return app
 
 
@@ -1,5 +1,7 @@
 from fastapi import APIRouter, Request
-from rag.server.chat.kb_chat import kb_chat
+from rag.server.chat.kb_chat import compress_stats, kb_chat
+from rag.server.models.api_spec import BaseResponse
 
 chat_router = APIRouter(prefix="/chat", tags=["chat"])
 chat_router.post("/kb_chat", summary="knowledge base chat")(kb_chat)
+chat_router.get("/compress_stats", response_model=BaseResponse)(compress_stats)
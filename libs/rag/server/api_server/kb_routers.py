@@ -14,5 +14,12 @@ kb_router.post("/drop_collection", response_model=BaseResponse)(drop_collection)
 
 kb_router.post("/upload_docs", response_model=BaseResponse)(upload_docs)
 kb_router.post("/add_context", response_model=BaseResponse)(add_context)
+kb_router.get("/jobs", response_model=ListResponse)(list_jobs)
+kb_router.get("/jobs/{job_id}", response_model=BaseResponse)(get_job)
+kb_router.post("/jobs/{job_id}/cancel", response_model=BaseResponse)(cancel_job)
 
 kb_router.post("/search", response_model=ListResponse)(search)
+kb_router.post("/batch_search", response_model=ListResponse)(batch_search)
+
+kb_router.get("/pool_stats", response_model=BaseResponse)(pool_stats)
+kb_router.get("/cache_stats", response_model=BaseResponse)(cache_stats)
@@ -0,0 +1,184 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from rag.server.metrics import count_cache
+from rag.server.models.kb_spec import Context
+from rag.settings import Settings
+
+# (kb_name, collection_name, prompt_name, model, top_k, score_threshold, hybrid,
+# rerank, compress, filters), every request parameter the answer depends on
+PartitionKey = Tuple[str, str, str, str, int, float, bool, bool, bool, Optional[str]]
+
+
+class _Entry:
+    def __init__(self, partition: PartitionKey, vector: np.ndarray, answer: str, docs):
+        self.partition = partition
+        self.vector = vector
+        self.answer = answer
+        self.docs = docs
+        self.created = time.time()
+
+
+class _Partition:
+    def __init__(self):
+        self.entries: Dict[int, _Entry] = {}
+        self._ids: List[int] = []
+        self._matrix: Optional[np.ndarray] = None
+
+    def add(self, entry_id: int, entry: _Entry):
+        self.entries[entry_id] = entry
+        self._matrix = None
+
+    def remove(self, entry_id: int):
+        if self.entries.pop(entry_id, None) is not None:
+            self._matrix = None
+
+    def nearest(self, vector: np.ndarray) -> Tuple[Optional[int], float]:
+        if not self.entries:
+            return None, 0.0
+        if self._matrix is None:
+            self._ids = list(self.entries)
+            self._matrix = np.stack([self.entries[i].vector for i in self._ids])
+        scores = self._matrix @ vector
+        best = int(np.argmax(scores))
+        return self._ids[best], float(scores[best])
+
+
+class SemanticAnswerCache:
+    """
+    Cache of kb_chat answers looked up by cosine similarity of query embeddings.
+
+    Entries are partitioned by (kb, collection, prompt_name, model), so a hit
+    never crosses knowledge bases or prompt modes. Eviction is LRU over all
+    partitions plus a TTL, and ``invalidate`` drops the answers of a collection
+    whenever its content changes. Answers computed across an invalidation are
+    not stored: take the ``version`` of the partition before searching and
+    pass it to ``put``.
+    """
+
+    def __init__(
+        self,
+        max_size: int = None,
+        ttl: float = None,
+        threshold: float = None,
+    ):
+        model_settings = Settings.model_settings
+        self.max_size = (
+            model_settings.ANSWER_CACHE_SIZE if max_size is None else max_size
+        )
+        self.ttl = model_settings.ANSWER_CACHE_TTL if ttl is None else ttl
+        self.threshold = (
+            model_settings.ANSWER_CACHE_THRESHOLD if threshold is None else threshold
+        )
+        self._lru: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._partitions: Dict[PartitionKey, _Partition] = {}
+        self._ids = itertools.count()
+        # invalidation count of each kb (collection None) and collection
+        self._versions: Dict[Tuple[str, Optional[str]], int] = {}
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _remove(self, entry_id: int):
+        entry = self._lru.pop(entry_id)
+        partition = self._partitions[entry.partition]
+        partition.remove(entry_id)
+        if not partition.entries:
+            del self._partitions[entry.partition]
+
+    def version(self, partition: PartitionKey) -> Tuple[int, int]:
+        """Version of the content behind a partition, changed by ``invalidate``"""
+        with self._lock:
+            return self._version(partition)
+
+    def _version(self, partition: PartitionKey) -> Tuple[int, int]:
+        kb_name, collection_name = partition[0], partition[1]
+        return (
+            self._versions.get((kb_name, None), 0),
+            self._versions.get((kb_name, collection_name), 0),
+        )
+
+    def get(
+        self, partition: PartitionKey, embedding: List[float]
+    ) -> Optional[Tuple[str, List[Context]]]:
+        vector = self._normalize(embedding)
+        with self._lock:
+            entry_id, score = None, 0.0
+            if partition in self._partitions:
+                entry_id, score = self._partitions[partition].nearest(vector)
+            hit = None
+            if entry_id is not None and score >= self.threshold:
+                entry = self._lru[entry_id]
+                if not self.ttl or time.time() - entry.created <= self.ttl:
+                    self._lru.move_to_end(entry_id)
+                    self._hits += 1
+                    hit = entry.answer, entry.docs
+                else:
+                    self._remove(entry_id)
+            if hit is None:
+                self._misses += 1
+        count_cache("answer", "miss" if hit is None else "hit")
+        return hit
+
+    def put(
+        self,
+        partition: PartitionKey,
+        embedding: List[float],
+        answer: str,
+        docs: List[Context],
+        version: Tuple[int, int] = None,
+    ):
+        """
+        Store an answer, dropped if the partition was invalidated since
+        ``version`` was taken, as its contexts may be deleted or outdated
+        """
+        if self.max_size <= 0 or answer is None:
+            return
+        entry = _Entry(partition, self._normalize(embedding), answer, docs)
+        with self._lock:
+            if version is not None and self._version(partition) != version:
+                return
+            entry_id = next(self._ids)
+            self._lru[entry_id] = entry
+            self._partitions.setdefault(partition, _Partition()).add(entry_id, entry)
+            while len(self._lru) > self.max_size:
+                self._remove(next(iter(self._lru)))
+
+    def invalidate(self, kb_name: str, collection_name: str = None):
+        """Drop cached answers of a collection, or of the whole kb"""
+        with self._lock:
+            version_key = (kb_name, collection_name)
+            self._versions[version_key] = self._versions.get(version_key, 0) + 1
+            for key in list(self._partitions):
+                if key[0] == kb_name and collection_name in (None, key[1]):
+                    for entry_id in list(self._partitions[key].entries):
+                        self._remove(entry_id)
+                    self._invalidations += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "size": len(self._lru),
+                "max_size": self.max_size,
+                "partitions": len(self._partitions),
+                "threshold": self.threshold,
+                "hits": self._hits,
+                "misses": self._misses,
+                "invalidations": self._invalidations,
+                "hit_ratio": self._hits / total if total else 0.0,
+            }
+
+
+answer_cache = SemanticAnswerCache()
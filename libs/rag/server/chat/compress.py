@@ -0,0 +1,165 @@
+import re
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from rag.server.chat.utils import count_tokens
+from rag.server.kb.base import KBService
+from rag.server.llm.embed_cache import embed_cache
+from rag.server.models.kb_spec import Context
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+# a sentence ends at Chinese end punctuation, or at western end punctuation
+# followed by a space, closing quotes and brackets stay with their sentence
+_SENTENCE_END_RE = re.compile(r"[。！？；…\n]+[”’」』）】]*|[.!?;]+[\"')\]]*(?=\s)")
+# fragments shorter than this are merged into the previous sentence
+MIN_SENTENCE_CHARS = 4
+GAP = " … "
+
+
+def split_sentences(text: str) -> List[Tuple[int, int]]:
+    """(start, end) character spans of the sentences of text"""
+    spans, start = [], 0
+    for match in _SENTENCE_END_RE.finditer(text):
+        end = match.end()
+        if spans and end - start < MIN_SENTENCE_CHARS:
+            spans[-1] = (spans[-1][0], end)
+        elif text[start:end].strip():
+            spans.append((start, end))
+        start = end
+    if text[start:].strip():
+        if spans and len(text) - start < MIN_SENTENCE_CHARS:
+            spans[-1] = (spans[-1][0], len(text))
+        else:
+            spans.append((start, len(text)))
+    return spans
+
+
+def select_spans(scores: np.ndarray, top_n: int, neighbours: int) -> List[int]:
+    """Indexes of the ``top_n`` best sentences and their neighbours, in text order"""
+    keep = np.zeros(len(scores), dtype=bool)
+    for i in np.argsort(-scores)[:top_n]:
+        keep[max(i - neighbours, 0) : i + neighbours + 1] = True
+    return np.flatnonzero(keep).tolist()
+
+
+class ContextCompressor:
+    """
+    Cut retrieved contexts down to the sentences relevant to the query.
+
+    Contexts are split into sentences, which are embedded through the
+    embedding cache in batched requests and scored against the query embedding
+    in one cosine pass. Each context
+    keeps its ``top_n`` best sentences and their neighbours, skipped runs are
+    marked by an ellipsis. If the sentences can not be embedded, the contexts
+    are kept whole.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._contexts = 0
+        self._tokens_in = 0
+        self._tokens_out = 0
+        self._failures = 0
+
+    @staticmethod
+    async def _aembed(kb: KBService, texts: List[str]) -> Optional[np.ndarray]:
+        """
+        Embed sentences through the embedding cache, so the sentences of
+        popular contexts are only embedded once
+        """
+        try:
+            embeddings = await embed_cache.aembed_many(
+                kb.aembed_func, kb.embed_model, kb.context_window, texts
+            )
+        except Exception as e:
+            logger.error(f"{e.__class__.__name__}: Fail to embed sentences: {e}")
+            return None
+        if any(embedding is None for embedding in embeddings):
+            return None
+        return np.asarray(embeddings, dtype=np.float32)
+
+    async def acompress(
+        self,
+        kb: KBService,
+        query_embedding: List[float],
+        docs: List[Context],
+        top_n: int = None,
+        neighbours: int = None,
+    ) -> List[Context]:
+        """Return docs with their content reduced to the query-relevant sentences"""
+        model_settings = Settings.model_settings
+        top_n = model_settings.COMPRESS_TOP_SENTENCES if top_n is None else top_n
+        if neighbours is None:
+            neighbours = model_settings.COMPRESS_NEIGHBOURS
+        if not docs:
+            return docs
+        spans = [split_sentences(doc.content) for doc in docs]
+        # contexts already as short as the selection are left as they are
+        max_kept = top_n * (2 * neighbours + 1)
+        todo = [i for i, doc_spans in enumerate(spans) if len(doc_spans) > max_kept]
+        sentences = [
+            docs[i].content[start:end].strip() for i in todo for start, end in spans[i]
+        ]
+        embeddings = await self._aembed(kb, sentences) if sentences else None
+        if sentences and embeddings is None:
+            logger.warning("Fail to embed sentences, keep contexts uncompressed")
+            with self._lock:
+                self._failures += 1
+            return docs
+
+        compressed = list(docs)
+        if sentences:
+            query = np.asarray(query_embedding, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1.0
+            norms = np.linalg.norm(embeddings, axis=1)
+            scores = embeddings @ query / np.where(norms == 0, 1.0, norms)
+            offset = 0
+            for i in todo:
+                n = len(spans[i])
+                kept = select_spans(scores[offset : offset + n], top_n, neighbours)
+                offset += n
+                content, parts, last = docs[i].content, [], None
+                for j in kept:
+                    if last is not None and j != last + 1:
+                        parts.append(GAP)
+                    parts.append(content[spans[i][j][0] : spans[i][j][1]].strip())
+                    last = j
+                if kept[0] > 0:
+                    parts.insert(0, GAP.lstrip())
+                if kept[-1] < n - 1:
+                    parts.append(GAP.rstrip())
+                compressed[i] = docs[i].model_copy(update={"content": "".join(parts)})
+
+        tokens_in = sum(count_tokens(doc.content) for doc in docs)
+        tokens_out = sum(count_tokens(doc.content) for doc in compressed)
+        logger.info(
+            f"Compressed {len(todo)} of {len(docs)} contexts "
+            f"from {tokens_in} to {tokens_out} tokens"
+        )
+        with self._lock:
+            self._requests += 1
+            self._contexts += len(todo)
+            self._tokens_in += tokens_in
+            self._tokens_out += tokens_out
+        return compressed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            tokens_out = self._tokens_out
+            return {
+                "requests": self._requests,
+                "contexts": self._contexts,
+                "failures": self._failures,
+                "tokens_in": self._tokens_in,
+                "tokens_out": self._tokens_out,
+                "tokens_saved": self._tokens_in - self._tokens_out,
+                "ratio": self._tokens_in / tokens_out if tokens_out else 0.0,
+            }
+
+
+compressor = ContextCompressor()
@@ -1,17 +1,92 @@
-from typing import List
+import asyncio
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional
 
 from fastapi import Body
-from rag.server.chat.utils import construct_message
-from rag.server.kb.kb_api import search
-from rag.server.llm.base import LLMFactory
+from fastapi.responses import StreamingResponse
+from rag.server.api_server.utils import map_collection_name
+from rag.server.chat.answer_cache import answer_cache
+from rag.server.chat.compress import compressor
+from rag.server.chat.rerank import reranker
+from rag.server.chat.utils import construct_message, sse_event
+from rag.server.kb.base import KBServiceFactory
+from rag.server.llm.base import LLM, LLMFactory
 from rag.server.models.api_spec import BaseResponse
+from rag.server.models.kb_spec import Context, ContextFilter
 from rag.server.models.model_spec import History
+from rag.server.timing import RequestTimings, start_request
 from rag.settings import Settings
-from rag.utils import build_logger
+from rag.utils import build_logger, shorten
 
 logger = build_logger()
 
 
+async def _stream_chat(
+    llm: LLM,
+    messages: List[Dict[str, str]],
+    docs: List[Context],
+    timings: RequestTimings,
+    on_complete: Callable[[str], None] = None,
+    **kwargs,
+) -> AsyncIterator[str]:
+    """
+    Server-sent events of a streaming chat:
+    contexts -> token * n -> usage, or an error event if generation fails
+    """
+    yield sse_event("contexts", [doc.model_dump() for doc in docs])
+    first_token_latency, usage, response = None, {}, []
+    llm_start = time.perf_counter()
+    try:
+        async for chunk in llm.astream_chat(messages, **kwargs):
+            if chunk.usage:
+                usage = chunk.usage
+            if chunk.content:
+                if first_token_latency is None:
+                    first_token_latency = timings.elapsed()
+                    timings.record("llm_first_token", time.perf_counter() - llm_start)
+                response.append(chunk.content)
+                yield sse_event("token", {"content": chunk.content})
+    except Exception as e:
+        msg = f"Fail to stream chat response: {e}"
+        logger.error(f"{e.__class__.__name__}: {msg}")
+        timings.record("llm", time.perf_counter() - llm_start)
+        timings.finish(error=e.__class__.__name__)
+        yield sse_event("error", {"code": 500, "msg": msg})
+        return
+    except (GeneratorExit, asyncio.CancelledError):
+        # the client went away before the end of the stream
+        timings.record("llm", time.perf_counter() - llm_start)
+        timings.finish(error="Disconnected")
+        raise
+    timings.record("llm", time.perf_counter() - llm_start)
+    response = "".join(response)
+    logger.debug(f"Model response: {shorten(response)}")
+    if on_complete is not None:
+        on_complete(response)
+    timings.finish(**usage)
+    yield sse_event(
+        "usage",
+        {
+            **usage,
+            "first_token_latency": first_token_latency,
+            "total_latency": timings.elapsed(),
+        },
+    )
+
+
+async def _stream_cached(
+    answer: str, docs: List[Context], timings: RequestTimings
+) -> AsyncIterator[str]:
+    yield sse_event("contexts", [doc.model_dump() for doc in docs])
+    yield sse_event("token", {"content": answer})
+    latency = timings.elapsed()
+    timings.finish()
+    yield sse_event(
+        "usage",
+        {"cached": True, "first_token_latency": latency, "total_latency": latency},
+    )
+
+
 async def kb_chat(
     query: str = Body(
         description="Query to chat with knowledge base",
@@ -38,24 +113,136 @@ async def kb_chat(
     temperature: float = Body(0.6, description="Temperature of sampling"),
     max_tokens: int = Body(2000, description="Max tokens of sampling"),
     prompt_name: str = Body("default", description="Prompt template name"),
+    use_cache: bool = Body(
+        True, description="Look up and store the answer in the semantic answer cache"
+    ),
+    rerank: Optional[bool] = Body(
+        None, description="Rerank retrieved contexts, defaults to RERANK_ENABLED"
+    ),
+    filters: Optional[ContextFilter] = Body(
+        None, description="Only retrieve contexts whose metadata match the filter"
+    ),
+    hybrid: Optional[bool] = Body(
+        None, description="Fuse BM25 hits with vector hits, defaults to HYBRID_SEARCH"
+    ),
+    compress: Optional[bool] = Body(
+        None,
+        description="Keep only query-relevant sentences, defaults to COMPRESS_ENABLED",
+    ),
 ):
     """
     Knowledge base chat
     """
-    logger.info(f"User query: {query}")
+    logger.info(f"User query: {shorten(query)}")
+    timings = start_request(
+        "kb_chat", kb_name=kb_name, collection_name=collection_name, stream=stream
+    )
+    if rerank is None:
+        rerank = Settings.model_settings.RERANK_ENABLED
+    if compress is None:
+        compress = Settings.model_settings.COMPRESS_ENABLED
+    if hybrid is None:
+        hybrid = Settings.kb_settings.HYBRID_SEARCH
     try:
+        cache_partition, on_complete = None, None
         if kb_name is not None and collection_name is not None:
-            docs = search(query, kb_name, collection_name, top_k, score_threshold)
+            kb = KBServiceFactory.get_kb_service_by_name(kb_name)
+            mapped_collection_name = map_collection_name(kb_name, collection_name)
+            # answers depend on the history, so only first-turn questions are cached
+            if use_cache and not history and Settings.model_settings.ANSWER_CACHE_ENABLED:
+                cache_partition = (
+                    kb_name,
+                    mapped_collection_name,
+                    prompt_name,
+                    model,
+                    top_k,
+                    score_threshold,
+                    hybrid,
+                    rerank,
+                    compress,
+                    filters.model_dump_json() if filters else None,
+                )
+                # taken before the search, an answer outliving a change is not cached
+                cache_version = answer_cache.version(cache_partition)
+                query_embedding = await kb.aembed_query(query)
+                cached = answer_cache.get(cache_partition, query_embedding)
+                if cached is not None:
+                    answer, docs = cached
+                    logger.info(f"Answer cache hit: {shorten(query)}")
+                    timings.fields["cached"] = True
+                    if stream:
+                        return StreamingResponse(
+                            _stream_cached(answer, docs, timings),
+                            media_type="text/event-stream",
+                        )
+                    timings.finish()
+                    return BaseResponse(code=200, msg="Chat success", data=answer)
+            # over-fetch candidates and let the reranker keep the best top_k
+            fetch_k = top_k
+            if rerank:
+                fetch_k *= Settings.model_settings.RERANK_FETCH_FACTOR
+            docs = await kb.asearch(
+                query,
+                mapped_collection_name,
+                fetch_k,
+                score_threshold,
+                hybrid=hybrid,
+                filters=filters,
+            )
+            if rerank:
+                with timings.stage("rerank"):
+                    docs = await reranker.arerank(query, docs, top_k)
+            if compress:
+                # the query embedding of the search is served by the embedding cache
+                query_embedding = await kb.aembed_query(query)
+                with timings.stage("compress"):
+                    docs = await compressor.acompress(kb, query_embedding, docs)
+            if cache_partition is not None:
+
+                def on_complete(response: str):
+                    answer_cache.put(
+                        cache_partition, query_embedding, response, docs, cache_version
+                    )
+
         else:
             docs = []
-        logger.info(f"Find docs: {docs}")
+        logger.info(f"Find {len(docs)} docs")
+        logger.debug(f"Find docs: {shorten(docs)}")
+        timings.fields["docs"] = len(docs)
         prompt_template = Settings.prompt_settings.RAG_PROMPT[prompt_name]
         llm = LLMFactory.get_llm_service(model)
-        messages = construct_message(query, history, docs, prompt_template)
-        response = llm.chat(messages, temperature=temperature, max_tokens=max_tokens)
-        logger.info(f"Model response: {response}")
+        with timings.stage("prompt"):
+            messages = construct_message(query, history, docs, prompt_template)
+        if stream:
+            return StreamingResponse(
+                _stream_chat(
+                    llm,
+                    messages,
+                    docs,
+                    timings,
+                    on_complete=on_complete,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                ),
+                media_type="text/event-stream",
+            )
+        with timings.stage("llm"):
+            response = await llm.achat(
+                messages, temperature=temperature, max_tokens=max_tokens
+            )
+        logger.debug(f"Model response: {shorten(response)}")
+        if on_complete is not None:
+            on_complete(response)
     except Exception as e:
         msg = f"Fail to chat with knowledge base {kb_name} on Collection {collection_name}: {e}"
         logger.error(f"{e.__class__.__name__}: {msg}")
+        timings.finish(error=e.__class__.__name__)
         return BaseResponse(code=500, msg=msg)
+    timings.finish()
     return BaseResponse(code=200, msg="Chat success", data=response)
+
+
+def compress_stats() -> BaseResponse:
+    return BaseResponse(
+        code=200, msg="Context compression stats", data=compressor.stats()
+    )
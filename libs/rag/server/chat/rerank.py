@@ -0,0 +1,117 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from rag.server.llm.base import LLMFactory
+from rag.server.llm.embed_cache import normalize_text
+from rag.server.models.kb_spec import Context
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+
+class Reranker:
+    """
+    Reorder retrieved contexts with a rerank model and keep the best ``top_k``.
+
+    Scores are cached per (model, query, context content), so a repeated
+    question only sends the contexts it has not scored yet, in one request.
+    If the rerank request fails, the retrieval order is kept.
+    """
+
+    def __init__(self, max_size: int = None, ttl: float = None):
+        model_settings = Settings.model_settings
+        self.max_size = (
+            model_settings.RERANK_CACHE_SIZE if max_size is None else max_size
+        )
+        self.ttl = model_settings.RERANK_CACHE_TTL if ttl is None else ttl
+        self._scores: "OrderedDict[str, tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._failures = 0
+
+    @staticmethod
+    def make_key(model: str, query: str, content: str) -> str:
+        raw = f"{model}\0{normalize_text(query)}\0{content}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def _get(self, key: str, now: float) -> Optional[float]:
+        item = self._scores.get(key)
+        if item is None:
+            return None
+        created, score = item
+        if self.ttl and now - created > self.ttl:
+            del self._scores[key]
+            return None
+        self._scores.move_to_end(key)
+        return score
+
+    def _put(self, key: str, score: float, now: float):
+        if self.max_size <= 0:
+            return
+        self._scores[key] = (now, score)
+        self._scores.move_to_end(key)
+        while len(self._scores) > self.max_size:
+            self._scores.popitem(last=False)
+
+    async def arerank(
+        self, query: str, docs: List[Context], top_k: int, model: str = None
+    ) -> List[Context]:
+        """Return the ``top_k`` best docs, ``distance`` holds the rerank score"""
+        if not docs:
+            return docs
+        model = model or Settings.model_settings.DEFAULT_RERANK_MODEL
+        keys = [self.make_key(model, query, doc.content) for doc in docs]
+        now = time.time()
+        with self._lock:
+            scores = [self._get(key, now) for key in keys]
+        missing = [i for i, score in enumerate(scores) if score is None]
+        with self._lock:
+            self._hits += len(docs) - len(missing)
+            self._misses += len(missing)
+        if missing:
+            llm = LLMFactory.get_llm_service(model)
+            try:
+                new_scores = await llm.arerank(
+                    query, [docs[i].content for i in missing]
+                )
+            except Exception as e:
+                logger.warning(
+                    f"{e.__class__.__name__}: Rerank with {model} failed, "
+                    "keep retrieval order"
+                )
+                with self._lock:
+                    self._failures += 1
+                return docs[:top_k]
+            now = time.time()
+            with self._lock:
+                for i, score in zip(missing, new_scores):
+                    scores[i] = score
+                    self._put(keys[i], score, now)
+        ranked = sorted(range(len(docs)), key=lambda i: scores[i], reverse=True)
+        return [
+            docs[i].model_copy(update={"distance": scores[i]}) for i in ranked[:top_k]
+        ]
+
+    def clear(self):
+        with self._lock:
+            self._scores.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._misses
+            return {
+                "size": len(self._scores),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "failures": self._failures,
+                "hit_ratio": self._hits / total if total else 0.0,
+            }
+
+
+reranker = Reranker()
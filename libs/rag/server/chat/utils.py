@@ -1,21 +1,154 @@
-from typing import Dict, List, Union
+import json
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Union
+
+from rag.server.kb.ingest import estimate_tokens
 from rag.server.models.kb_spec import Context
 from rag.server.models.model_spec import History
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
 
 USER_PROMPT_INDEX = 1
+# role and separator tokens the chat format adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+# below this, a context is dropped rather than cut to fit the budget
+MIN_CONTEXT_TOKENS = 32
+
+
+@lru_cache()
+def _encoding(name: str):
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding(name)
+    except Exception as e:
+        logger.warning(f"Tokenizer {name} unavailable, tokens are estimated: {e}")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    """Tokens of text with the local PROMPT_TOKENIZER, estimated without tiktoken"""
+    encoding = _encoding(Settings.model_settings.PROMPT_TOKENIZER)
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of text within max_tokens"""
+    encoding = _encoding(Settings.model_settings.PROMPT_TOKENIZER)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens])
+    tokens = estimate_tokens(text)
+    while tokens > max_tokens:
+        text = text[: len(text) * max_tokens // tokens]
+        tokens = estimate_tokens(text)
+    return text
+
+
+def format_context(index: int, context: Context) -> str:
+    return f"[{index}] {context.content}"
+
+
+def format_history(history: History) -> str:
+    return f"{history.role}: {history.content}"
+
+
+def select_history(
+    history: List[History], max_tokens: int, history_len: int = None
+) -> List[History]:
+    """The latest ``history_len`` rounds of history, oldest first, within max_tokens"""
+    if history_len is None:
+        history_len = Settings.model_settings.HISTORY_LEN
+    recent = history[-2 * history_len :] if history_len > 0 else []
+    selected, used = [], 0
+    for item in reversed(recent):
+        tokens = count_tokens(format_history(item)) + 1
+        if used + tokens > max_tokens:
+            break
+        selected.append(item)
+        used += tokens
+    return selected[::-1]
+
+
+def select_contexts(contexts: List[Context], max_tokens: int) -> List[str]:
+    """
+    Formatted contexts within max_tokens, best scored first. A context which
+    does not fit is cut to the remaining budget, or dropped with the rest if
+    too little is left.
+    """
+    ranked = sorted(
+        contexts,
+        key=lambda c: float("-inf") if c.distance is None else c.distance,
+        reverse=True,
+    )
+    selected, used = [], 0
+    for context in ranked:
+        text = format_context(len(selected) + 1, context)
+        tokens = count_tokens(text) + 2
+        if used + tokens > max_tokens:
+            remaining = max_tokens - used - 2
+            if remaining >= MIN_CONTEXT_TOKENS:
+                selected.append(truncate_tokens(text, remaining))
+            break
+        selected.append(text)
+        used += tokens
+    if len(selected) < len(contexts):
+        logger.info(
+            f"Prompt budget of {max_tokens} tokens fits {len(selected)} "
+            f"of {len(contexts)} contexts"
+        )
+    return selected
+
 
 def construct_message(
     query: str,
     history: List[History],
     contexts: List[Context],
-    prompt_template: Union[str, Dict[str, str], List[Dict[str, str]]]
+    prompt_template: Union[str, Dict[str, str], List[Dict[str, str]]],
+    max_tokens: Optional[int] = None,
 ) -> List[Dict[str, str]]:
-    format_context = {
-        "query": query,
-        "history": history,
-        "contexts": contexts,
-    }
+    """
+    Fill the prompt template with the query, the latest history and the best
+    contexts, so that the whole prompt stays within ``max_tokens``
+    (PROMPT_MAX_TOKENS by default). History gets at most PROMPT_HISTORY_TOKENS,
+    contexts get what is left. The template itself is left untouched.
+    """
+    model_settings = Settings.model_settings
+    if max_tokens is None:
+        max_tokens = model_settings.PROMPT_MAX_TOKENS
+    if isinstance(prompt_template, str):
+        prompt_template = [{"role": "user", "content": prompt_template}]
+    elif isinstance(prompt_template, dict):
+        prompt_template = [prompt_template]
+    user_index = min(USER_PROMPT_INDEX, len(prompt_template) - 1)
+
+    fixed = count_tokens(query)
+    for i, message in enumerate(prompt_template):
+        content = message["content"]
+        if i == user_index:
+            content = content.format(query="", history="", contexts="")
+        fixed += count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    budget = max(max_tokens - fixed, 0)
+    history = select_history(
+        history or [], min(budget, model_settings.PROMPT_HISTORY_TOKENS)
+    )
+    history_text = "\n".join(format_history(h) for h in history)
+    budget -= count_tokens(history_text)
+    contexts_text = "\n\n".join(select_contexts(contexts, budget))
+
+    messages = [dict(message) for message in prompt_template]
+    messages[user_index]["content"] = messages[user_index]["content"].format(
+        query=query, history=history_text, contexts=contexts_text
+    )
+    return messages
 
-    prompt_template[USER_PROMPT_INDEX]["content"] = prompt_template[USER_PROMPT_INDEX]["content"].format(format_context)
 
-    return prompt_template
+def sse_event(event: str, data: Any) -> str:
+    """Format a server-sent event, data is serialized as a single json line"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
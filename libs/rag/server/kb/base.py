@@ -1,16 +1,38 @@
+import asyncio
+import shutil
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import List, Union
+from functools import partial
+from pathlib import Path
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
 
-from rag.server.models.kb_spec import Context
+from rag.server.metrics import VECTOR_SEARCH_LATENCY
+from rag.server.models.kb_spec import Context, ContextFilter, IngestStats
+from rag.server.timing import stage
 from rag.settings import Settings
 
 
 class SupportedVectorStoreTypes:
     FAISS = "faiss"
     MILVUS = "milvus"
+    NUMPY = "numpy"
 
 
 class KBService(ABC):
+    # one of SupportedVectorStoreTypes, labels the metrics of the service
+    vs_type: str = None
+
     def __init__(
         self,
         kb_name: str,
@@ -20,17 +42,338 @@ class KBService(ABC):
         self.kb_name = kb_name
         self.kb_info = kb_info
         self.embed_model = embed_model
+        self._lexical_indexes = {}
+        self._lexical_lock = threading.Lock()
 
-    def add_doc(self):
-        # TODO 1. parse document into Context list contexts
-        contexts = []
-        for context in contexts:
-            self.add_context(context)
+    def init_embedding(self, embed_model: str) -> int:
+        """
+        Resolve the embedding model of the kb, set ``context_window``,
+        ``embed_func`` and ``aembed_func``, and return the embedding dim
+        """
+        from rag.server.llm.base import LLMFactory
+        from rag.server.llm.utils import get_model_configs
 
-    def delete_doc(self):
-        # TODO search context by doc metadata
-        # TODO delete context from vector store
-        pass
+        embedding_model_config = get_model_configs(embed_model)
+        embed_dim = embedding_model_config.meta_data.get(
+            "embed_size", Settings.model_settings.DEFAULT_EMBEDDING_SIZE
+        )
+        self.context_window = embedding_model_config.meta_data.get(
+            "context_window", Settings.model_settings.DEFAULT_EMBEDDING_CONTEXT_WINDOW
+        )
+        embed_service = LLMFactory.get_llm_service(embed_model)
+        self.embed_func = partial(
+            embed_service.embed, context_window=self.context_window
+        )
+        self.aembed_func = partial(
+            embed_service.aembed, context_window=self.context_window
+        )
+        return embed_dim
+
+    def embed_query(self, query: str) -> List[float]:
+        """Embed a query through the shared embedding cache, needs ``embed_func``"""
+        from rag.server.llm.embed_cache import embed_cache
+
+        with stage("embed"):
+            return embed_cache.embed(
+                self.embed_func, self.embed_model, self.context_window, query
+            )
+
+    async def aembed_query(self, query: str) -> List[float]:
+        from rag.server.llm.embed_cache import embed_cache
+
+        with stage("embed"):
+            return await embed_cache.aembed(
+                self.aembed_func, self.embed_model, self.context_window, query
+            )
+
+    def embed_queries(self, queries: List[str]) -> List[Optional[List[float]]]:
+        """Embed many queries through the embedding cache in batched requests"""
+        from rag.server.llm.embed_cache import embed_cache
+
+        with stage("embed"):
+            return embed_cache.embed_many(
+                self.embed_func, self.embed_model, self.context_window, queries
+            )
+
+    def lexical_index(self, collection_name: str):
+        """The BM25 index over the content of a collection, loaded on first use"""
+        from rag.server.kb.lexical import BM25Index
+
+        with self._lexical_lock:
+            index = self._lexical_indexes.get(collection_name)
+            if index is None:
+                index = BM25Index(self._lexical_path(collection_name))
+                self._lexical_indexes[collection_name] = index
+            return index
+
+    def _lexical_path(self, collection_name: str) -> Path:
+        root = Path(Settings.basic_settings.KB_ROOT_PATH)
+        return root / self.kb_name / "lexical" / collection_name
+
+    def drop_lexical_index(self, collection_name: str):
+        with self._lexical_lock:
+            self._lexical_indexes.pop(collection_name, None)
+        shutil.rmtree(self._lexical_path(collection_name), ignore_errors=True)
+
+    def with_lexical_index(
+        self,
+        collection_name: str,
+        insert_func: Callable[[List[Dict[str, Any]]], Sequence[Union[str, int]]],
+    ) -> Callable[[List[Dict[str, Any]]], None]:
+        """
+        Wrap an insert function returning the ids the vector store gave to the
+        rows, so inserted rows are also added to the lexical index
+        """
+        if not Settings.kb_settings.LEXICAL_INDEX:
+            return insert_func
+
+        def insert(rows: List[Dict[str, Any]]):
+            ids = insert_func(rows)
+            self.lexical_index(collection_name).add(
+                list(ids),
+                [row["content"] for row in rows],
+                [(row["metadata"] or {}).get("file_name") for row in rows],
+            )
+
+        return insert
+
+    @abstractmethod
+    def get_by_ids(
+        self, collection_name: str, ids: List[Union[str, int]]
+    ) -> List[Context]:
+        """Fetch contexts by id, needed to join lexical hits with the vector store"""
+
+    def lexical_search(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int,
+        filters: Optional[ContextFilter] = None,
+    ) -> List[Context]:
+        """BM25 search over the collection, ``distance`` holds the BM25 score"""
+        # the postings know nothing of metadata, filters are applied to an over-fetch
+        fetch_k = top_k if filters is None else top_k * 4
+        hits = self.lexical_index(collection_name).search(query, fetch_k)
+        if not hits:
+            return []
+        stored = {c.id: c for c in self.get_by_ids(collection_name, [k for k, _ in hits])}
+        return [
+            stored[key].model_copy(update={"distance": score})
+            for key, score in hits
+            if key in stored
+            and (filters is None or filters.matches(stored[key].metadata))
+        ][:top_k]
+
+    @abstractmethod
+    def _search_by_embedding(
+        self,
+        query_embedding: List[float],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        """Dense search of an embedded query, pre-filtered by metadata ``filters``"""
+
+    def _search_many_by_embedding(
+        self,
+        query_embeddings: List[List[float]],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        """Dense search of many embedded queries, override to search them in one call"""
+        return [
+            self._search_by_embedding(
+                embedding, collection_name, top_k, score_threshold, filters, **kwargs
+            )
+            for embedding in query_embeddings
+        ]
+
+    def _retrieve(
+        self,
+        query: str,
+        query_embedding: List[float],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        """
+        Dense search, fused with BM25 hits by reciprocal rank when ``hybrid``
+        (defaults to HYBRID_SEARCH) and the collection has a lexical index.
+        Fused contexts carry the RRF score as ``distance``. Both paths only
+        return contexts matching the metadata ``filters``.
+        """
+        return self._retrieve_many(
+            [query],
+            [query_embedding],
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+            **kwargs,
+        )[0]
+
+    def _retrieve_many(
+        self,
+        queries: List[str],
+        query_embeddings: List[List[float]],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        kb_settings = Settings.kb_settings
+        if filters is not None and filters.is_empty():
+            filters = None
+        if hybrid is None:
+            hybrid = kb_settings.HYBRID_SEARCH
+        if hybrid and len(self.lexical_index(collection_name)) == 0:
+            hybrid = False
+        candidates = max(top_k, kb_settings.HYBRID_CANDIDATES) if hybrid else top_k
+        with stage("ann"):
+            dense = self._dense_search(
+                query_embeddings,
+                collection_name,
+                candidates,
+                score_threshold,
+                filters,
+                **kwargs,
+            )
+        if not hybrid:
+            return dense
+        from rag.server.kb.lexical import reciprocal_rank_fusion
+
+        fused = []
+        for query, hits in zip(queries, dense):
+            with stage("lexical"):
+                lexical = self.lexical_search(
+                    query, collection_name, candidates, filters
+                )
+            fused.append(
+                reciprocal_rank_fusion([hits, lexical], kb_settings.RRF_K)[:top_k]
+            )
+        return fused
+
+    def _dense_search(
+        self,
+        query_embeddings: List[List[float]],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        start = time.perf_counter()
+        try:
+            if len(query_embeddings) == 1:
+                return [
+                    self._search_by_embedding(
+                        query_embeddings[0],
+                        collection_name,
+                        top_k,
+                        score_threshold,
+                        filters,
+                        **kwargs,
+                    )
+                ]
+            return self._search_many_by_embedding(
+                query_embeddings,
+                collection_name,
+                top_k,
+                score_threshold,
+                filters,
+                **kwargs,
+            )
+        finally:
+            VECTOR_SEARCH_LATENCY.labels(self.vs_type).observe(
+                time.perf_counter() - start
+            )
+
+    def search_many(
+        self,
+        queries: List[str],
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        """
+        Search many queries at once: they are embedded in batched requests and
+        searched by a single multi-vector call where the backend supports it.
+        Returns the results of each query in input order, queries which fail to
+        embed get an empty result.
+        """
+        embeddings = self.embed_queries(queries)
+        embedded = [i for i, embedding in enumerate(embeddings) if embedding is not None]
+        results: List[List[Context]] = [[] for _ in queries]
+        if not embedded:
+            return results
+        found = self._retrieve_many(
+            [queries[i] for i in embedded],
+            [embeddings[i] for i in embedded],
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+            **kwargs,
+        )
+        for i, contexts in zip(embedded, found):
+            results[i] = contexts
+        return results
+
+    async def asearch_many(
+        self,
+        queries: List[str],
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        return await asyncio.to_thread(
+            self.search_many,
+            queries,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+            **kwargs,
+        )
+
+    def add_doc(
+        self,
+        collection_name: str,
+        file: BinaryIO,
+        file_name: str,
+        chunk_size: int = Settings.kb_settings.CHUNK_SIZE,
+        chunk_overlap: int = Settings.kb_settings.OVERLAP_SIZE,
+    ) -> Optional[IngestStats]:
+        """Stream a document through parse -> chunk -> embed -> insert"""
+        from rag.server.kb.doc_loader import chunk_segments, load_document
+
+        contexts = chunk_segments(
+            load_document(file, file_name), chunk_size, chunk_overlap
+        )
+        return self.add_context(collection_name, contexts)
+
+    @abstractmethod
+    def delete_doc(self, collection_name: str, file_name: str):
+        """Delete all contexts of a document"""
 
     def update_doc(self):
         # TODO search context by doc metadata
@@ -55,8 +398,16 @@ class KBService(ABC):
         """List all collections in the knowledge base"""
 
     @abstractmethod
-    def add_context(self, collection_name: str, context: Context):
-        """Add context to kb collection"""
+    def add_context(
+        self,
+        collection_name: str,
+        context: Union[Context, Iterable[Context]],
+        **kwargs,
+    ) -> Optional[IngestStats]:
+        """
+        Add context to kb collection, kwargs such as on_progress / cancel are
+        passed to EmbeddingPipeline.run
+        """
 
     @abstractmethod
     def search(
@@ -69,6 +420,19 @@ class KBService(ABC):
     ) -> List[Context]:
         """Search for similar contexts in kb"""
 
+    async def asearch(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int = 10,
+        score_threshold: float = 0.3,
+        **kwargs,
+    ) -> List[Context]:
+        """Search without blocking the event loop, override for native async IO"""
+        return await asyncio.to_thread(
+            self.search, query, collection_name, top_k, score_threshold, **kwargs
+        )
+
     @abstractmethod
     def create_collection(self, collection_name: str, collection_info: str, **kwargs):
         pass
@@ -77,6 +441,13 @@ class KBService(ABC):
     def save_vector_store(self):
         """dump knowledge base to disk"""
 
+    def close(self):
+        """Release resources owned by this service"""
+
+    @classmethod
+    def close_shared(cls):
+        """Release resources shared by all services of this type"""
+
 
 class KBServiceFactory:
     @staticmethod
@@ -95,19 +466,21 @@ class KBServiceFactory:
             from rag.server.kb.milvus_kb_service import MilvusKBService
 
             return MilvusKBService(kb_name, kb_info, embed_model)
+        elif vector_store_type == SupportedVectorStoreTypes.FAISS:
+            from rag.server.kb.faiss_kb_service import FaissKBService
+
+            return FaissKBService(kb_name, kb_info, embed_model)
+        elif vector_store_type == SupportedVectorStoreTypes.NUMPY:
+            from rag.server.kb.numpy_kb_service import NumpyKBService
+
+            return NumpyKBService(kb_name, kb_info, embed_model)
         return None
 
     @staticmethod
     def get_kb_service_by_name(kb_name: str) -> KBService:
         # TODO: get kb info from db
         # dummy code, will fail on create_kb
-        vector_store_type = "milvus"
-        if isinstance(vector_store_type, str):
-            vector_store_type = getattr(
-                SupportedVectorStoreTypes, vector_store_type.upper()
-            )
-        if vector_store_type == SupportedVectorStoreTypes.MILVUS:
-            from rag.server.kb.milvus_kb_service import MilvusKBService
+        vector_store_type = Settings.kb_settings.DEFAULT_VS_TYPE
+        from rag.server.kb.kb_pool import kb_pool
 
-            # dummy code
-            return MilvusKBService(kb_name)
+        return kb_pool.get(kb_name, vector_store_type)
@@ -0,0 +1,178 @@
+import io
+import json
+from pathlib import Path
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Tuple
+
+from rag.server.models.kb_spec import Context, ContextMetadata
+
+# a segment is a piece of document text together with where it came from
+Segment = Tuple[str, ContextMetadata]
+
+TEXT_BLOCK_SIZE = 64 * 1024
+SPLIT_CHARS = "\n。！？；!?;."
+SUPPORTED_SUFFIXES = [".txt", ".md", ".markdown", ".jsonl", ".pdf"]
+
+
+def _text_stream(file: BinaryIO) -> io.TextIOWrapper:
+    return io.TextIOWrapper(file, encoding="utf-8", errors="replace")
+
+
+def iter_txt(file: BinaryIO, file_name: str) -> Iterator[Segment]:
+    metadata = ContextMetadata(file_name=file_name)
+    stream = _text_stream(file)
+    while block := stream.read(TEXT_BLOCK_SIZE):
+        yield block, metadata
+
+
+def iter_markdown(file: BinaryIO, file_name: str) -> Iterator[Segment]:
+    """Markdown headings become the title of the following text"""
+    metadata = ContextMetadata(file_name=file_name)
+    for line in _text_stream(file):
+        if line.startswith("#"):
+            title = line.lstrip("#").strip()
+            if title:
+                metadata = ContextMetadata(file_name=file_name, title=title)
+        yield line, metadata
+
+
+def iter_jsonl(file: BinaryIO, file_name: str) -> Iterator[Segment]:
+    """
+    Each line is either a Context ({"content": ..., "metadata": {...}}) or a
+    record of the data import format ({"full_text": ..., "series_name": ...})
+    """
+    for line in _text_stream(file):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if "content" in record:
+            metadata = ContextMetadata.model_validate(record.get("metadata") or {})
+            text = record["content"]
+        else:
+            metadata = ContextMetadata.model_validate(record)
+            text = record.get("full_text", "")
+        if metadata.file_name is None:
+            metadata.file_name = file_name
+        yield text, metadata
+
+
+def iter_pdf(file: BinaryIO, file_name: str) -> Iterator[Segment]:
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        raise ImportError("pypdf is required to parse PDF files: pip install pypdf")
+
+    reader = PdfReader(file)
+    for page_no, page in enumerate(reader.pages, start=1):
+        text = page.extract_text() or ""
+        yield text, ContextMetadata(
+            file_name=file_name, start_page=page_no, end_page=page_no
+        )
+
+
+def check_document_type(file_name: str) -> str:
+    suffix = Path(file_name).suffix.lower()
+    if suffix not in SUPPORTED_SUFFIXES:
+        raise ValueError(
+            f"Unsupported document type {suffix}, should be one of {SUPPORTED_SUFFIXES}"
+        )
+    return suffix
+
+
+def load_document(file: BinaryIO, file_name: str) -> Iterator[Segment]:
+    suffix = check_document_type(file_name)
+    if suffix == ".txt":
+        return iter_txt(file, file_name)
+    elif suffix in (".md", ".markdown"):
+        return iter_markdown(file, file_name)
+    elif suffix == ".jsonl":
+        return iter_jsonl(file, file_name)
+    else:
+        return iter_pdf(file, file_name)
+
+
+def _split_point(text: str, chunk_size: int, chunk_overlap: int) -> int:
+    """Prefer to end a chunk at a sentence or line break in its last quarter"""
+    lower = max(chunk_overlap + 1, chunk_size * 3 // 4)
+    for i in range(chunk_size - 1, lower - 1, -1):
+        if text[i] in SPLIT_CHARS:
+            return i + 1
+    return chunk_size
+
+
+def _group_key(metadata: ContextMetadata) -> tuple:
+    return metadata.series_name, metadata.file_name, metadata.title
+
+
+class _ChunkBuffer:
+    """Text waiting to be chunked, with the page each piece of it starts on"""
+
+    def __init__(self):
+        self.text = ""
+        # leading chars already emitted as the tail of the previous chunk
+        self.overlap = 0
+        self.pages: List[Tuple[int, Optional[int], Optional[int]]] = []
+
+    def append(self, text: str, metadata: ContextMetadata):
+        self.pages.append((len(self.text), metadata.start_page, metadata.end_page))
+        self.text += text
+
+    def page_range(self, end: int) -> Tuple[Optional[int], Optional[int]]:
+        pages = [p for p in self.pages if p[0] < end]
+        starts = [p[1] for p in pages if p[1] is not None]
+        ends = [p[2] for p in pages if p[2] is not None]
+        return (min(starts) if starts else None, max(ends) if ends else None)
+
+    def consume(self, end: int, keep: int):
+        """Drop text before ``end - keep``, the last ``keep`` chars are the overlap"""
+        cut = max(end - keep, 0)
+        kept = [(offset - cut, s, e) for offset, s, e in self.pages if offset >= cut]
+        if not kept or kept[0][0] > 0:
+            # the kept text starts inside an earlier piece, so it inherits its page
+            before = [p for p in self.pages if p[0] < cut]
+            if before:
+                kept.insert(0, (0, before[-1][1], before[-1][2]))
+        self.text = self.text[cut:]
+        self.pages = kept
+        self.overlap = end - cut
+
+
+def chunk_segments(
+    segments: Iterable[Segment], chunk_size: int, chunk_overlap: int
+) -> Iterator[Context]:
+    """
+    Sliding window chunker over a stream of segments.
+
+    Chunks never mix text with a different series / file / title, and their
+    start_page / end_page cover the pages of the text they contain. Only one
+    window of text is held in memory at a time.
+    """
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap should be smaller than chunk_size")
+    buffer, current = _ChunkBuffer(), None
+
+    def make_context(text: str, end: int) -> Context:
+        start_page, end_page = buffer.page_range(end)
+        metadata = current.model_copy(
+            update={"start_page": start_page, "end_page": end_page}
+        )
+        return Context(metadata=metadata, content=text)
+
+    def flush() -> Iterator[Context]:
+        text = buffer.text.strip()
+        if text and len(buffer.text) > buffer.overlap:
+            yield make_context(text, len(buffer.text))
+        buffer.__init__()
+
+    for text, metadata in segments:
+        if current is not None and _group_key(metadata) != _group_key(current):
+            yield from flush()
+        current = metadata
+        buffer.append(text, metadata)
+        while len(buffer.text) >= chunk_size:
+            end = _split_point(buffer.text, chunk_size, chunk_overlap)
+            chunk = buffer.text[:end].strip()
+            if chunk:
+                yield make_context(chunk, end)
+            buffer.consume(end, chunk_overlap)
+    if current is not None:
+        yield from flush()
@@ -0,0 +1,528 @@
+import asyncio
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from rag.server.kb.base import KBService, SupportedVectorStoreTypes
+from rag.server.kb.ingest import EmbeddingPipeline
+from rag.server.models.kb_spec import Context, ContextFilter, IngestStats
+from rag.settings import Settings
+
+try:
+    import faiss
+except ImportError:
+    raise ImportError("faiss is required by the faiss vector store: pip install faiss-cpu")
+
+INDEX_FILE = "index.faiss"
+LOG_FILE = "vectors.log"
+STORE_FILE = "store.sqlite3"
+INFO_FILE = "info.json"
+STRING_FIELDS = ("series_name", "file_name", "title")
+
+
+def _filter_sql(filters: ContextFilter) -> Tuple[str, List]:
+    """WHERE clause over the sidecar metadata, served by its json_extract indexes"""
+    clauses, params = [], []
+    for field in STRING_FIELDS:
+        allowed = getattr(filters, field)
+        if allowed is not None:
+            placeholders = ",".join("?" * len(allowed))
+            clauses.append(f"json_extract(metadata, '$.{field}') IN ({placeholders})")
+            params.extend(allowed)
+    if filters.start_page is not None:
+        clauses.append("json_extract(metadata, '$.end_page') >= ?")
+        params.append(filters.start_page)
+    if filters.end_page is not None:
+        clauses.append("json_extract(metadata, '$.start_page') <= ?")
+        params.append(filters.end_page)
+    return " AND ".join(clauses) or "1", params
+
+
+class _FaissCollection:
+    """
+    One collection on disk: the faiss index, a sqlite sidecar holding content and
+    metadata by id, and ``info.json`` describing how the index was built.
+    Vectors are L2-normalized so inner product equals cosine similarity.
+
+    ``index.faiss`` is a snapshot, vectors added since are appended to
+    ``vectors.log`` and replayed on load. The snapshot is rewritten once the
+    changes since it outgrow a fraction of the index, see ``save``.
+    """
+
+    def __init__(self, path: Path, info: Dict):
+        self.path = path
+        self.info = info
+        self.lock = threading.RLock()
+        # vectors added or deleted since the snapshot
+        self.pending = 0
+        self.store = sqlite3.connect(str(path / STORE_FILE), check_same_thread=False)
+        self.store.execute(
+            "CREATE TABLE IF NOT EXISTS context ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, content TEXT, metadata TEXT)"
+        )
+        for field in STRING_FIELDS:
+            self.store.execute(
+                f"CREATE INDEX IF NOT EXISTS context_{field} "
+                f"ON context (json_extract(metadata, '$.{field}'))"
+            )
+        self.store.commit()
+        self.live = self.store.execute("SELECT COUNT(*) FROM context").fetchone()[0]
+        self.mmapped = False
+        index_file = path / INDEX_FILE
+        if index_file.is_file():
+            flags = faiss.IO_FLAG_MMAP if Settings.kb_settings.FAISS_MMAP else 0
+            self.index = faiss.read_index(str(index_file), flags)
+            self.mmapped = bool(flags)
+        else:
+            self.index = self._build_index(0)
+        self._set_search_params()
+        if (path / LOG_FILE).is_file():
+            self._replay()
+
+    @property
+    def inner_index(self) -> "faiss.Index":
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexIDMap):
+            return faiss.downcast_index(index.index)
+        return index
+
+    @property
+    def is_staging(self) -> bool:
+        """
+        An ivf collection is staged in an exact flat index until it has enough
+        vectors to train its lists on, see ``_train``
+        """
+        return self.info["index_type"] == "ivf" and not isinstance(
+            self.inner_index, faiss.IndexIVF
+        )
+
+    @property
+    def log_dtype(self) -> np.dtype:
+        return np.dtype([("id", "<i8"), ("vector", "<f4", (self.info["dim"],))])
+
+    def _build_index(self, n_train: int) -> "faiss.Index":
+        dim, index_type = self.info["dim"], self.info["index_type"]
+        kb_settings = Settings.kb_settings
+        if index_type == "flat":
+            index = faiss.IndexFlatIP(dim)
+        elif index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(dim, kb_settings.FAISS_HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        elif index_type == "ivf" and n_train == 0:
+            index = faiss.IndexFlatIP(dim)
+        elif index_type == "ivf":
+            # keep ~39 training points per list, as faiss recommends
+            nlist = max(1, min(kb_settings.FAISS_IVF_NLIST, n_train // 39))
+            # ivf keeps ids itself, an id map over it would go stale on remove_ids
+            return faiss.IndexIVFFlat(
+                faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT
+            )
+        else:
+            raise ValueError(f"Unsupported faiss index type {index_type}")
+        return faiss.IndexIDMap2(index)
+
+    def _set_search_params(self):
+        inner = self.inner_index
+        if isinstance(inner, faiss.IndexHNSW):
+            inner.hnsw.efSearch = Settings.kb_settings.FAISS_HNSW_EF_SEARCH
+        elif isinstance(inner, faiss.IndexIVF):
+            inner.nprobe = Settings.kb_settings.FAISS_IVF_NPROBE
+
+    def _writable_index(self) -> "faiss.Index":
+        if self.mmapped:
+            # an mmapped index is read-only, it is fully loaded on the first write
+            self.index = faiss.read_index(str(self.path / INDEX_FILE))
+            self.mmapped = False
+            self._set_search_params()
+        return self.index
+
+    def _max_id(self) -> int:
+        """Largest id of the index, ids only grow so later ones are not in it"""
+        index = faiss.downcast_index(self.index)
+        if isinstance(index, faiss.IndexIDMap):
+            ids = faiss.vector_to_array(index.id_map)
+            return int(ids.max()) if len(ids) else 0
+        ivf = faiss.extract_index_ivf(self.index)
+        invlists = ivf.invlists
+        return max(
+            (
+                int(faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).max())
+                for i in range(ivf.nlist)
+                if invlists.list_size(i)
+            ),
+            default=0,
+        )
+
+    def _replay(self):
+        """Add the vectors logged after the snapshot, then take a new snapshot"""
+        data = (self.path / LOG_FILE).read_bytes()
+        # a record torn by a crash belongs to a row whose insert was rolled back
+        records = np.frombuffer(
+            data[: len(data) - len(data) % self.log_dtype.itemsize], self.log_dtype
+        )
+        # a crash between writing the snapshot and removing the log leaves
+        # records already in the snapshot
+        last = self._max_id()
+        alive = [
+            row[0]
+            for row in self.store.execute("SELECT id FROM context WHERE id > ?", (last,))
+        ]
+        records = records[np.isin(records["id"], alive)]
+        if len(records):
+            self._writable_index().add_with_ids(
+                np.ascontiguousarray(records["vector"]), records["id"].copy()
+            )
+        self._write()
+
+    def add(self, rows: List[Dict]) -> List[int]:
+        vectors = np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        with self.lock:
+            cursor = self.store.cursor()
+            try:
+                ids = []
+                for row in rows:
+                    cursor.execute(
+                        "INSERT INTO context (content, metadata) VALUES (?, ?)",
+                        (row["content"], json.dumps(row["metadata"], ensure_ascii=False)),
+                    )
+                    ids.append(cursor.lastrowid)
+                ids = np.asarray(ids, dtype=np.int64)
+                # logged before the commit, so a committed row has its vector on disk
+                records = np.empty(len(ids), dtype=self.log_dtype)
+                records["id"], records["vector"] = ids, vectors
+                with open(self.path / LOG_FILE, "ab") as fp:
+                    fp.write(records.tobytes())
+                self._writable_index().add_with_ids(vectors, ids)
+            except Exception:
+                self.store.rollback()
+                raise
+            self.store.commit()
+            self.live += len(ids)
+            self.pending += len(ids)
+            if (
+                self.is_staging
+                and self.index.ntotal >= Settings.kb_settings.FAISS_IVF_NLIST * 39
+            ):
+                self._train()
+        return ids.tolist()
+
+    def _train(self):
+        """Replace the staging flat index by an ivf index trained on its vectors"""
+        staging = faiss.downcast_index(self._writable_index())
+        ids = faiss.vector_to_array(staging.id_map)
+        vectors = staging.index.reconstruct_n(0, staging.ntotal)
+        # skip the vectors deleted from the sidecar only
+        alive = set(row[0] for row in self.store.execute("SELECT id FROM context"))
+        mask = np.asarray([i in alive for i in ids.tolist()], dtype=bool)
+        if not mask.any():
+            return
+        index = self._build_index(int(mask.sum()))
+        index.train(vectors[mask])
+        index.add_with_ids(vectors[mask], ids[mask])
+        self.index = index
+        self._set_search_params()
+        self._write()
+
+    def _search_params(self, ids: List[int]) -> "faiss.SearchParameters":
+        """Restrict a search to ``ids``, keeping the tuned parameters of the index"""
+        selector = faiss.IDSelectorBatch(np.asarray(ids, dtype=np.int64))
+        inner = self.inner_index
+        if isinstance(inner, faiss.IndexHNSW):
+            return faiss.SearchParametersHNSW(
+                sel=selector, efSearch=Settings.kb_settings.FAISS_HNSW_EF_SEARCH
+            )
+        if isinstance(inner, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(
+                sel=selector, nprobe=Settings.kb_settings.FAISS_IVF_NPROBE
+            )
+        return faiss.SearchParameters(sel=selector)
+
+    def search(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+    ) -> List[List[Context]]:
+        """
+        Search a batch of queries in one faiss call, ``filters`` select the
+        matching ids in the sidecar first and restrict the search to them
+        """
+        vectors = np.asarray(query_embeddings, dtype=np.float32)
+        faiss.normalize_L2(vectors)
+        with self.lock:
+            if self.index.ntotal == 0:
+                return [[] for _ in query_embeddings]
+            if filters is None:
+                # vectors deleted from the sidecar only are skipped, so fetch more
+                k = min(self.index.ntotal, top_k + self.index.ntotal - self.live)
+                scores, ids = self.index.search(vectors, k)
+            else:
+                where, params = _filter_sql(filters)
+                selected = [
+                    row[0]
+                    for row in self.store.execute(
+                        f"SELECT id FROM context WHERE {where}", params
+                    )
+                ]
+                if not selected:
+                    return [[] for _ in query_embeddings]
+                k = min(len(selected), top_k)
+                scores, ids = self.index.search(
+                    vectors, k, params=self._search_params(selected)
+                )
+        hits = [
+            [
+                (int(i), float(s))
+                for i, s in zip(row_ids, row_scores)
+                if i >= 0 and s >= score_threshold
+            ]
+            for row_ids, row_scores in zip(ids, scores)
+        ]
+        hit_ids = list({i for row in hits for i, _ in row})
+        stored = {c.id: c for c in self.get(hit_ids)}
+        # ids missing from the sidecar were deleted from an index without remove_ids
+        return [
+            [
+                stored[i].model_copy(update={"distance": score})
+                for i, score in row
+                if i in stored
+            ][:top_k]
+            for row in hits
+        ]
+
+    def get(self, ids: List[int]) -> List[Context]:
+        if not ids:
+            return []
+        placeholders = ",".join("?" * len(ids))
+        with self.lock:
+            rows = self.store.execute(
+                f"SELECT id, content, metadata FROM context WHERE id IN ({placeholders})",
+                list(ids),
+            ).fetchall()
+        return [
+            Context(id=i, content=content, metadata=json.loads(metadata))
+            for i, content, metadata in rows
+        ]
+
+    def delete_where(self, where: str, params: Iterable):
+        with self.lock:
+            ids = [
+                row[0]
+                for row in self.store.execute(
+                    f"SELECT id FROM context WHERE {where}", list(params)
+                )
+            ]
+            if not ids:
+                return
+            self.store.executemany("DELETE FROM context WHERE id = ?", [(i,) for i in ids])
+            self.store.commit()
+            self.live -= len(ids)
+            try:
+                self._writable_index().remove_ids(np.asarray(ids, dtype=np.int64))
+            except RuntimeError:
+                # hnsw can not remove vectors, the sidecar delete hides them from search
+                pass
+            self.pending += len(ids)
+
+    def _write(self):
+        tmp = self.path / (INDEX_FILE + ".tmp")
+        faiss.write_index(self.index, str(tmp))
+        os.replace(tmp, self.path / INDEX_FILE)
+        # the snapshot now holds everything the log recorded
+        (self.path / LOG_FILE).unlink(missing_ok=True)
+        self.pending = 0
+
+    def save(self, compact_ratio: float = 0.1):
+        """
+        Snapshot the index once the changes since the last snapshot outgrow
+        ``compact_ratio`` of it, so bulk ingestion rewrites it a logarithmic
+        number of times. Added vectors are durable in the log meanwhile,
+        deleted ones are hidden by the sidecar.
+        """
+        with self.lock:
+            if self.pending and self.pending >= compact_ratio * self.index.ntotal:
+                self._write()
+
+    def close(self):
+        self.save(0)
+        self.store.close()
+
+
+class FaissKBService(KBService):
+    """
+    Embedded vector store running in-process, collections are persisted under
+    ``KB_ROOT_PATH/<kb_name>/faiss/<collection_name>``.
+    """
+
+    vs_type = SupportedVectorStoreTypes.FAISS
+
+    def __init__(
+        self,
+        kb_name: str = "default",
+        kb_info: str = None,
+        embed_model: str = Settings.model_settings.DEFAULT_EMBEDDING_MODEL,
+    ):
+        self.embed_dim = self.init_embedding(embed_model)
+        if kb_info is None or len(kb_info.strip()) == 0:
+            kb_info = f"Faiss KB Service, based on {embed_model}, dim {self.embed_dim}"
+        super().__init__(kb_name, kb_info, embed_model)
+        self.root = Path(Settings.basic_settings.KB_ROOT_PATH) / kb_name / "faiss"
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._collections: Dict[str, _FaissCollection] = {}
+        self._lock = threading.Lock()
+
+    def _collection(self, collection_name: str) -> _FaissCollection:
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            if collection is None:
+                path = self.root / collection_name
+                if not (path / INFO_FILE).is_file():
+                    raise ValueError(f"Collection {collection_name} not exist")
+                info = json.loads((path / INFO_FILE).read_text(encoding="utf-8"))
+                collection = _FaissCollection(path, info)
+                self._collections[collection_name] = collection
+            return collection
+
+    def create_collection(
+        self,
+        collection_name: str,
+        collection_info: str = "",
+        index_type: str = None,
+        **kwargs,
+    ):
+        path = self.root / collection_name
+        path.mkdir(parents=True, exist_ok=True)
+        info = {
+            "description": collection_info,
+            "dim": self.embed_dim,
+            "embed_model": self.embed_model,
+            "index_type": index_type or Settings.kb_settings.FAISS_INDEX_TYPE,
+        }
+        (path / INFO_FILE).write_text(json.dumps(info, ensure_ascii=False), "utf-8")
+        return self._collection(collection_name).info
+
+    def drop_collection(self, collection_name: str):
+        with self._lock:
+            collection = self._collections.pop(collection_name, None)
+        if collection is not None:
+            collection.store.close()
+        shutil.rmtree(self.root / collection_name, ignore_errors=True)
+        self.drop_lexical_index(collection_name)
+
+    def list_collection(self):
+        return sorted(p.parent.name for p in self.root.glob(f"*/{INFO_FILE}"))
+
+    def add_context(
+        self,
+        collection_name: str,
+        context: Union[Context, Iterable[Context]],
+        **kwargs,
+    ) -> IngestStats:
+        if isinstance(context, Context):
+            context = [context]
+        collection = self._collection(collection_name)
+        insert = self.with_lexical_index(collection_name, collection.add)
+        pipeline = EmbeddingPipeline(self.embed_func, self.context_window)
+        stats = pipeline.run(context, insert, **kwargs)
+        collection.save()
+        self.lexical_index(collection_name).save()
+        return stats
+
+    def search(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        query_embedding = self.embed_query(query)
+        return self._retrieve(
+            query,
+            query_embedding,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+        )
+
+    async def asearch(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        query_embedding = await self.aembed_query(query)
+        # the search waits on the collection lock, which ingestion can hold for
+        # seconds, so it is offloaded to keep the event loop serving requests
+        return await asyncio.to_thread(
+            self._retrieve,
+            query,
+            query_embedding,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+        )
+
+    def _search_by_embedding(
+        self,
+        query_embedding: List[float],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        return self._collection(collection_name).search(
+            [query_embedding], top_k, score_threshold, filters
+        )[0]
+
+    def _search_many_by_embedding(
+        self,
+        query_embeddings: List[List[float]],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        return self._collection(collection_name).search(
+            query_embeddings, top_k, score_threshold, filters
+        )
+
+    def get_by_ids(self, collection_name: str, ids: List[int]) -> List[Context]:
+        return self._collection(collection_name).get(ids)
+
+    def delete_doc(self, collection_name: str, file_name: str):
+        self._collection(collection_name).delete_where(
+            "json_extract(metadata, '$.file_name') = ?", [file_name]
+        )
+        self.lexical_index(collection_name).delete_file(file_name)
+
+    def save_vector_store(self):
+        with self._lock:
+            collections = list(self._collections.values())
+        for collection in collections:
+            collection.save(0)
+
+    def close(self):
+        with self._lock:
+            collections = list(self._collections.values())
+            self._collections.clear()
+        for collection in collections:
+            collection.close()
@@ -0,0 +1,224 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from rag.server.llm.client import CircuitOpenError
+from rag.server.models.kb_spec import Context, IngestStats
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+EmbedFunc = Callable[[List[str]], Optional[List[List[float]]]]
+InsertFunc = Callable[[List[Dict[str, Any]]], Any]
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count, CJK characters are about one token each, others about 4 per token"""
+    cjk = sum(1 for ch in text if "㐀" <= ch <= "鿿")
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_batches(
+    contexts: Iterable[Context],
+    batch_size: int,
+    batch_tokens: int,
+    context_window: int,
+) -> Iterator[List[Context]]:
+    """Group contexts into sub-batches bounded by item count and estimated tokens"""
+    batch, tokens = [], 0
+    for context in contexts:
+        n = estimate_tokens(context.content[:context_window])
+        if batch and (len(batch) >= batch_size or tokens + n > batch_tokens):
+            yield batch
+            batch, tokens = [], 0
+        batch.append(context)
+        tokens += n
+    if batch:
+        yield batch
+
+
+class EmbeddingPipeline:
+    """
+    Embed and insert contexts in provider-sized sub-batches.
+
+    Sub-batches are embedded concurrently by a bounded thread pool while the
+    calling thread inserts finished batches, so the vector store insert of one
+    batch overlaps with the embedding requests of the next ones. Only a few
+    batches are in flight at a time, which keeps memory bounded for lazy inputs.
+    A failing batch is retried with exponential backoff and then split in
+    halves, so a single oversized or rejected item does not fail its neighbours.
+    A batch sends at most EMBED_MAX_ATTEMPTS requests, and after
+    EMBED_MAX_CONSECUTIVE_FAILURES failed requests in a row batches are no
+    longer retried nor split until a request succeeds again.
+    """
+
+    def __init__(
+        self,
+        embed_func: EmbedFunc,
+        context_window: int = Settings.model_settings.DEFAULT_EMBEDDING_CONTEXT_WINDOW,
+        batch_size: int = None,
+        batch_tokens: int = None,
+        concurrency: int = None,
+        max_retries: int = None,
+    ):
+        kb_settings = Settings.kb_settings
+        self.embed_func = embed_func
+        self.context_window = context_window
+        self.batch_size = batch_size or kb_settings.EMBED_BATCH_SIZE
+        self.batch_tokens = batch_tokens or kb_settings.EMBED_BATCH_TOKENS
+        self.concurrency = concurrency or kb_settings.EMBED_CONCURRENCY
+        self.max_retries = (
+            kb_settings.EMBED_MAX_RETRIES if max_retries is None else max_retries
+        )
+        self.max_attempts = kb_settings.EMBED_MAX_ATTEMPTS
+        self.max_consecutive_failures = kb_settings.EMBED_MAX_CONSECUTIVE_FAILURES
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def _record(self, ok: bool) -> bool:
+        """Count consecutive failed requests, True once the platform looks down"""
+        with self._lock:
+            self._failures = 0 if ok else self._failures + 1
+            return self._failing()
+
+    def _failing(self) -> bool:
+        return self._failures >= self.max_consecutive_failures
+
+    def _embed_with_retry(
+        self, content: List[str], retries: int, budget: List[int]
+    ) -> Optional[List[List[float]]]:
+        """
+        Embed with up to ``retries`` retries, each request spends one of the
+        attempts left in ``budget``. Once the platform looks down a single
+        failed attempt gives up, so an outage costs one request per batch.
+        """
+        for attempt in range(retries + 1):
+            if budget[0] <= 0:
+                return None
+            budget[0] -= 1
+            try:
+                embedding = self.embed_func(content)
+            except CircuitOpenError:
+                # the platform is down, fail the batch instead of splitting it
+                raise
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: Fail to embed batch: {e}")
+                embedding = None
+            if embedding is not None and len(embedding) == len(content):
+                self._record(True)
+                return embedding
+            if self._record(False):
+                return None
+            if attempt < retries:
+                delay = min(2**attempt, 30) * (0.5 + random.random())
+                logger.warning(
+                    f"Embedding batch of {len(content)} failed, retry in {delay:.1f}s"
+                )
+                time.sleep(delay)
+        return None
+
+    def _embed_batch(
+        self, batch: List[Context], budget: List[int] = None
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Embed a batch into insertable rows aligned with it, items which keep
+        failing are None. Only the submitted batch is retried, its halves are
+        tried once each.
+        """
+        retries = self.max_retries if budget is None else 0
+        if budget is None:
+            budget = [self.max_attempts]
+        content = [c.content[: self.context_window] for c in batch]
+        embedding = self._embed_with_retry(content, retries, budget)
+        if embedding is None:
+            if len(batch) == 1:
+                logger.error(f"Fail to embed context: {batch[0].content[:50]}")
+                return [None]
+            if budget[0] <= 0 or self._failing():
+                logger.error(f"Embedding keeps failing, drop batch of {len(batch)}")
+                return [None] * len(batch)
+            mid = len(batch) // 2
+            return self._embed_batch(batch[:mid], budget) + self._embed_batch(
+                batch[mid:], budget
+            )
+        rows = []
+        for context, embed in zip(batch, embedding):
+            row = context.model_dump()
+            row["embedding"] = embed
+            rows.append(row)
+        return rows
+
+    def run(
+        self,
+        contexts: Iterable[Context],
+        insert_func: InsertFunc,
+        on_progress: Callable[[IngestStats], None] = None,
+        cancel: threading.Event = None,
+    ) -> IngestStats:
+        """
+        Batches are inserted in input order, so ``inserted + failed`` is always
+        the length of a fully processed prefix of ``contexts``, which is what
+        resumable callers checkpoint, and ``failed_indexes`` are the positions
+        of the failed contexts in ``contexts``. ``cancel`` stops submitting new batches,
+        the ones already in flight are still inserted.
+        """
+        stats = IngestStats()
+        start = time.perf_counter()
+        batches = split_batches(
+            contexts, self.batch_size, self.batch_tokens, self.context_window
+        )
+        max_in_flight = self.concurrency * 2
+        with ThreadPoolExecutor(
+            max_workers=self.concurrency, thread_name_prefix="embed"
+        ) as executor:
+            in_flight: Deque[Tuple[Future, int]] = deque()
+            for batch in batches:
+                if cancel is not None and cancel.is_set():
+                    break
+                stats.batches += 1
+                in_flight.append((executor.submit(self._embed_batch, batch), len(batch)))
+                # insert the oldest batch while the newer ones keep embedding
+                if len(in_flight) >= max_in_flight:
+                    self._insert(*in_flight.popleft(), insert_func, stats, on_progress)
+            while in_flight:
+                self._insert(*in_flight.popleft(), insert_func, stats, on_progress)
+        stats.elapsed = time.perf_counter() - start
+        if stats.elapsed > 0:
+            stats.docs_per_sec = stats.inserted / stats.elapsed
+        logger.info(
+            f"Ingested {stats.inserted} contexts in {stats.batches} batches, "
+            f"{stats.failed} failed, {stats.docs_per_sec:.1f} docs/s"
+        )
+        return stats
+
+    @staticmethod
+    def _insert(
+        future: Future,
+        size: int,
+        insert_func: InsertFunc,
+        stats: IngestStats,
+        on_progress: Callable[[IngestStats], None] = None,
+    ):
+        # batches are inserted in input order, so this one starts after the prefix
+        offset = stats.inserted + stats.failed
+        try:
+            embedded = future.result()
+            rows = [row for row in embedded if row is not None]
+            failed = [i for i, row in enumerate(embedded) if row is None]
+            stats.embedded += len(rows)
+            if rows:
+                insert_start = time.perf_counter()
+                insert_func(rows)
+                stats.insert_seconds += time.perf_counter() - insert_start
+        except Exception as e:
+            logger.error(f"{e.__class__.__name__}: Fail to insert batch: {e}")
+            rows, failed = [], list(range(size))
+        stats.inserted += len(rows)
+        stats.failed += len(failed)
+        stats.failed_indexes.extend(offset + i for i in failed)
+        if on_progress is not None:
+            on_progress(stats)
@@ -0,0 +1,260 @@
+import itertools
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional
+
+from rag.server.chat.answer_cache import answer_cache
+from rag.server.kb.base import KBServiceFactory
+from rag.server.kb.doc_loader import chunk_segments, load_document
+from rag.server.models.kb_spec import Context, IngestJob, IngestStats
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+JOB_FILE = "job.json"
+INPUT_DIR = "input"
+CONTEXT_FILE = "contexts.jsonl"
+
+
+class IngestJobManager:
+    """
+    Local background queue for ingestion jobs, no external broker required.
+
+    Every job lives in its own directory under ``DATA_PATH/jobs`` with its input
+    (the uploaded file or the contexts as jsonl) and a ``job.json`` progress
+    checkpoint. The checkpoint records how many contexts of the input are fully
+    processed, so jobs interrupted by a restart resume after that prefix.
+    """
+
+    def __init__(self, root: Path = None, workers: int = None):
+        self._root = root
+        self._workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._jobs: Dict[str, IngestJob] = {}
+        self._stop_events: Dict[str, threading.Event] = {}
+        self._cancelled: set = set()
+        self._lock = threading.RLock()
+
+    @property
+    def root(self) -> Path:
+        if self._root is None:
+            self._root = Settings.basic_settings.DATA_PATH / "jobs"
+        return self._root
+
+    def _job_dir(self, job_id: str) -> Path:
+        return self.root / job_id
+
+    def _save(self, job: IngestJob):
+        job.updated_at = time.time()
+        path = self._job_dir(job.id) / JOB_FILE
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text(job.model_dump_json(), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def start(self):
+        """Start the workers and resume the jobs left unfinished by the last run"""
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._workers or Settings.kb_settings.INGEST_JOB_WORKERS,
+            thread_name_prefix="ingest-job",
+        )
+        for job_file in sorted(self.root.glob(f"*/{JOB_FILE}")):
+            try:
+                job = IngestJob.model_validate_json(job_file.read_text("utf-8"))
+            except Exception as e:
+                logger.error(f"{e.__class__.__name__}: Fail to load job {job_file}: {e}")
+                continue
+            with self._lock:
+                self._jobs[job.id] = job
+            if job.status in ("queued", "running"):
+                logger.info(f"Resume ingestion job {job.id} from {job.processed}")
+                job.status = "queued"
+                self._enqueue(job)
+
+    def shutdown(self):
+        """Stop running jobs at a batch boundary, they are resumed on next start"""
+        with self._lock:
+            for event in self._stop_events.values():
+                event.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def _create(self, kind: str, kb_name: str, collection_name: str, **params) -> IngestJob:
+        now = time.time()
+        job = IngestJob(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            kb_name=kb_name,
+            collection_name=collection_name,
+            params=params,
+            created_at=now,
+            updated_at=now,
+        )
+        (self._job_dir(job.id) / INPUT_DIR).mkdir(parents=True, exist_ok=True)
+        return job
+
+    def _enqueue(self, job: IngestJob):
+        with self._lock:
+            self._jobs[job.id] = job
+            self._stop_events[job.id] = threading.Event()
+            self._save(job)
+        self._executor.submit(self._run, job.id)
+
+    def submit_upload(
+        self,
+        kb_name: str,
+        collection_name: str,
+        file: BinaryIO,
+        file_name: str,
+        chunk_size: int,
+        chunk_overlap: int,
+        override: bool = False,
+    ) -> IngestJob:
+        job = self._create(
+            "upload_docs",
+            kb_name,
+            collection_name,
+            file_name=file_name,
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            override=override,
+        )
+        input_file = self._job_dir(job.id) / INPUT_DIR / Path(file_name).name
+        with open(input_file, "wb") as fp:
+            shutil.copyfileobj(file, fp)
+        # the total is estimated by the job, parsing here would block the request
+        self._enqueue(job)
+        return job
+
+    def submit_contexts(
+        self, kb_name: str, collection_name: str, contexts: List[Context]
+    ) -> IngestJob:
+        job = self._create("add_context", kb_name, collection_name)
+        with open(self._job_dir(job.id) / INPUT_DIR / CONTEXT_FILE, "w", encoding="utf-8") as fp:
+            for context in contexts:
+                fp.write(context.model_dump_json() + "\n")
+        job.total = len(contexts)
+        self._enqueue(job)
+        return job
+
+    @staticmethod
+    def _estimate_chunks(
+        path: Path, file_name: str, chunk_size: int, chunk_overlap: int
+    ) -> Optional[int]:
+        """Estimate chunks from the text length, PDF pages are too costly to pre-parse"""
+        if path.suffix.lower() == ".pdf":
+            return None
+        with open(path, "rb") as fp:
+            chars = sum(len(text) for text, _ in load_document(fp, file_name))
+        return max(1, -(-chars // max(chunk_size - chunk_overlap, 1)))
+
+    def _iter_input(self, job: IngestJob) -> Iterator[Context]:
+        input_dir = self._job_dir(job.id) / INPUT_DIR
+        if job.kind == "add_context":
+            with open(input_dir / CONTEXT_FILE, encoding="utf-8") as fp:
+                for line in fp:
+                    yield Context.model_validate_json(line)
+        else:
+            file_name = job.params["file_name"]
+            with open(input_dir / Path(file_name).name, "rb") as fp:
+                yield from chunk_segments(
+                    load_document(fp, file_name),
+                    job.params["chunk_size"],
+                    job.params["chunk_overlap"],
+                )
+
+    def _run(self, job_id: str):
+        with self._lock:
+            job = self._jobs[job_id]
+            stop = self._stop_events[job_id]
+            if job.status != "queued" or stop.is_set():
+                return
+            job.status = "running"
+            self._save(job)
+        base = job.model_copy()
+
+        def on_progress(stats: IngestStats):
+            with self._lock:
+                job.processed = base.processed + stats.inserted + stats.failed
+                job.embedded = base.embedded + stats.embedded
+                job.inserted = base.inserted + stats.inserted
+                job.failed = base.failed + stats.failed
+                run_elapsed = time.perf_counter() - run_start
+                job.elapsed = base.elapsed + run_elapsed
+                job.docs_per_sec = (job.processed - base.processed) / run_elapsed
+                if job.total is not None and job.docs_per_sec > 0:
+                    job.eta = max(job.total - job.processed, 0) / job.docs_per_sec
+                self._save(job)
+
+        run_start = time.perf_counter()
+        try:
+            if job.kind == "upload_docs" and job.total is None:
+                file_name = job.params["file_name"]
+                total = self._estimate_chunks(
+                    self._job_dir(job.id) / INPUT_DIR / Path(file_name).name,
+                    file_name,
+                    job.params["chunk_size"],
+                    job.params["chunk_overlap"],
+                )
+                with self._lock:
+                    job.total = total
+                    self._save(job)
+            kb = KBServiceFactory.get_kb_service_by_name(job.kb_name)
+            if job.params.get("override") and job.processed == 0:
+                kb.delete_doc(job.collection_name, job.params["file_name"])
+            contexts = itertools.islice(self._iter_input(job), job.processed, None)
+            kb.add_context(
+                job.collection_name, contexts, on_progress=on_progress, cancel=stop
+            )
+            answer_cache.invalidate(job.kb_name, job.collection_name)
+        except Exception as e:
+            msg = f"Fail to run ingestion job {job.id}: {e}"
+            logger.error(f"{e.__class__.__name__}: {msg}")
+            with self._lock:
+                job.status, job.error = "failed", msg
+                self._save(job)
+            return
+        with self._lock:
+            if job_id in self._cancelled:
+                job.status = "cancelled"
+            elif stop.is_set():
+                # interrupted by shutdown, resumed from the checkpoint on next start
+                job.status = "queued"
+            else:
+                job.status, job.eta = "succeeded", 0.0
+            if job.status != "queued":
+                shutil.rmtree(self._job_dir(job.id) / INPUT_DIR, ignore_errors=True)
+            self._save(job)
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job is not None else None
+
+    def list(self) -> List[IngestJob]:
+        with self._lock:
+            return [job.model_copy() for job in self._jobs.values()]
+
+    def cancel(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status in ("queued", "running"):
+                self._cancelled.add(job_id)
+                self._stop_events[job_id].set()
+                if job.status == "queued":
+                    job.status = "cancelled"
+                    shutil.rmtree(self._job_dir(job.id) / INPUT_DIR, ignore_errors=True)
+                    self._save(job)
+            return job.model_copy()
+
+
+job_manager = IngestJobManager()
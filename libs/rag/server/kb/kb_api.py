@@ -1,13 +1,20 @@
-from typing import List, Union
+from typing import List, Literal, Optional, Union
 
 from fastapi import Body, File, Form, UploadFile
 from rag.server.api_server.utils import (
     filter_collection_with_kb_name,
     map_collection_name,
 )
+from rag.server.chat.answer_cache import answer_cache
+from rag.server.chat.rerank import reranker
 from rag.server.kb.base import KBServiceFactory
+from rag.server.kb.doc_loader import check_document_type
+from rag.server.kb.jobs import job_manager
+from rag.server.kb.kb_pool import kb_pool
+from rag.server.llm.embed_cache import embed_cache
 from rag.server.models.api_spec import BaseResponse, KBRequest, ListResponse
-from rag.server.models.kb_spec import Context
+from rag.server.models.kb_spec import Context, ContextFilter
+from rag.server.timing import start_request
 from rag.settings import Settings
 from rag.utils import build_logger
 
@@ -23,6 +30,12 @@ __all__ = [
     "upload_docs",
     "add_context",
     "search",
+    "batch_search",
+    "pool_stats",
+    "cache_stats",
+    "list_jobs",
+    "get_job",
+    "cancel_job",
 ]
 
 
@@ -32,7 +45,7 @@ def create_kb(
     vector_store_type: str = Body(
         Settings.kb_settings.DEFAULT_VS_TYPE,
         description="Vector store type",
-        examples=["faiss", "milvus"],
+        examples=["faiss", "milvus", "numpy"],
     ),
     embed_model: str = Body("BAAI/bge-m3"),
 ) -> BaseResponse:
@@ -68,6 +81,7 @@ def drop_kb(kb_name: str = Body(example="default")) -> BaseResponse:
         kb_collections = filter_collection_with_kb_name(kb_name, collections)
         for c in kb_collections:
             kb.drop_collection(c)
+        answer_cache.invalidate(kb_name)
         # TODO: remove collections from db
     except Exception as e:
         msg = f"Fail to drop knowledge base: {e}"
@@ -84,6 +98,13 @@ def create_collection(
     kb_name: str = Body(description="Knowledge base name", example="default"),
     collection_name: str = Body(description="Collection name", example="history_rag"),
     collection_info: str = Body("", description="Description to collection"),
+    vector_precision: Optional[
+        Literal["float32", "float16", "bfloat16", "int8", "binary"]
+    ] = Body(
+        None,
+        description="Precision of the stored embeddings of a milvus collection, "
+        "defaults to MILVUS_VECTOR_PRECISION",
+    ),
 ) -> BaseResponse:
     kb = KBServiceFactory.get_kb_service_by_name(kb_name)
     if kb is None:
@@ -92,7 +113,9 @@ def create_collection(
         collection_name = map_collection_name(kb_name, collection_name)
         if collection_name in kb.list_collection():
             return BaseResponse(code=403, msg="Collection already exists")
-        kb.create_collection(collection_name, collection_info)
+        kb.create_collection(
+            collection_name, collection_info, vector_precision=vector_precision
+        )
         # TODO: add collection to db
     except Exception as e:
         msg = f"Fail to create collection: {e}"
@@ -114,6 +137,7 @@ def drop_collection(
         if collection_name not in kb.list_collection():
             return BaseResponse(code=404, msg="Collection not exist")
         kb.drop_collection(collection_name)
+        answer_cache.invalidate(kb_name, collection_name)
     except Exception as e:
         msg = f"Fail to drop collection: {e}"
         logger.error(f"{e.__class__.__name__}: {msg}")
@@ -145,11 +169,60 @@ def upload_docs(
     kb_name: str = Form(
         "default", description="Knowledge base name", example="default"
     ),
+    collection_name: str = Form(
+        "history_rag", description="Collection name", example="history_rag"
+    ),
     override: bool = Form(False, description="Override existing documents"),
     chunk_size: int = Form(Settings.kb_settings.CHUNK_SIZE, description="Chunk size"),
     chunk_overlap: int = Form(Settings.kb_settings.OVERLAP_SIZE, description="Overlap"),
+    background: bool = Form(False, description="Run as background ingestion jobs"),
 ) -> BaseResponse:
-    raise NotImplementedError
+    kb = KBServiceFactory.get_kb_service_by_name(kb_name)
+    if kb is None:
+        return BaseResponse(code=404, msg="Knowledge base not found")
+    try:
+        collection_name = map_collection_name(kb_name, collection_name)
+    except ValueError as e:
+        return BaseResponse(code=400, msg=str(e))
+
+    results, failed_files = [], []
+    for file in files:
+        try:
+            check_document_type(file.filename)
+            if background:
+                job = job_manager.submit_upload(
+                    kb_name,
+                    collection_name,
+                    file.file,
+                    file.filename,
+                    chunk_size,
+                    chunk_overlap,
+                    override,
+                )
+                results.append({"file_name": file.filename, "job_id": job.id})
+                continue
+            if override:
+                kb.delete_doc(collection_name, file.filename)
+            stats = kb.add_doc(
+                collection_name, file.file, file.filename, chunk_size, chunk_overlap
+            )
+            results.append({"file_name": file.filename, "stats": stats})
+            if stats is not None and stats.failed > 0:
+                failed_files.append(file.filename)
+        except Exception as e:
+            msg = f"Fail to upload document {file.filename}: {e}"
+            logger.error(f"{e.__class__.__name__}: {msg}")
+            results.append({"file_name": file.filename, "error": msg})
+            failed_files.append(file.filename)
+        finally:
+            file.file.close()
+    answer_cache.invalidate(kb_name, collection_name)
+    if failed_files:
+        msg = f"Fail to upload documents: {failed_files}"
+        return BaseResponse(code=500, msg=msg, data=results)
+    if background:
+        return BaseResponse(code=200, msg="Ingestion jobs queued", data=results)
+    return BaseResponse(code=200, msg="Documents uploaded", data=results)
 
 
 def add_context(
@@ -160,18 +233,28 @@ def add_context(
     collection_name: str = Body(
         "history_rag", description="Collection name", example="history_rag"
     ),
+    background: bool = Body(False, description="Run as a background ingestion job"),
 ) -> BaseResponse:
     kb = KBServiceFactory.get_kb_service_by_name(kb_name)
     if kb is None:
         return BaseResponse(code=404, msg="Knowledge base not found")
     try:
         collection_name = map_collection_name(kb_name, collection_name)
-        kb.add_context(collection_name, context)
+        if background:
+            if isinstance(context, Context):
+                context = [context]
+            job = job_manager.submit_contexts(kb_name, collection_name, context)
+            return BaseResponse(code=200, msg="Ingestion job queued", data=job)
+        stats = kb.add_context(collection_name, context)
+        answer_cache.invalidate(kb_name, collection_name)
     except Exception as e:
         msg = f"Fail to upload context: {e}"
         logger.error(f"{e.__class__.__name__}: {msg}")
         return BaseResponse(code=500, msg=msg)
-    return BaseResponse(code=200, msg="Context uploaded")
+    if stats is not None and stats.failed > 0:
+        msg = f"Fail to upload {stats.failed} contexts"
+        return BaseResponse(code=500, msg=msg, data=stats)
+    return BaseResponse(code=200, msg="Context uploaded", data=stats)
 
 
 def search(
@@ -188,17 +271,118 @@ def search(
     score_threshold: float = Body(
         Settings.kb_settings.SCORE_THRESHOLD, description="Similarity score threshold"
     ),
+    hybrid: Optional[bool] = Body(
+        None, description="Fuse BM25 hits with vector hits, defaults to HYBRID_SEARCH"
+    ),
+    filters: Optional[ContextFilter] = Body(
+        None, description="Only search contexts whose metadata match the filter"
+    ),
 ) -> ListResponse:
     kb = KBServiceFactory.get_kb_service_by_name(kb_name)
     if kb is None:
         return ListResponse(code=404, msg="Knowledge base not found")
     if query is None or query.strip() == "":
         return ListResponse(code=400, msg="Query is empty")
+    timings = start_request("search", kb_name=kb_name, top_k=top_k)
     try:
         collection_name = map_collection_name(kb_name, collection_name)
-        contexts = kb.search(query, collection_name, top_k, score_threshold)
+        contexts = kb.search(
+            query,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid=hybrid,
+            filters=filters,
+        )
     except Exception as e:
         msg = f"Fail to search query {query}: {e}"
         logger.error(f"{e.__class__.__name__}: {msg}")
+        timings.finish(error=e.__class__.__name__)
         return ListResponse(code=500, msg=msg)
+    timings.finish(docs=len(contexts))
     return ListResponse(code=200, msg="Search results", data=contexts)
+
+
+def batch_search(
+    queries: List[str] = Body(
+        ..., description="User queries", examples=[["Who is Zheyuan Lin"]]
+    ),
+    kb_name: str = Body(
+        "default", description="Knowledge base name", examples=["default"]
+    ),
+    collection_name: str = Body(
+        "default", description="Collection name", examples=["default"]
+    ),
+    top_k: int = Body(
+        Settings.kb_settings.VS_TOP_K, description="Top k retrieved chunks per query"
+    ),
+    score_threshold: float = Body(
+        Settings.kb_settings.SCORE_THRESHOLD, description="Similarity score threshold"
+    ),
+    hybrid: Optional[bool] = Body(
+        None, description="Fuse BM25 hits with vector hits, defaults to HYBRID_SEARCH"
+    ),
+    filters: Optional[ContextFilter] = Body(
+        None, description="Only search contexts whose metadata match the filter"
+    ),
+) -> ListResponse:
+    """Search many queries at once, data holds the results of each query in order"""
+    kb = KBServiceFactory.get_kb_service_by_name(kb_name)
+    if kb is None:
+        return ListResponse(code=404, msg="Knowledge base not found")
+    if not queries or any(q is None or q.strip() == "" for q in queries):
+        return ListResponse(code=400, msg="Queries should be non-empty")
+    max_queries = Settings.kb_settings.BATCH_SEARCH_MAX_QUERIES
+    if len(queries) > max_queries:
+        return ListResponse(code=400, msg=f"At most {max_queries} queries per batch")
+    timings = start_request(
+        "batch_search", kb_name=kb_name, top_k=top_k, queries=len(queries)
+    )
+    try:
+        collection_name = map_collection_name(kb_name, collection_name)
+        results = kb.search_many(
+            queries,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid=hybrid,
+            filters=filters,
+        )
+    except Exception as e:
+        msg = f"Fail to search {len(queries)} queries: {e}"
+        logger.error(f"{e.__class__.__name__}: {msg}")
+        timings.finish(error=e.__class__.__name__)
+        return ListResponse(code=500, msg=msg)
+    timings.finish()
+    return ListResponse(code=200, msg="Search results", data=results)
+
+
+def pool_stats() -> BaseResponse:
+    return BaseResponse(code=200, msg="KB service pool stats", data=kb_pool.stats())
+
+
+def cache_stats() -> BaseResponse:
+    stats = {
+        "embedding": embed_cache.stats(),
+        "answer": answer_cache.stats(),
+        "rerank": reranker.stats(),
+    }
+    return BaseResponse(code=200, msg="Cache stats", data=stats)
+
+
+def list_jobs() -> ListResponse:
+    return ListResponse(code=200, msg="Ingestion jobs", data=job_manager.list())
+
+
+def get_job(job_id: str) -> BaseResponse:
+    job = job_manager.get(job_id)
+    if job is None:
+        return BaseResponse(code=404, msg=f"Job {job_id} not found")
+    return BaseResponse(code=200, msg="Ingestion job", data=job)
+
+
+def cancel_job(job_id: str) -> BaseResponse:
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return BaseResponse(code=404, msg=f"Job {job_id} not found")
+    return BaseResponse(code=200, msg="Ingestion job cancelled", data=job)
@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from rag.server.kb.base import KBService, KBServiceFactory
+from rag.server.metrics import count_cache
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+PoolKey = Tuple[str, str, str]
+
+
+class _PoolEntry:
+    def __init__(self, service: KBService):
+        self.service = service
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.uses = 0
+
+
+class KBServicePool:
+    """
+    Process-wide registry of long-lived KB services.
+
+    Services are keyed by (kb_name, vector_store_type, embed_model) so that the
+    vector store connection and the embedding client are built once and reused
+    by every request. The least recently used service is closed when the pool
+    grows beyond ``max_size``. Services are built outside the pool lock, one
+    build per key at a time, so a slow build does not stall the other KBs.
+    """
+
+    def __init__(self, max_size: int = None):
+        self._max_size = max_size
+        self._entries: "OrderedDict[PoolKey, _PoolEntry]" = OrderedDict()
+        self._lock = threading.RLock()
+        # held while the service of a key is built
+        self._building: Dict[PoolKey, threading.Lock] = {}
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @property
+    def max_size(self) -> int:
+        if self._max_size is not None:
+            return self._max_size
+        return Settings.kb_settings.KB_POOL_SIZE
+
+    def get(
+        self,
+        kb_name: str,
+        vector_store_type: str = None,
+        embed_model: str = None,
+        kb_info: str = None,
+    ) -> KBService:
+        if vector_store_type is None:
+            vector_store_type = Settings.kb_settings.DEFAULT_VS_TYPE
+        if embed_model is None:
+            embed_model = Settings.model_settings.DEFAULT_EMBEDDING_MODEL
+        key = (kb_name, vector_store_type.lower(), embed_model)
+        with self._lock:
+            service = self._hit(key)
+            if service is not None:
+                return service
+            build_lock = self._building.setdefault(key, threading.Lock())
+        with build_lock:
+            with self._lock:
+                # built by another request while this one waited
+                service = self._hit(key)
+                if service is not None:
+                    return service
+                self._misses += 1
+                count_cache("kb_pool", "miss")
+            try:
+                service = KBServiceFactory.get_kb_service(
+                    kb_name, kb_info, vector_store_type, embed_model
+                )
+            finally:
+                with self._lock:
+                    if self._building.get(key) is build_lock:
+                        del self._building[key]
+            if service is None:
+                return None
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _PoolEntry(service)
+                    self._evict()
+                entry.uses += 1
+                entry.last_used = time.time()
+            if entry.service is not service:
+                # keep the service which got in first
+                self._close_service(service)
+            return entry.service
+
+    def _hit(self, key: PoolKey) -> Optional[KBService]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._hits += 1
+        count_cache("kb_pool", "hit")
+        self._entries.move_to_end(key)
+        entry.uses += 1
+        entry.last_used = time.time()
+        return entry.service
+
+    def _evict(self):
+        while len(self._entries) > self.max_size:
+            key, entry = self._entries.popitem(last=False)
+            self._evictions += 1
+            logger.info(f"Evict KB service {key} from pool")
+            self._close_service(entry.service)
+
+    @staticmethod
+    def _close_service(service: KBService):
+        try:
+            service.close()
+        except Exception as e:
+            logger.error(f"{e.__class__.__name__}: Fail to close KB service: {e}")
+
+    def warmup(self, kb_names: List[str]):
+        """Build services ahead of the first request, failures are only logged"""
+        for kb_name in kb_names:
+            try:
+                self.get(kb_name)
+                logger.info(f"KB service {kb_name} warmed up")
+            except Exception as e:
+                logger.error(
+                    f"{e.__class__.__name__}: Fail to warm up KB service {kb_name}: {e}"
+                )
+
+    def close(self):
+        with self._lock:
+            services = [entry.service for entry in self._entries.values()]
+            self._entries.clear()
+        for service in services:
+            self._close_service(service)
+        for service_cls in {type(s) for s in services}:
+            service_cls.close_shared()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            now = time.time()
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "services": [
+                    {
+                        "kb_name": kb_name,
+                        "vector_store_type": vs_type,
+                        "embed_model": embed_model,
+                        "uses": entry.uses,
+                        "age": round(now - entry.created_at, 3),
+                        "idle": round(now - entry.last_used, 3),
+                    }
+                    for (kb_name, vs_type, embed_model), entry in self._entries.items()
+                ],
+            }
+
+
+kb_pool = KBServicePool()
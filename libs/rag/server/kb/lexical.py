@@ -0,0 +1,279 @@
+import json
+import math
+import os
+import re
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from rag.server.models.kb_spec import Context
+
+DocKey = Union[str, int]
+
+SEGMENT_FILE = "segment.npz"
+DOCS_FILE = "docs.json"
+LOG_FILE = "log.jsonl"
+
+# runs of CJK characters, or words of other scripts not running into CJK text
+_TOKEN_RE = re.compile(r"[㐀-䶿一-鿿豈-﫿]+|[^\W_㐀-䶿一-鿿豈-﫿]+")
+
+
+def _is_cjk(ch: str) -> bool:
+    return "㐀" <= ch <= "鿿" or "豈" <= ch <= "﫿"
+
+
+def tokenize(text: str) -> Iterator[str]:
+    """
+    Chinese-aware tokenizer without a dictionary: runs of CJK characters are
+    split into overlapping bigrams, so names such as 人物 / 地名 / 年号 match
+    whatever their word boundaries, other scripts are split into lowercased words.
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    for match in _TOKEN_RE.finditer(text):
+        token = match.group()
+        if not _is_cjk(token[0]):
+            yield token
+        elif len(token) == 1:
+            yield token
+        else:
+            for i in range(len(token) - 1):
+                yield token[i : i + 2]
+
+
+def reciprocal_rank_fusion(
+    rankings: Sequence[List[Context]], k: int = 60
+) -> List[Context]:
+    """
+    Merge ranked lists by sum of ``1 / (k + rank)``, contexts are matched by id
+    and the fused score replaces their ``distance``
+    """
+    scores: Dict[DocKey, float] = {}
+    contexts: Dict[DocKey, Context] = {}
+    for ranking in rankings:
+        for rank, context in enumerate(ranking, start=1):
+            scores[context.id] = scores.get(context.id, 0.0) + 1.0 / (k + rank)
+            contexts.setdefault(context.id, context)
+    fused = sorted(scores, key=scores.get, reverse=True)
+    return [contexts[i].model_copy(update={"distance": scores[i]}) for i in fused]
+
+
+class BM25Index:
+    """
+    Persisted BM25 inverted index over the content of one collection.
+
+    Postings live in a compacted CSR segment (``segment.npz``: per-term offsets
+    into doc number / term frequency arrays) plus an in-memory delta for docs
+    added since the last compaction, which is made durable by an append-only
+    ``log.jsonl``. Deletes are tombstones until the next compaction. Docs are
+    identified by the key of the vector store, so hits can be joined with it.
+    """
+
+    def __init__(self, path: Path, k1: float = 1.5, b: float = 0.75):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.lock = threading.RLock()
+        self.keys: List[DocKey] = []
+        self.files: List[Optional[str]] = []
+        self.lengths = array("f")
+        self.alive = array("b")
+        self.live = 0
+        self.total_length = 0.0
+        self.terms: Dict[str, int] = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.docs = np.zeros(0, dtype=np.int32)
+        self.freqs = np.zeros(0, dtype=np.float32)
+        self.delta: Dict[int, Tuple[List[int], List[int]]] = {}
+        self.delta_docs = 0
+        self.dead = 0
+        self._load()
+
+    def __len__(self) -> int:
+        return self.live
+
+    def _load(self):
+        if (self.path / SEGMENT_FILE).is_file():
+            segment = np.load(self.path / SEGMENT_FILE)
+            self.offsets = segment["offsets"]
+            self.docs = segment["docs"]
+            self.freqs = segment["freqs"]
+            self.lengths = array("f", segment["lengths"].tobytes())
+            docs = json.loads((self.path / DOCS_FILE).read_text(encoding="utf-8"))
+            self.terms = {term: i for i, term in enumerate(docs["terms"])}
+            self.keys, self.files = docs["keys"], docs["files"]
+            self.alive = array("b", [1]) * len(self.keys)
+            self.live = len(self.keys)
+            self.total_length = float(sum(self.lengths))
+        if (self.path / LOG_FILE).is_file():
+            with open(self.path / LOG_FILE, encoding="utf-8") as fp:
+                for line in fp:
+                    record = json.loads(line)
+                    if "delete" in record:
+                        self._delete(record["delete"])
+                    else:
+                        self._add(record["key"], record["file"], record["tf"])
+
+    def _add(self, key: DocKey, file_name: Optional[str], tf: Dict[str, int]):
+        doc = len(self.keys)
+        self.keys.append(key)
+        self.files.append(file_name)
+        length = sum(tf.values())
+        self.lengths.append(length)
+        self.alive.append(1)
+        self.live += 1
+        self.total_length += length
+        self.delta_docs += 1
+        for term, freq in tf.items():
+            tid = self.terms.setdefault(term, len(self.terms))
+            docs, freqs = self.delta.setdefault(tid, ([], []))
+            docs.append(doc)
+            freqs.append(freq)
+
+    def _delete(self, file_name: str) -> int:
+        deleted = 0
+        for doc, name in enumerate(self.files):
+            if name == file_name and self.alive[doc]:
+                self.alive[doc] = 0
+                self.live -= 1
+                self.total_length -= self.lengths[doc]
+                deleted += 1
+        self.dead += deleted
+        return deleted
+
+    def _append_log(self, records: List[Dict]):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open(self.path / LOG_FILE, "a", encoding="utf-8") as fp:
+            for record in records:
+                fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def add(
+        self,
+        keys: Sequence[DocKey],
+        texts: Sequence[str],
+        file_names: Sequence[Optional[str]],
+    ):
+        records = [
+            {"key": key, "file": file_name, "tf": dict(Counter(tokenize(text)))}
+            for key, text, file_name in zip(keys, texts, file_names)
+        ]
+        with self.lock:
+            self._append_log(records)
+            for record in records:
+                self._add(record["key"], record["file"], record["tf"])
+
+    def delete_file(self, file_name: str):
+        with self.lock:
+            if self._delete(file_name):
+                self._append_log([{"delete": file_name}])
+
+    def _postings(self, tid: int) -> Tuple[np.ndarray, np.ndarray]:
+        if tid + 1 < len(self.offsets):
+            start, end = self.offsets[tid], self.offsets[tid + 1]
+            docs, freqs = self.docs[start:end], self.freqs[start:end]
+        else:
+            docs, freqs = self.docs[:0], self.freqs[:0]
+        if tid in self.delta:
+            delta_docs, delta_freqs = self.delta[tid]
+            docs = np.concatenate([docs, np.asarray(delta_docs, dtype=np.int32)])
+            freqs = np.concatenate([freqs, np.asarray(delta_freqs, dtype=np.float32)])
+        return docs, freqs
+
+    def search(self, query: str, top_k: int) -> List[Tuple[DocKey, float]]:
+        """Return the keys and BM25 scores of the ``top_k`` best matching docs"""
+        with self.lock:
+            if self.live == 0 or top_k <= 0:
+                return []
+            n = len(self.keys)
+            lengths = np.frombuffer(self.lengths, dtype=np.float32)
+            alive = np.frombuffer(self.alive, dtype=np.int8)
+            avgdl = self.total_length / self.live
+            hit_docs, hit_scores = [], []
+            for term in set(tokenize(query)):
+                tid = self.terms.get(term)
+                if tid is None:
+                    continue
+                docs, freqs = self._postings(tid)
+                if len(docs) == 0:
+                    continue
+                # tombstones are left out of df as they are out of N, a df
+                # above N would make the idf negative
+                df = int(alive[docs].sum())
+                if df == 0:
+                    continue
+                idf = math.log(1 + (self.live - df + 0.5) / (df + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[docs] / avgdl)
+                hit_docs.append(docs)
+                hit_scores.append(idf * freqs * (self.k1 + 1) / (freqs + norm))
+            # an array exporting its buffer can not grow, release the views in the lock
+            del lengths, alive
+            if not hit_docs:
+                return []
+            scores = np.bincount(
+                np.concatenate(hit_docs), np.concatenate(hit_scores), minlength=n
+            )
+            scores *= np.frombuffer(self.alive, dtype=np.int8)
+            candidates = np.flatnonzero(scores)
+            if len(candidates) > top_k:
+                best = np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+                candidates = candidates[best]
+            candidates = candidates[np.argsort(-scores[candidates])]
+            return [(self.keys[i], float(scores[i])) for i in candidates]
+
+    def compact(self):
+        """Merge the delta into the segment and drop deleted docs"""
+        with self.lock:
+            alive = np.frombuffer(self.alive, dtype=np.int8).astype(bool)
+            remap = np.cumsum(alive) - 1
+            term_ids = [np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))]
+            docs, freqs = [self.docs], [self.freqs]
+            for tid, (delta_docs, delta_freqs) in self.delta.items():
+                term_ids.append(np.full(len(delta_docs), tid))
+                docs.append(np.asarray(delta_docs, dtype=np.int32))
+                freqs.append(np.asarray(delta_freqs, dtype=np.float32))
+            term_ids, docs, freqs = map(np.concatenate, (term_ids, docs, freqs))
+            keep = alive[docs]
+            term_ids, docs, freqs = term_ids[keep], remap[docs[keep]], freqs[keep]
+            order = np.lexsort((docs, term_ids))
+            self.docs = docs[order].astype(np.int32)
+            self.freqs = freqs[order]
+            counts = np.bincount(term_ids, minlength=len(self.terms))
+            self.offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            self.keys = [k for k, a in zip(self.keys, alive) if a]
+            self.files = [f for f, a in zip(self.files, alive) if a]
+            self.lengths = array(
+                "f", np.frombuffer(self.lengths, dtype=np.float32)[alive].tobytes()
+            )
+            self.alive = array("b", [1]) * len(self.keys)
+            self.delta, self.delta_docs, self.dead = {}, 0, 0
+            self._write()
+
+    def _write(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        tmp = self.path / (SEGMENT_FILE + ".tmp")
+        with open(tmp, "wb") as fp:
+            np.savez(
+                fp,
+                offsets=self.offsets,
+                docs=self.docs,
+                freqs=self.freqs,
+                lengths=np.frombuffer(self.lengths, dtype=np.float32),
+            )
+        os.replace(tmp, self.path / SEGMENT_FILE)
+        terms = sorted(self.terms, key=self.terms.get)
+        docs = {"terms": terms, "keys": self.keys, "files": self.files}
+        tmp = self.path / (DOCS_FILE + ".tmp")
+        tmp.write_text(json.dumps(docs, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path / DOCS_FILE)
+        # the segment now holds everything the log recorded
+        (self.path / LOG_FILE).unlink(missing_ok=True)
+
+    def save(self, compact_ratio: float = 0.1):
+        """Compact once the delta or the tombstones outgrow ``compact_ratio`` of the index"""
+        with self.lock:
+            pending = self.delta_docs + self.dead
+            if pending and pending >= compact_ratio * len(self.keys):
+                self.compact()
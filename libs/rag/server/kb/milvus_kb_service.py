@@ -1,16 +1,46 @@
-from functools import partial
-from typing import Any, Dict, List, Union
+import asyncio
+import json
+import threading
+from typing import Any, ClassVar, Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from pymilvus import CollectionSchema, DataType, FieldSchema, MilvusClient
-from rag.server.kb.base import KBService
-from rag.server.llm.proxy_llm import PlatformLLM
-from rag.server.llm.utils import get_model_configs
-from rag.server.models.kb_spec import Context, ContextMetadata
-from rag.server.models.model_spec import ModelConfig
+from rag.server.kb.base import KBService, SupportedVectorStoreTypes
+from rag.server.kb.ingest import EmbeddingPipeline
+from rag.server.kb.quantize import cosine_similarity, quantize
+from rag.server.models.kb_spec import (
+    Context,
+    ContextFilter,
+    ContextMetadata,
+    IngestStats,
+)
 from rag.settings import Settings
 
+# metadata fields promoted to indexed scalar fields, so filters on them are
+# evaluated by Milvus before the ANN search
+STRING_FIELDS = ("series_name", "file_name", "title")
+PAGE_FIELDS = ("start_page", "end_page")
+MAX_STRING_FIELD_LENGTH = 512
+# vector type and index metric of the embedding field at each precision
+VECTOR_TYPES = {
+    "float32": (DataType.FLOAT_VECTOR, "COSINE"),
+    "float16": (DataType.FLOAT16_VECTOR, "COSINE"),
+    "bfloat16": (DataType.BFLOAT16_VECTOR, "COSINE"),
+    "int8": (DataType.INT8_VECTOR, "COSINE"),
+    "binary": (DataType.BINARY_VECTOR, "HAMMING"),
+}
+# full precision copy of quantized embeddings, memory-mapped by Milvus and
+# only read to rescore the candidates of a search
+FULL_EMBEDDING_FIELD = "embedding_full"
+# max limit of a Milvus search
+MAX_SEARCH_LIMIT = 16384
+
 
 class MilvusKBService(KBService):
+    vs_type = SupportedVectorStoreTypes.MILVUS
+
+    # one gRPC connection per Milvus endpoint, shared by every kb service
+    _clients: ClassVar[Dict[Tuple[str, str], MilvusClient]] = {}
+    _clients_lock: ClassVar[threading.Lock] = threading.Lock()
 
     def __init__(
         self,
@@ -18,25 +48,14 @@ class MilvusKBService(KBService):
         kb_info: str = None,
         embed_model: str = Settings.model_settings.DEFAULT_EMBEDDING_MODEL,
     ):
-        self.client = MilvusClient(
-            uri=Settings.kb_settings.MILVUS_HOST,
-            token=Settings.kb_settings.MILVUS_TOKEN,
-        )
-
-        embedding_model_config: ModelConfig = get_model_configs(embed_model)
-        embed_dim = embedding_model_config.meta_data.get(
-            "embed_size", Settings.model_settings.DEFAULT_EMBEDDING_SIZE
-        )
-        self.context_window = embedding_model_config.meta_data.get(
-            "context_window", Settings.model_settings.DEFAULT_EMBEDDING_CONTEXT_WINDOW
-        )
-        self.embed_func = partial(
-            PlatformLLM(embedding_model_config).embed,
-            context_window=self.context_window,
+        self.client = self.shared_client(
+            Settings.kb_settings.MILVUS_HOST, Settings.kb_settings.MILVUS_TOKEN
         )
+        embed_dim = self.init_embedding(embed_model)
         if kb_info is None or len(kb_info.strip()) == 0:
             kb_info = f"Milvus KB Service, based on {embed_model}, dim {embed_dim}"
         super().__init__(kb_name, kb_info, embed_model)
+        self.embed_dim = embed_dim
         self._DEFAULT_FIELDS = [
             FieldSchema(
                 name="uuid",
@@ -60,18 +79,171 @@ class MilvusKBService(KBService):
                 is_primary=False,
                 dim=embed_dim,
             ),
+            *[
+                FieldSchema(
+                    name=name,
+                    dtype=DataType.VARCHAR,
+                    max_length=MAX_STRING_FIELD_LENGTH,
+                    nullable=True,
+                )
+                for name in STRING_FIELDS
+            ],
+            *[
+                FieldSchema(name=name, dtype=DataType.INT64, nullable=True)
+                for name in PAGE_FIELDS
+            ],
         ]
         self._DEFAULT_INDEX_PARAMS = [
             {
                 "field_name": "embedding",
                 "index_type": "AUTOINDEX",
                 "metric_type": "COSINE",
-            }
+            },
+            *[
+                {"field_name": name, "index_type": "INVERTED"}
+                for name in STRING_FIELDS + PAGE_FIELDS
+            ],
         ]
+        # fields of each collection by name, collections created before the
+        # scalar field promotion only have the metadata JSON field
+        self._fields: Dict[str, Dict[str, Dict[str, Any]]] = {}
+
+    @classmethod
+    def shared_client(cls, uri: str, token: str) -> MilvusClient:
+        with cls._clients_lock:
+            client = cls._clients.get((uri, token))
+            if client is None:
+                client = MilvusClient(uri=uri, token=token)
+                cls._clients[(uri, token)] = client
+            return client
+
+    @classmethod
+    def close_shared(cls):
+        with cls._clients_lock:
+            clients = list(cls._clients.values())
+            cls._clients.clear()
+        for client in clients:
+            client.close()
 
     def list_collection(self):
         return self.client.list_collections()
 
+    def _describe(self, collection_name: str) -> Dict[str, Dict[str, Any]]:
+        fields = self._fields.get(collection_name)
+        if fields is None:
+            schema = self.client.describe_collection(collection_name)
+            fields = {field["name"]: field for field in schema["fields"]}
+            self._fields[collection_name] = fields
+        return fields
+
+    def scalar_fields(self, collection_name: str) -> Set[str]:
+        return self._describe(collection_name).keys() & set(STRING_FIELDS + PAGE_FIELDS)
+
+    def vector_precision(self, collection_name: str) -> str:
+        """Precision of the embedding field, collections without one are float32"""
+        field = self._describe(collection_name).get("embedding")
+        if field is not None:
+            for precision, (dtype, _) in VECTOR_TYPES.items():
+                if field["type"] == dtype:
+                    return precision
+        return "float32"
+
+    def _default_schema(
+        self, precision: str
+    ) -> Tuple[List[FieldSchema], List[Dict[str, Any]]]:
+        """
+        Default fields and index params with the embedding field at ``precision``.
+        Quantized embeddings come with a memory-mapped full precision copy.
+        """
+        if precision not in VECTOR_TYPES:
+            raise ValueError(f"Unsupported vector precision {precision}")
+        if precision == "float32":
+            return self._DEFAULT_FIELDS, self._DEFAULT_INDEX_PARAMS
+        if precision == "binary" and self.embed_dim % 8:
+            raise ValueError(
+                f"Binary vectors need a dim multiple of 8, got {self.embed_dim}"
+            )
+        dtype, metric_type = VECTOR_TYPES[precision]
+        fields = [
+            (
+                FieldSchema(name="embedding", dtype=dtype, dim=self.embed_dim)
+                if field.name == "embedding"
+                else field
+            )
+            for field in self._DEFAULT_FIELDS
+        ]
+        fields.append(
+            FieldSchema(
+                name=FULL_EMBEDDING_FIELD,
+                dtype=DataType.FLOAT_VECTOR,
+                dim=self.embed_dim,
+                mmap_enabled=True,
+            )
+        )
+        index_params = [
+            (
+                {**param, "metric_type": metric_type}
+                if param["field_name"] == "embedding"
+                else param
+            )
+            for param in self._DEFAULT_INDEX_PARAMS
+        ]
+        index_params.append(
+            {
+                "field_name": FULL_EMBEDDING_FIELD,
+                "index_type": "FLAT",
+                "metric_type": "COSINE",
+                "params": {"mmap.enabled": "true"},
+            }
+        )
+        return fields, index_params
+
+    def _field_ref(self, collection_name: str, name: str) -> str:
+        if name in self.scalar_fields(collection_name):
+            return name
+        return f'metadata["{name}"]'
+
+    def filter_expr(self, collection_name: str, filters: ContextFilter) -> str:
+        """Milvus boolean expression of a filter, on scalar fields when promoted"""
+        clauses = []
+        for name in STRING_FIELDS:
+            allowed = getattr(filters, name)
+            if allowed is not None:
+                values = json.dumps(allowed, ensure_ascii=False)
+                clauses.append(f"{self._field_ref(collection_name, name)} in {values}")
+        if filters.start_page is not None:
+            ref = self._field_ref(collection_name, "end_page")
+            clauses.append(f"{ref} >= {int(filters.start_page)}")
+        if filters.end_page is not None:
+            ref = self._field_ref(collection_name, "start_page")
+            clauses.append(f"{ref} <= {int(filters.end_page)}")
+        return " and ".join(clauses)
+
+    def _with_scalar_fields(
+        self, collection_name: str, rows: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        fields = self.scalar_fields(collection_name)
+        for row in rows:
+            metadata = row["metadata"] or {}
+            for name in fields:
+                value = metadata.get(name)
+                if name in STRING_FIELDS and value is not None:
+                    value = value[:MAX_STRING_FIELD_LENGTH]
+                row[name] = value
+        return rows
+
+    def _with_quantized_vectors(
+        self, collection_name: str, rows: List[Dict[str, Any]]
+    ) -> List[Dict[str, Any]]:
+        precision = self.vector_precision(collection_name)
+        if precision == "float32" or not rows:
+            return rows
+        codes = quantize([row["embedding"] for row in rows], precision)
+        for row, code in zip(rows, codes):
+            row[FULL_EMBEDDING_FIELD] = row["embedding"]
+            row["embedding"] = code
+        return rows
+
     def search(
         self,
         query: str,
@@ -79,24 +251,138 @@ class MilvusKBService(KBService):
         top_k: int = Settings.kb_settings.VS_TOP_K,
         score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
         search_params: Dict[str, Any] = None,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+    ) -> List[Context]:
+        query_embedding = self.embed_query(query)
+        return self._retrieve(
+            query,
+            query_embedding,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+            search_params=search_params,
+        )
+
+    async def asearch(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        search_params: Dict[str, Any] = None,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+    ) -> List[Context]:
+        query_embedding = await self.aembed_query(query)
+        # the gRPC search is offloaded so the event loop keeps serving requests
+        return await asyncio.to_thread(
+            self._retrieve,
+            query,
+            query_embedding,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+            search_params=search_params,
+        )
+
+    def _search_by_embedding(
+        self,
+        query_embedding: List[float],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        search_params: Dict[str, Any] = None,
+        **kwargs,
     ) -> List[Context]:
+        return self._search_many_by_embedding(
+            [query_embedding],
+            collection_name,
+            top_k,
+            score_threshold,
+            filters,
+            search_params,
+        )[0]
+
+    def _search_many_by_embedding(
+        self,
+        query_embeddings: List[List[float]],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        search_params: Dict[str, Any] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        precision = self.vector_precision(collection_name)
         if search_params is None:
-            search_params = {"metric_type": "COSINE"}
-        query_embedding = self.embed_func(query)
+            search_params = {"metric_type": VECTOR_TYPES[precision][1]}
+        expr = "" if filters is None else self.filter_expr(collection_name, filters)
+        output_fields = ["id", "distance", "metadata", "content"]
+        if precision == "float32":
+            data, limit = query_embeddings, top_k
+        else:
+            # over-fetch from the quantized field, then rescore at full precision,
+            # queries are typed rows so they are not taken as binary vectors
+            data = quantize(query_embeddings, precision)
+            factor = max(Settings.kb_settings.MILVUS_RESCORE_FACTOR, 1)
+            limit = min(top_k * factor, MAX_SEARCH_LIMIT)
+            output_fields.append(FULL_EMBEDDING_FIELD)
+        # one multi-vector ANN request for all the queries, pre-filtered by expr
         results = self.client.search(
             collection_name=collection_name,
             anns_field="embedding",
-            data=[query_embedding],
+            data=data,
+            filter=expr,
             search_params=search_params,
-            limit=top_k,
-            output_fields=["id", "distance", "metadata", "content"],
-        )[0]
-        results = [r for r in results if r["distance"] >= score_threshold]
-        results = [
-            {"id": r["id"], "distance": r["distance"], **r["entity"]} for r in results
+            limit=limit,
+            output_fields=output_fields,
+        )
+        if precision != "float32":
+            results = [
+                self._rescore(query_embedding, hits, top_k)
+                for query_embedding, hits in zip(query_embeddings, results)
+            ]
+        return [
+            [
+                Context.model_validate(
+                    {"id": r["id"], "distance": r["distance"], **r["entity"]}
+                )
+                for r in hits
+                if r["distance"] >= score_threshold
+            ]
+            for hits in results
+        ]
+
+    @staticmethod
+    def _rescore(
+        query_embedding: List[float], hits: List[Dict[str, Any]], top_k: int
+    ) -> List[Dict[str, Any]]:
+        """Best ``top_k`` hits by cosine similarity of their full precision vectors"""
+        if not hits:
+            return []
+        vectors = [r["entity"].pop(FULL_EMBEDDING_FIELD) for r in hits]
+        scores = cosine_similarity(query_embedding, vectors)
+        order = scores.argsort()[::-1][:top_k]
+        return [{**hits[i], "distance": float(scores[i])} for i in order]
+
+    def get_by_ids(
+        self, collection_name: str, ids: List[Union[str, int]]
+    ) -> List[Context]:
+        results = self.client.get(
+            collection_name=collection_name,
+            ids=ids,
+            output_fields=["metadata", "content"],
+        )
+        return [
+            Context(id=r["uuid"], metadata=r["metadata"] or {}, content=r["content"])
+            for r in results
         ]
-        contexts = [Context.model_validate(obj) for obj in results]
-        return contexts
 
     def create_collection(
         self,
@@ -104,14 +390,22 @@ class MilvusKBService(KBService):
         collection_info: str = "",
         fields: List[FieldSchema] = None,
         index_params: List[Dict[str, str]] = None,
+        vector_precision: str = None,
+        **kwargs,
     ) -> Dict[str, str]:
         """
+        Create a collection, the embedding field of the default fields is
+        stored at ``vector_precision`` (defaults to MILVUS_VECTOR_PRECISION).
+
         {"state": "<LoadState: Loaded>"}
         """
+        default_index_params = self._DEFAULT_INDEX_PARAMS
         if fields is None:
-            fields = self._DEFAULT_FIELDS
+            if vector_precision is None:
+                vector_precision = Settings.kb_settings.MILVUS_VECTOR_PRECISION
+            fields, default_index_params = self._default_schema(vector_precision)
         if index_params is None and "embedding" in [field.name for field in fields]:
-            index_params = self._DEFAULT_INDEX_PARAMS
+            index_params = default_index_params
         schema = CollectionSchema(
             fields=fields, description=collection_info, enable_dynamic_field=True
         )
@@ -124,6 +418,7 @@ class MilvusKBService(KBService):
             schema=schema,
             index_params=index_parameters,
         )
+        self._fields.pop(collection_name, None)
         load_state = self.client.get_load_state(collection_name)
         return load_state
 
@@ -136,19 +431,36 @@ class MilvusKBService(KBService):
     def drop_collection(self, collection_name):
         if collection_name in self.list_collection():
             self.client.drop_collection(collection_name)
+        self._fields.pop(collection_name, None)
+        self.drop_lexical_index(collection_name)
 
-    def add_context(self, collection_name: str, context: Union[Context, List[Context]]):
+    def add_context(
+        self,
+        collection_name: str,
+        context: Union[Context, Iterable[Context]],
+        **kwargs,
+    ) -> IngestStats:
         if isinstance(context, Context):
             context = [context]
-        context_data = [c.model_dump() for c in context]
-        content = [c["content"] for c in context_data]
-        embedding = self.embed_func(content)
-        for c, embed in zip(context_data, embedding):
-            c["embedding"] = embed
-        self.client.insert(collection_name=collection_name, data=context_data)
-
-    def get_obj_by_uuid(self, collection_name: str, uuid: str):
-        return self.client(collection_name=collection_name, ids=[uuid])
+        insert = self.with_lexical_index(
+            collection_name,
+            lambda rows: self.client.insert(
+                collection_name,
+                self._with_quantized_vectors(
+                    collection_name, self._with_scalar_fields(collection_name, rows)
+                ),
+            )["ids"],
+        )
+        pipeline = EmbeddingPipeline(self.embed_func, self.context_window)
+        stats = pipeline.run(context, insert, **kwargs)
+        self.lexical_index(collection_name).save()
+        return stats
+
+    def delete_doc(self, collection_name: str, file_name: str):
+        quoted = json.dumps(file_name, ensure_ascii=False)
+        ref = self._field_ref(collection_name, "file_name")
+        self.client.delete(collection_name=collection_name, filter=f"{ref} == {quoted}")
+        self.lexical_index(collection_name).delete_file(file_name)
 
     def save_vector_store(self):
         pass
@@ -0,0 +1,455 @@
+import asyncio
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Union
+
+import numpy as np
+from rag.server.kb.base import KBService, SupportedVectorStoreTypes
+from rag.server.kb.ingest import EmbeddingPipeline
+from rag.server.models.kb_spec import Context, ContextFilter, IngestStats
+from rag.settings import Settings
+
+STRING_FIELDS = ("series_name", "file_name", "title")
+PAGE_FIELDS = ("start_page", "end_page")
+
+VECTOR_FILE = "vectors.npy"
+CONTEXT_FILE = "contexts.jsonl"
+INFO_FILE = "info.json"
+VECTOR_LOG_FILE = "vectors.log"
+CONTEXT_LOG_FILE = "contexts.log"
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2-normalize rows so a dot product is the cosine similarity"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Indices of the ``top_k`` highest scores of each row, best first"""
+    if top_k < scores.shape[1]:
+        part = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        part = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+class _NumpyCollection:
+    """
+    One collection held as a contiguous float32 matrix of normalized vectors,
+    with the content and metadata of each row in the same order. On disk it is
+    ``vectors.npy`` plus ``contexts.jsonl``, the matrix is memory-mapped on load
+    and copied into RAM on the first write.
+
+    Those files are a snapshot, changes since are appended to ``vectors.log``
+    and ``contexts.log`` and replayed on load. The snapshot is rewritten once
+    the changes since it outgrow a fraction of the collection, see ``save``.
+    """
+
+    def __init__(self, path: Path, info: Dict):
+        self.path = path
+        self.info = info
+        self.lock = threading.RLock()
+        # rows added or deleted since the snapshot
+        self.pending = 0
+        self.rows: List[Dict] = []
+        # row position by id, rebuilt lazily after deletes shift the rows
+        self.positions: Optional[Dict[int, int]] = None
+        # metadata columns for filtering, rebuilt lazily after writes
+        self.columns: Optional[Dict[str, np.ndarray]] = None
+        self.codes: Dict[str, Dict[str, int]] = {}
+        self.size = 0
+        self.buffer = np.zeros((0, info["dim"]), dtype=np.float32)
+        if (path / VECTOR_FILE).is_file():
+            mmap_mode = "r" if Settings.kb_settings.NUMPY_MMAP else None
+            self.buffer = np.load(path / VECTOR_FILE, mmap_mode=mmap_mode)
+            with open(path / CONTEXT_FILE, encoding="utf-8") as fp:
+                self.rows = [json.loads(line) for line in fp]
+            self.size = len(self.rows)
+        if (path / CONTEXT_LOG_FILE).is_file():
+            self._replay()
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self.buffer[: self.size]
+
+    def _reserve(self, n: int):
+        """Grow the buffer geometrically so appends are amortized O(1) per row"""
+        if isinstance(self.buffer, np.memmap) or self.size + n > len(self.buffer):
+            capacity = max(self.size + n, len(self.buffer) * 2, 1024)
+            buffer = np.empty((capacity, self.info["dim"]), dtype=np.float32)
+            buffer[: self.size] = self.vectors
+            self.buffer = buffer
+
+    def _append(self, vectors: np.ndarray, rows: List[Dict]):
+        self._reserve(len(rows))
+        self.buffer[self.size : self.size + len(rows)] = vectors
+        for row in rows:
+            if self.positions is not None:
+                self.positions[row["id"]] = len(self.rows)
+            self.rows.append(row)
+        self.size += len(rows)
+        self.columns = None
+
+    def add(self, rows: List[Dict]) -> List[int]:
+        vectors = normalize(
+            np.asarray([row["embedding"] for row in rows], dtype=np.float32)
+        )
+        with self.lock:
+            start = self.info["next_id"]
+            rows = [
+                {"id": start + i, "content": row["content"], "metadata": row["metadata"]}
+                for i, row in enumerate(rows, 1)
+            ]
+            # vectors are logged first, a row is only replayed with its vector
+            with open(self.path / VECTOR_LOG_FILE, "ab") as fp:
+                fp.write(vectors.tobytes())
+            self._append_log(rows)
+            self.info["next_id"] += len(rows)
+            self._append(vectors, rows)
+            self.pending += len(rows)
+        return [row["id"] for row in rows]
+
+    def _append_log(self, records: List[Dict]):
+        with open(self.path / CONTEXT_LOG_FILE, "a", encoding="utf-8") as fp:
+            for record in records:
+                fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _replay(self):
+        """Apply the changes logged after the snapshot, then take a new snapshot"""
+        dim = self.info["dim"]
+        # deletes after a snapshot are only logged to the context log
+        vector_log = self.path / VECTOR_LOG_FILE
+        data = vector_log.read_bytes() if vector_log.is_file() else b""
+        vectors = np.frombuffer(data[: len(data) - len(data) % (4 * dim)], np.float32)
+        vectors = vectors.reshape(-1, dim)
+        n = 0
+        with open(self.path / CONTEXT_LOG_FILE, encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # torn by a crash, nothing was logged after it
+                    break
+                if "delete" in record:
+                    self._delete(record["delete"], record["last_id"])
+                    continue
+                if n >= len(vectors):
+                    break
+                # a crash between writing the snapshot and removing the logs
+                # leaves records already in the snapshot
+                if record["id"] > self.info["next_id"]:
+                    self._append(vectors[n : n + 1], [record])
+                    self.info["next_id"] = record["id"]
+                n += 1
+        self._write()
+
+    def get(self, ids: List[int]) -> List[Context]:
+        with self.lock:
+            if self.positions is None:
+                self.positions = {row["id"]: i for i, row in enumerate(self.rows)}
+            rows = [self.rows[self.positions[i]] for i in ids if i in self.positions]
+        return [Context.model_validate(row) for row in rows]
+
+    def _build_columns(self):
+        """String fields are dictionary encoded so filters compare small ints"""
+        metadata = [row["metadata"] or {} for row in self.rows]
+        self.columns, self.codes = {}, {}
+        for field in STRING_FIELDS:
+            codes = self.codes[field] = {}
+            self.columns[field] = np.asarray(
+                [codes.setdefault(m.get(field), len(codes)) for m in metadata],
+                dtype=np.int32,
+            )
+        for field in PAGE_FIELDS:
+            self.columns[field] = np.asarray(
+                [np.nan if m.get(field) is None else m[field] for m in metadata],
+                dtype=np.float64,
+            )
+
+    def _mask(self, filters: ContextFilter) -> np.ndarray:
+        if self.columns is None:
+            self._build_columns()
+        mask = np.ones(self.size, dtype=bool)
+        for field in STRING_FIELDS:
+            allowed = getattr(filters, field)
+            if allowed is not None:
+                codes = [self.codes[field][v] for v in allowed if v in self.codes[field]]
+                mask &= np.isin(self.columns[field], codes)
+        # comparisons with nan are false, so contexts without pages are dropped
+        if filters.start_page is not None:
+            mask &= self.columns["end_page"] >= filters.start_page
+        if filters.end_page is not None:
+            mask &= self.columns["start_page"] <= filters.end_page
+        return mask
+
+    def search(
+        self,
+        query_embeddings: List[List[float]],
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+    ) -> List[List[Context]]:
+        """
+        Score a batch of queries in one matrix multiply, against the rows
+        matching ``filters`` only
+        """
+        queries = normalize(np.asarray(query_embeddings, dtype=np.float32))
+        with self.lock:
+            selected = None
+            vectors = self.vectors
+            if filters is not None and self.size > 0:
+                selected = np.flatnonzero(self._mask(filters))
+                vectors = vectors[selected]
+            if len(vectors) == 0 or top_k <= 0:
+                return [[] for _ in query_embeddings]
+            scores = queries @ vectors.T
+            rows = self.rows
+        indices = top_k_indices(scores, top_k)
+        results = []
+        for q, row_indices in enumerate(indices):
+            contexts = []
+            for i in row_indices:
+                score = float(scores[q, i])
+                if score < score_threshold:
+                    break
+                row = rows[i if selected is None else selected[i]]
+                contexts.append(
+                    Context(
+                        id=row["id"],
+                        distance=score,
+                        content=row["content"],
+                        metadata=row["metadata"],
+                    )
+                )
+            results.append(contexts)
+        return results
+
+    def _delete(self, file_name: str, last_id: int) -> int:
+        """Delete the rows of a file with an id up to ``last_id``"""
+        keep = np.asarray(
+            [
+                row["id"] > last_id
+                or (row["metadata"] or {}).get("file_name") != file_name
+                for row in self.rows
+            ],
+            dtype=bool,
+        )
+        if keep.all():
+            return 0
+        self.buffer = self.vectors[keep]
+        self.rows = [row for row, k in zip(self.rows, keep) if k]
+        self.positions = None
+        self.columns = None
+        deleted = self.size - len(self.rows)
+        self.size = len(self.rows)
+        return deleted
+
+    def delete_file(self, file_name: str):
+        with self.lock:
+            deleted = self._delete(file_name, self.info["next_id"])
+            if deleted:
+                # rows of the file added later are kept when the log is replayed
+                self._append_log([{"delete": file_name, "last_id": self.info["next_id"]}])
+                self.pending += deleted
+
+    def save(self, compact_ratio: float = 0.1):
+        """
+        Snapshot the collection once the changes since the last snapshot
+        outgrow ``compact_ratio`` of it, so bulk ingestion rewrites it a
+        logarithmic number of times. Changes are durable in the logs meanwhile.
+        """
+        with self.lock:
+            if self.pending and self.pending >= compact_ratio * self.size:
+                self._write()
+
+    def _write(self):
+        tmp = self.path / (VECTOR_FILE + ".tmp")
+        with open(tmp, "wb") as fp:
+            np.save(fp, self.vectors)
+        os.replace(tmp, self.path / VECTOR_FILE)
+        tmp = self.path / (CONTEXT_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as fp:
+            for row in self.rows:
+                fp.write(json.dumps(row, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path / CONTEXT_FILE)
+        tmp = self.path / (INFO_FILE + ".tmp")
+        tmp.write_text(json.dumps(self.info, ensure_ascii=False), "utf-8")
+        os.replace(tmp, self.path / INFO_FILE)
+        # the snapshot now holds everything the logs recorded, the vector log
+        # goes first so a crash in between never leaves vectors without records
+        (self.path / VECTOR_LOG_FILE).unlink(missing_ok=True)
+        (self.path / CONTEXT_LOG_FILE).unlink(missing_ok=True)
+        self.pending = 0
+
+
+class NumpyKBService(KBService):
+    """
+    Dependency-free vector store doing exact brute-force cosine search in
+    process, suited to tests and collections up to about a million chunks.
+    Collections are persisted under ``KB_ROOT_PATH/<kb_name>/numpy/<collection_name>``.
+    """
+
+    vs_type = SupportedVectorStoreTypes.NUMPY
+
+    def __init__(
+        self,
+        kb_name: str = "default",
+        kb_info: str = None,
+        embed_model: str = Settings.model_settings.DEFAULT_EMBEDDING_MODEL,
+    ):
+        self.embed_dim = self.init_embedding(embed_model)
+        if kb_info is None or len(kb_info.strip()) == 0:
+            kb_info = f"Numpy KB Service, based on {embed_model}, dim {self.embed_dim}"
+        super().__init__(kb_name, kb_info, embed_model)
+        self.root = Path(Settings.basic_settings.KB_ROOT_PATH) / kb_name / "numpy"
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._collections: Dict[str, _NumpyCollection] = {}
+        self._lock = threading.Lock()
+
+    def _collection(self, collection_name: str) -> _NumpyCollection:
+        with self._lock:
+            collection = self._collections.get(collection_name)
+            if collection is None:
+                path = self.root / collection_name
+                if not (path / INFO_FILE).is_file():
+                    raise ValueError(f"Collection {collection_name} not exist")
+                info = json.loads((path / INFO_FILE).read_text(encoding="utf-8"))
+                collection = _NumpyCollection(path, info)
+                self._collections[collection_name] = collection
+            return collection
+
+    def create_collection(
+        self,
+        collection_name: str,
+        collection_info: str = "",
+        **kwargs,
+    ):
+        path = self.root / collection_name
+        path.mkdir(parents=True, exist_ok=True)
+        info = {
+            "description": collection_info,
+            "dim": self.embed_dim,
+            "embed_model": self.embed_model,
+            "next_id": 0,
+        }
+        (path / INFO_FILE).write_text(json.dumps(info, ensure_ascii=False), "utf-8")
+        return self._collection(collection_name).info
+
+    def drop_collection(self, collection_name: str):
+        with self._lock:
+            self._collections.pop(collection_name, None)
+        shutil.rmtree(self.root / collection_name, ignore_errors=True)
+        self.drop_lexical_index(collection_name)
+
+    def list_collection(self):
+        return sorted(p.parent.name for p in self.root.glob(f"*/{INFO_FILE}"))
+
+    def add_context(
+        self,
+        collection_name: str,
+        context: Union[Context, Iterable[Context]],
+        **kwargs,
+    ) -> IngestStats:
+        if isinstance(context, Context):
+            context = [context]
+        collection = self._collection(collection_name)
+        insert = self.with_lexical_index(collection_name, collection.add)
+        pipeline = EmbeddingPipeline(self.embed_func, self.context_window)
+        stats = pipeline.run(context, insert, **kwargs)
+        collection.save()
+        self.lexical_index(collection_name).save()
+        return stats
+
+    def search(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        query_embedding = self.embed_query(query)
+        return self._retrieve(
+            query,
+            query_embedding,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+        )
+
+    async def asearch(
+        self,
+        query: str,
+        collection_name: str,
+        top_k: int = Settings.kb_settings.VS_TOP_K,
+        score_threshold: float = Settings.kb_settings.SCORE_THRESHOLD,
+        hybrid: Optional[bool] = None,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        query_embedding = await self.aembed_query(query)
+        # brute-force scoring takes milliseconds on large collections, so it is
+        # offloaded to keep the event loop serving requests
+        return await asyncio.to_thread(
+            self._retrieve,
+            query,
+            query_embedding,
+            collection_name,
+            top_k,
+            score_threshold,
+            hybrid,
+            filters,
+        )
+
+    def _search_by_embedding(
+        self,
+        query_embedding: List[float],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[Context]:
+        return self._collection(collection_name).search(
+            [query_embedding], top_k, score_threshold, filters
+        )[0]
+
+    def _search_many_by_embedding(
+        self,
+        query_embeddings: List[List[float]],
+        collection_name: str,
+        top_k: int,
+        score_threshold: float,
+        filters: Optional[ContextFilter] = None,
+        **kwargs,
+    ) -> List[List[Context]]:
+        return self._collection(collection_name).search(
+            query_embeddings, top_k, score_threshold, filters
+        )
+
+    def get_by_ids(self, collection_name: str, ids: List[int]) -> List[Context]:
+        return self._collection(collection_name).get(ids)
+
+    def delete_doc(self, collection_name: str, file_name: str):
+        self._collection(collection_name).delete_file(file_name)
+        self.lexical_index(collection_name).delete_file(file_name)
+
+    def save_vector_store(self):
+        with self._lock:
+            collections = list(self._collections.values())
+        for collection in collections:
+            collection.save(0)
+
+    def close(self):
+        self.save_vector_store()
+        with self._lock:
+            self._collections.clear()
@@ -0,0 +1,67 @@
+from typing import List, Union
+
+import numpy as np
+
+VECTOR_PRECISIONS = ("float32", "float16", "bfloat16", "int8", "binary")
+
+
+def to_bfloat16(vectors: np.ndarray) -> np.ndarray:
+    """bfloat16 bits of float32 vectors as uint16, rounded to nearest even"""
+    bits = np.ascontiguousarray(vectors, dtype=np.float32).view(np.uint32)
+    rounded = bits + 0x7FFF + ((bits >> 16) & 1)
+    return (rounded >> 16).astype(np.uint16)
+
+
+def to_int8(vectors: np.ndarray) -> np.ndarray:
+    """
+    Symmetric scalar quantization with one scale per vector. Cosine similarity
+    ignores the scale, so vectors are not rescaled back.
+    """
+    scale = np.abs(vectors).max(axis=1, keepdims=True)
+    scale[scale == 0] = 1.0
+    return np.rint(vectors / scale * 127).astype(np.int8)
+
+
+def to_binary(vectors: np.ndarray) -> np.ndarray:
+    """Sign bits packed 8 per byte, compared by hamming distance"""
+    if vectors.shape[1] % 8:
+        raise ValueError(
+            f"Binary codes need a dim multiple of 8, got {vectors.shape[1]}"
+        )
+    return np.packbits(vectors > 0, axis=1)
+
+
+def quantize(
+    vectors: List[List[float]], precision: str
+) -> List[Union[np.ndarray, bytes]]:
+    """
+    Each vector at the given precision, as passed to Milvus. Typed numpy rows
+    tell pymilvus the vector type, raw bytes are taken as binary vectors.
+    """
+    array = np.asarray(vectors, dtype=np.float32)
+    if precision == "float16":
+        codes = array.astype(np.float16)
+    elif precision == "bfloat16":
+        try:
+            from ml_dtypes import bfloat16
+        except ImportError:
+            raise ImportError(
+                "ml_dtypes is required by bfloat16 vectors: pip install ml_dtypes"
+            )
+
+        codes = to_bfloat16(array).view(bfloat16)
+    elif precision == "int8":
+        codes = to_int8(array)
+    elif precision == "binary":
+        return [row.tobytes() for row in to_binary(array)]
+    else:
+        raise ValueError(f"Unsupported vector precision {precision}")
+    return list(codes)
+
+
+def cosine_similarity(query: List[float], vectors: List[List[float]]) -> np.ndarray:
+    """Cosine similarity of the query to each of the vectors, at full precision"""
+    query = np.asarray(query, dtype=np.float32)
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, query.shape[0])
+    norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(query) or 1.0)
+    return matrix @ query / np.where(norms == 0, 1.0, norms)
@@ -1,6 +1,9 @@
-from typing import Dict, List, Union
+import asyncio
+import threading
+from typing import AsyncIterator, Dict, List, Tuple, Union
 
-from rag.server.llm.utils import get_model_configs
+from rag.server.llm.utils import get_all_model_configs, get_model_configs
+from rag.server.models.model_spec import ChatChunk
 
 
 class LLM:
@@ -10,12 +13,81 @@ class LLM:
     def embed(self, contents: Union[List[str], str], **kwargs) -> List[List[float]]:
         raise NotImplementedError
 
+    async def achat(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        return await asyncio.to_thread(self.chat, messages, **kwargs)
+
+    async def astream_chat(
+        self, messages: List[Dict[str, str]], **kwargs
+    ) -> AsyncIterator[ChatChunk]:
+        yield ChatChunk(content=await self.achat(messages, **kwargs))
+
+    async def aembed(
+        self, contents: Union[List[str], str], **kwargs
+    ) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed, contents, **kwargs)
+
+    def rerank(self, query: str, documents: List[str], **kwargs) -> List[float]:
+        """Relevance score of each document to the query, in input order"""
+        raise NotImplementedError
+
+    async def arerank(self, query: str, documents: List[str], **kwargs) -> List[float]:
+        return await asyncio.to_thread(self.rerank, query, documents, **kwargs)
+
+    def close(self):
+        pass
+
+    async def aclose(self):
+        self.close()
+
 
 class LLMFactory:
+    # llm services keep an HTTP connection pool, so they are built once per model
+    _services: Dict[Tuple[str, str], LLM] = {}
+    _lock = threading.Lock()
+
     @staticmethod
     def get_llm_service(model_name: str, platform_name: str = None) -> LLM:
-        model_config = get_model_configs(model_name, platform_name)
-        from rag.server.llm.proxy_llm import PlatformLLM
+        """
+        The service of a model on the given platform, or a router over every
+        platform serving the model
+        """
+        key = (model_name, platform_name)
+        with LLMFactory._lock:
+            llm_service = LLMFactory._services.get(key)
+            if llm_service is None:
+                from rag.server.llm.proxy_llm import PlatformLLM
+
+                if platform_name is not None:
+                    model_configs = [get_model_configs(model_name, platform_name)]
+                else:
+                    model_configs = get_all_model_configs(model_name)
+                if len(model_configs) == 1:
+                    llm_service = PlatformLLM(model_configs[0])
+                else:
+                    from rag.server.llm.router import RouterLLM
 
-        llm_service = PlatformLLM(model_config)
+                    llm_service = RouterLLM(model_configs)
+                LLMFactory._services[key] = llm_service
         return llm_service
+
+    @staticmethod
+    def close():
+        with LLMFactory._lock:
+            services = list(LLMFactory._services.values())
+            LLMFactory._services.clear()
+        for llm_service in services:
+            llm_service.close()
+        from rag.server.llm.client import PlatformClient
+
+        PlatformClient.close()
+
+    @staticmethod
+    async def aclose():
+        with LLMFactory._lock:
+            services = list(LLMFactory._services.values())
+            LLMFactory._services.clear()
+        for llm_service in services:
+            await llm_service.aclose()
+        from rag.server.llm.client import PlatformClient
+
+        await PlatformClient.aclose()
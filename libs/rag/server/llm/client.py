@@ -0,0 +1,412 @@
+import asyncio
+import random
+import threading
+import time
+import weakref
+from email.utils import parsedate_to_datetime
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    ClassVar,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+import httpx
+import openai
+from rag.server.models.model_spec import ModelConfig
+from rag.settings import PlatformConfig, Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+RETRYABLE_STATUS = {408, 409, 429}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a platform whose circuit breaker is open"""
+
+
+class TokenBucket:
+    """
+    Request rate limiter refilled at ``rate`` tokens per second up to ``burst``.
+    Callers reserve a token and wait until it is due, so waiting callers are
+    served in arrival order. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Take a token, return the seconds to wait before using it"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            self._tokens -= 1
+            return max(-self._tokens / self.rate, 0.0)
+
+    def acquire(self):
+        if self.rate > 0:
+            delay = self._reserve()
+            if delay:
+                time.sleep(delay)
+
+    async def aacquire(self):
+        if self.rate > 0:
+            delay = self._reserve()
+            if delay:
+                await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """
+    Fail fast while a platform is down. The circuit opens after
+    ``failure_threshold`` consecutive provider failures (connection errors,
+    timeouts, 5xx), then after ``reset_timeout`` seconds lets one trial call
+    through (half-open): its success closes the circuit, its failure reopens it.
+    A trial ending without a verdict, cancelled or failing on the client side,
+    is ended by ``end_trial`` so the next call becomes the trial.
+    A threshold of 0 disables the breaker.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def allow(self) -> bool:
+        """Raise if the circuit is open, True if the call is the half-open trial"""
+        with self._lock:
+            if self._opened_at is None:
+                return False
+            waited = time.monotonic() - self._opened_at
+            if waited < self.reset_timeout or self._trial:
+                raise CircuitOpenError(
+                    f"Platform {self.name} is unavailable, circuit breaker is open"
+                )
+            self._trial = True
+            return True
+
+    def end_trial(self, trial: bool):
+        """Let another call through after a trial ended without a verdict"""
+        if trial:
+            with self._lock:
+                self._trial = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            half_open = self._trial
+            self._trial = False
+            if self.failure_threshold <= 0:
+                return
+            if half_open or self._failures >= self.failure_threshold:
+                if self._opened_at is None or half_open:
+                    logger.error(f"Circuit breaker of platform {self.name} opened")
+                self._opened_at = time.monotonic()
+
+
+def is_retryable(e: Exception) -> bool:
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in RETRYABLE_STATUS or e.status_code >= 500
+    return False
+
+
+def is_provider_failure(e: Exception) -> bool:
+    """Errors meaning the platform is unhealthy, as opposed to a rejected request"""
+    if isinstance(e, openai.APIConnectionError):
+        return True
+    return isinstance(e, openai.APIStatusError) and e.status_code >= 500
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    """Seconds asked by the Retry-After(-Ms) header of an error response"""
+    response = getattr(e, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+class PlatformClient:
+    """
+    HTTP clients and resilience policy shared by every model of a platform:
+    a tuned connection pool, retries with exponential backoff and full jitter
+    (honoring Retry-After), a concurrency limit, a token-bucket rate limit and
+    a circuit breaker. Failures surviving the retries are raised.
+    """
+
+    _clients: ClassVar[Dict[Tuple[str, str, str], "PlatformClient"]] = {}
+    _clients_lock: ClassVar[threading.Lock] = threading.Lock()
+
+    def __init__(self, config: PlatformConfig):
+        self.config = config
+        self.name = config.PLATFORM_NAME
+        timeout = httpx.Timeout(config.TIMEOUT, connect=config.CONNECT_TIMEOUT)
+        limits = httpx.Limits(
+            max_connections=config.MAX_CONNECTIONS,
+            max_keepalive_connections=config.MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.KEEPALIVE_EXPIRY,
+        )
+        # retries are handled here, so the SDK does not retry on its own
+        self.client = openai.Client(
+            api_key=config.API_KEY,
+            base_url=config.API_BASE_URL,
+            timeout=timeout,
+            max_retries=0,
+            http_client=httpx.Client(limits=limits, timeout=timeout),
+        )
+        self.async_client = openai.AsyncClient(
+            api_key=config.API_KEY,
+            base_url=config.API_BASE_URL,
+            timeout=timeout,
+            max_retries=0,
+            http_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+        )
+        self.bucket = TokenBucket(config.RATE_LIMIT, config.RATE_BURST)
+        self.breaker = CircuitBreaker(
+            self.name, config.BREAKER_FAILURE_THRESHOLD, config.BREAKER_RESET_TIMEOUT
+        )
+        self._semaphore = threading.BoundedSemaphore(config.MAX_CONCURRENCY)
+        # asyncio semaphores are bound to the loop they are first used in
+        self._async_semaphores: "weakref.WeakKeyDictionary" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._stats_lock = threading.Lock()
+        self._requests = 0
+        self._retries = 0
+        self._failures = 0
+
+    @classmethod
+    def get(cls, model_config: ModelConfig) -> "PlatformClient":
+        """The client of the platform of a model, built on first use"""
+        key = (
+            model_config.platform_name,
+            model_config.api_base_url,
+            model_config.api_key,
+        )
+        with cls._clients_lock:
+            client = cls._clients.get(key)
+            if client is None:
+                config = next(
+                    (
+                        p
+                        for p in Settings.model_settings.MODEL_PLATFORMS
+                        if p.PLATFORM_NAME == model_config.platform_name
+                    ),
+                    PlatformConfig(PLATFORM_NAME=model_config.platform_name),
+                )
+                config = config.model_copy(
+                    update={
+                        "API_BASE_URL": model_config.api_base_url,
+                        "API_KEY": model_config.api_key,
+                    }
+                )
+                client = cls._clients[key] = cls(config)
+        return client
+
+    def _async_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        semaphore = self._async_semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.config.MAX_CONCURRENCY)
+            self._async_semaphores[loop] = semaphore
+        return semaphore
+
+    def _backoff(self, e: Exception, attempt: int, max_retries: int = None) -> float:
+        """
+        Seconds to wait before retrying after ``e``, the error is recorded by
+        the breaker and raised if it is not retryable or retries are exhausted
+        """
+        if max_retries is None:
+            max_retries = self.config.MAX_RETRIES
+        if is_provider_failure(e):
+            self.breaker.record_failure()
+        elif isinstance(e, openai.APIStatusError):
+            # the platform answered, only the request was refused
+            self.breaker.record_success()
+        if not is_retryable(e) or attempt >= max_retries:
+            with self._stats_lock:
+                self._failures += 1
+            logger.error(f"{e.__class__.__name__}: Request to {self.name} failed: {e}")
+            raise e
+        backoff = self.config.RETRY_BACKOFF * 2**attempt
+        delay = random.uniform(0, min(self.config.RETRY_BACKOFF_MAX, backoff))
+        requested = retry_after(e)
+        if requested is not None:
+            delay = min(max(delay, requested), self.config.RETRY_BACKOFF_MAX)
+        with self._stats_lock:
+            self._retries += 1
+        logger.warning(
+            f"{e.__class__.__name__}: Request to {self.name} failed, "
+            f"retry {attempt + 1}/{max_retries} in {delay:.2f}s"
+        )
+        return delay
+
+    def call(
+        self, func: Callable[..., Any], max_retries: int = None, **kwargs
+    ) -> Any:
+        attempt = 0
+        while True:
+            trial = self.breaker.allow()
+            try:
+                self.bucket.acquire()
+                with self._stats_lock:
+                    self._requests += 1
+                try:
+                    with self._semaphore:
+                        result = func(**kwargs)
+                except Exception as e:
+                    delay = self._backoff(e, attempt, max_retries)
+                else:
+                    self.breaker.record_success()
+                    return result
+            finally:
+                self.breaker.end_trial(trial)
+            time.sleep(delay)
+            attempt += 1
+
+    async def acall(
+        self, func: Callable[..., Awaitable], max_retries: int = None, **kwargs
+    ) -> Any:
+        attempt = 0
+        while True:
+            trial = self.breaker.allow()
+            try:
+                await self.bucket.aacquire()
+                with self._stats_lock:
+                    self._requests += 1
+                try:
+                    async with self._async_semaphore():
+                        result = await func(**kwargs)
+                except Exception as e:
+                    delay = self._backoff(e, attempt, max_retries)
+                else:
+                    self.breaker.record_success()
+                    return result
+            finally:
+                self.breaker.end_trial(trial)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def astream(
+        self,
+        func: Callable[..., Awaitable[AsyncIterator]],
+        max_retries: int = None,
+        **kwargs,
+    ) -> AsyncIterator:
+        """
+        Iterate a streaming response. The request is retried until the stream
+        is opened, then it holds a concurrency slot until it is consumed.
+        """
+        attempt = 0
+        while True:
+            trial = self.breaker.allow()
+            opened = False
+            try:
+                await self.bucket.aacquire()
+                with self._stats_lock:
+                    self._requests += 1
+                semaphore = self._async_semaphore()
+                await semaphore.acquire()
+                try:
+                    stream = await func(**kwargs)
+                    opened = True
+                except Exception as e:
+                    delay = self._backoff(e, attempt, max_retries)
+                finally:
+                    # once opened, the slot and the trial are handed to the stream
+                    if not opened:
+                        semaphore.release()
+            finally:
+                if not opened:
+                    self.breaker.end_trial(trial)
+            if opened:
+                break
+            await asyncio.sleep(delay)
+            attempt += 1
+        try:
+            async for chunk in stream:
+                yield chunk
+            self.breaker.record_success()
+        except Exception as e:
+            if is_provider_failure(e):
+                self.breaker.record_failure()
+            raise
+        finally:
+            semaphore.release()
+            self.breaker.end_trial(trial)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return {
+                "requests": self._requests,
+                "retries": self._retries,
+                "failures": self._failures,
+                "breaker": self.breaker.state,
+            }
+
+    @classmethod
+    def all_stats(cls) -> Dict[str, Dict[str, Any]]:
+        with cls._clients_lock:
+            clients = list(cls._clients.values())
+        return {client.name: client.stats() for client in clients}
+
+    @classmethod
+    def close(cls):
+        with cls._clients_lock:
+            clients = list(cls._clients.values())
+            cls._clients.clear()
+        for client in clients:
+            client.client.close()
+
+    @classmethod
+    async def aclose(cls):
+        with cls._clients_lock:
+            clients = list(cls._clients.values())
+            cls._clients.clear()
+        for client in clients:
+            await client.async_client.close()
+            client.client.close()
@@ -0,0 +1,306 @@
+import asyncio
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from rag.server.metrics import count_cache
+from rag.settings import Settings
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class _DiskTier:
+    """sqlite table of float32 embeddings, trimmed to the least recently used rows"""
+
+    def __init__(self, path: Path, max_size: int, ttl: float):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embedding ("
+            "key TEXT PRIMARY KEY, vector BLOB, created REAL, accessed REAL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS embedding_accessed ON embedding (accessed)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[array]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, created FROM embedding WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl and now - row[1] > self.ttl:
+                self._conn.execute("DELETE FROM embedding WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            self._conn.execute(
+                "UPDATE embedding SET accessed = ? WHERE key = ?", (now, key)
+            )
+            self._conn.commit()
+        vector = array("f")
+        vector.frombytes(row[0])
+        return vector
+
+    def put(self, key: str, vector: array):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO embedding VALUES (?, ?, ?, ?)",
+                (key, vector.tobytes(), now, now),
+            )
+            self._puts += 1
+            # trimming needs a table scan, so it only runs every few hundred writes
+            if self._puts % 256 == 0:
+                self._conn.execute(
+                    "DELETE FROM embedding WHERE key IN (SELECT key FROM embedding "
+                    "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                    (self.max_size,),
+                )
+            self._conn.commit()
+
+    def size(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of query embeddings keyed by (embed model, context window, text).
+
+    The memory tier is an LRU with TTL, the optional disk tier is a sqlite file
+    under ``BasicSettings.DATA_PATH`` that survives restarts. Texts are NFKC
+    normalized and whitespace collapsed before hashing.
+    """
+
+    def __init__(
+        self,
+        max_size: int = None,
+        ttl: float = None,
+        disk: bool = None,
+        disk_size: int = None,
+        disk_path: Path = None,
+    ):
+        model_settings = Settings.model_settings
+        self.max_size = model_settings.EMBED_CACHE_SIZE if max_size is None else max_size
+        self.ttl = model_settings.EMBED_CACHE_TTL if ttl is None else ttl
+        if disk is None:
+            disk = model_settings.EMBED_CACHE_DISK
+        if disk_size is None:
+            disk_size = model_settings.EMBED_CACHE_DISK_SIZE
+        if disk_path is None:
+            disk_path = Settings.basic_settings.DATA_PATH / "cache" / "embedding.sqlite3"
+        self._memory: "OrderedDict[str, tuple[float, array]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = _DiskTier(Path(disk_path), disk_size, self.ttl) if disk else None
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 or self._disk is not None
+
+    @staticmethod
+    def make_key(model: str, context_window: int, text: str) -> str:
+        raw = f"{model}\0{context_window}\0{normalize_text(text)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[List[float]]:
+        now = time.time()
+        vector = None
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                created, vector = item
+                if self.ttl and now - created > self.ttl:
+                    del self._memory[key]
+                    vector = None
+                else:
+                    self._memory.move_to_end(key)
+                    self._hits += 1
+        if vector is not None:
+            count_cache("embedding", "hit")
+            return vector.tolist()
+        if self._disk is not None:
+            vector = self._disk.get(key)
+            if vector is not None:
+                self._put_memory(key, vector)
+                with self._lock:
+                    self._disk_hits += 1
+                count_cache("embedding", "disk_hit")
+                return vector.tolist()
+        with self._lock:
+            self._misses += 1
+        count_cache("embedding", "miss")
+        return None
+
+    def put(self, key: str, embedding: List[float]):
+        vector = array("f", embedding)
+        self._put_memory(key, vector)
+        if self._disk is not None:
+            self._disk.put(key, vector)
+
+    def _put_memory(self, key: str, vector: array):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._memory[key] = (time.time(), vector)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def embed(
+        self,
+        embed_func: Callable[[str], List[float]],
+        model: str,
+        context_window: int,
+        text: str,
+    ) -> List[float]:
+        if not self.enabled:
+            return embed_func(text)
+        key = self.make_key(model, context_window, text)
+        embedding = self.get(key)
+        if embedding is None:
+            embedding = embed_func(text)
+            if embedding is not None:
+                self.put(key, embedding)
+        return embedding
+
+    def embed_many(
+        self,
+        embed_func: Callable[[List[str]], List[List[float]]],
+        model: str,
+        context_window: int,
+        texts: List[str],
+        batch_size: int = None,
+    ) -> List[Optional[List[float]]]:
+        """Embed texts in input order, cache misses are sent in batched requests"""
+        batch_size = batch_size or Settings.kb_settings.EMBED_BATCH_SIZE
+        keys = [self.make_key(model, context_window, text) for text in texts]
+        if self.enabled:
+            embeddings = [self.get(key) for key in keys]
+        else:
+            embeddings = [None] * len(texts)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start : start + batch_size]
+            results = embed_func([texts[i] for i in batch])
+            if results is None:
+                continue
+            for i, embedding in zip(batch, results):
+                embeddings[i] = embedding
+                if self.enabled:
+                    self.put(keys[i], embedding)
+        return embeddings
+
+    async def aembed(
+        self,
+        aembed_func: Callable[[str], Awaitable[List[float]]],
+        model: str,
+        context_window: int,
+        text: str,
+    ) -> List[float]:
+        if not self.enabled:
+            return await aembed_func(text)
+        key = self.make_key(model, context_window, text)
+        embedding = self.get(key)
+        if embedding is None:
+            embedding = await aembed_func(text)
+            if embedding is not None:
+                self.put(key, embedding)
+        return embedding
+
+    async def aembed_many(
+        self,
+        aembed_func: Callable[[List[str]], Awaitable[List[List[float]]]],
+        model: str,
+        context_window: int,
+        texts: List[str],
+        batch_size: int = None,
+        concurrency: int = None,
+    ) -> List[Optional[List[float]]]:
+        """
+        Embed texts in input order, cache misses are sent in batched requests,
+        ``concurrency`` of them at a time. Texts of a failed batch are None.
+        """
+        kb_settings = Settings.kb_settings
+        batch_size = batch_size or kb_settings.EMBED_BATCH_SIZE
+        semaphore = asyncio.Semaphore(concurrency or kb_settings.EMBED_CONCURRENCY)
+        keys = [self.make_key(model, context_window, text) for text in texts]
+        if self.enabled:
+            embeddings = [self.get(key) for key in keys]
+        else:
+            embeddings = [None] * len(texts)
+        # a text repeated in the input is embedded once
+        missing: Dict[str, List[int]] = {}
+        for i, embedding in enumerate(embeddings):
+            if embedding is None:
+                missing.setdefault(keys[i], []).append(i)
+        pending = list(missing.values())
+
+        async def embed_batch(batch: List[List[int]]):
+            async with semaphore:
+                results = await aembed_func([texts[indexes[0]] for indexes in batch])
+            if results is None:
+                return
+            for indexes, embedding in zip(batch, results):
+                for i in indexes:
+                    embeddings[i] = embedding
+                if self.enabled:
+                    self.put(keys[indexes[0]], embedding)
+
+        await asyncio.gather(
+            *[
+                embed_batch(pending[start : start + batch_size])
+                for start in range(0, len(pending), batch_size)
+            ]
+        )
+        return embeddings
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self._hits + self._disk_hits + self._misses
+            return {
+                "size": len(self._memory),
+                "max_size": self.max_size,
+                "disk_size": self._disk.size() if self._disk is not None else None,
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_ratio": (self._hits + self._disk_hits) / total if total else 0.0,
+            }
+
+
+embed_cache = EmbeddingCache()
@@ -1,65 +1,113 @@
-import json
-from time import sleep
-from typing import Callable, Dict, List, Union
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Union
 
-import openai
 from rag.server.llm.base import LLM
-from rag.server.models.model_spec import ModelConfig
+from rag.server.llm.client import PlatformClient
+from rag.server.metrics import observe_embed_batch, observe_llm, observe_tokens
+from rag.server.models.model_spec import ChatChunk, ModelConfig
 from rag.settings import Settings
 from rag.utils import build_logger
 
-SLEEP_SEC = 3
 logger = build_logger()
 
 
 class PlatformLLM(LLM):
-    def __init__(self, model_config: ModelConfig):
-        self.client = openai.Client(
-            api_key=model_config.api_key,
-            base_url=model_config.api_base_url,
-        )
+    """
+    Model of an OpenAI compatible platform. Requests go through the
+    PlatformClient shared by the models of the platform, failures surviving
+    its retries (MAX_RETRIES of the platform unless ``max_retries`` is given)
+    are raised.
+    """
+
+    def __init__(self, model_config: ModelConfig, max_retries: int = None):
+        self.platform = PlatformClient.get(model_config)
+        self.client = self.platform.client
+        self.async_client = self.platform.async_client
         self.model_config = model_config
+        self.max_retries = max_retries
 
     def chat(self, messages: List[Dict[str, str]], **kwargs) -> str:
-        return self._call(self._chat, messages=messages, **kwargs)
+        return self._call("chat", self._chat, messages=messages, **kwargs)
 
     def embed(self, content: Union[str, List[str]], **kwargs) -> List[float]:
-        return self._call(self._embed, content=content, **kwargs)
+        return self._call("embed", self._embed, content=content, **kwargs)
 
-    def _call(self, func: Callable, **kwargs) -> str:
+    async def achat(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        return await self._acall("chat", self._achat, messages=messages, **kwargs)
+
+    async def astream_chat(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = Settings.model_settings.TEMPERATURE,
+        max_tokens: int = Settings.model_settings.MAX_TOKENS,
+    ) -> AsyncIterator[ChatChunk]:
+        response = self.platform.astream(
+            self.async_client.chat.completions.create,
+            max_retries=self.max_retries,
+            model=self.model_config.model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        start, error = time.perf_counter(), True
         try:
-            response = func(**kwargs)
-            return response
-        except openai.BadRequestError as e:
-            err = json.loads(e.response.text)
-            if err["error"]["code"] == "content_filter":
-                logger.error("Content filter triggered!")
-                return None
-            logger.error(f"API request was invalid: {e}")
-            return None
-        except openai.APIConnectionError as e:
-            logger.error(f"API connection failed: {e}")
-            return None
-        except openai.RateLimitError as e:
-            logger.error(
-                f"Token rate limit exceeded. Retrying after {SLEEP_SEC} second..."
+            async for chunk in response:
+                usage = None
+                if chunk.usage:
+                    observe_tokens(self.model_config, chunk.usage)
+                    usage = {
+                        "prompt_tokens": chunk.usage.prompt_tokens,
+                        "completion_tokens": chunk.usage.completion_tokens,
+                        "total_tokens": chunk.usage.total_tokens,
+                    }
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if content or usage:
+                    yield ChatChunk(content=content or "", usage=usage)
+            error = False
+        finally:
+            seconds = time.perf_counter() - start
+            observe_llm(self.model_config, "stream_chat", seconds, error)
+
+    async def aembed(self, content: Union[str, List[str]], **kwargs) -> List[float]:
+        return await self._acall("embed", self._aembed, content=content, **kwargs)
+
+    def rerank(self, query: str, documents: List[str], **kwargs) -> List[float]:
+        return self._call(
+            "rerank", self._rerank, query=query, documents=documents, **kwargs
+        )
+
+    async def arerank(self, query: str, documents: List[str], **kwargs) -> List[float]:
+        return await self._acall(
+            "rerank", self._arerank, query=query, documents=documents, **kwargs
+        )
+
+    def close(self):
+        # the HTTP clients belong to the platform, they are closed with it
+        pass
+
+    def _call(self, method: str, func: Callable, **kwargs) -> Any:
+        start, error = time.perf_counter(), True
+        try:
+            result = self.platform.call(func, max_retries=self.max_retries, **kwargs)
+            error = False
+            return result
+        finally:
+            observe_llm(self.model_config, method, time.perf_counter() - start, error)
+
+    async def _acall(
+        self, method: str, func: Callable[..., Awaitable], **kwargs
+    ) -> Any:
+        start, error = time.perf_counter(), True
+        try:
+            result = await self.platform.acall(
+                func, max_retries=self.max_retries, **kwargs
             )
-            sleep(SLEEP_SEC)
-            return func(**kwargs)
-        except openai.APIError as e:
-            if "The operation was timeout" in str(e):
-                # Handle the timeout error here
-                logger.error("API request timed out. Please try again later.")
-                return None
-            elif "DeploymentNotFound" in str(e):
-                logger.error("The API deployment for this resource does not exist")
-                return None
-            else:
-                # Handle other API errors here
-                logger.error(f"The OpenAI API returned an error: {e}")
-                return None
-        except Exception as e:
-            logger.error(f"An error occurred: {e}")
+            error = False
+            return result
+        finally:
+            observe_llm(self.model_config, method, time.perf_counter() - start, error)
 
     def _chat(
         self,
@@ -73,6 +121,22 @@ class PlatformLLM(LLM):
             temperature=temperature,
             max_tokens=max_tokens,
         )
+        observe_tokens(self.model_config, response.usage)
+        return response.choices[0].message.content
+
+    async def _achat(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = Settings.model_settings.TEMPERATURE,
+        max_tokens: int = Settings.model_settings.MAX_TOKENS,
+    ) -> str:
+        response = await self.async_client.chat.completions.create(
+            model=self.model_config.model_name,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        observe_tokens(self.model_config, response.usage)
         return response.choices[0].message.content
 
     def _embed(
@@ -82,10 +146,71 @@ class PlatformLLM(LLM):
     ) -> Union[List[float], List[List[float]]]:
         if isinstance(content, List):
             content = [c[:context_window] for c in content]
+        observe_embed_batch(self.model_config, self._batch_size(content))
         embedding = self.client.embeddings.create(
             input=content,
             model=self.model_config.model_name,
         )
+        observe_tokens(self.model_config, embedding.usage)
+        return self._parse_embedding(content, embedding)
+
+    async def _aembed(
+        self,
+        content: Union[str, List[str]],
+        context_window: int = Settings.model_settings.DEFAULT_EMBEDDING_CONTEXT_WINDOW,
+    ) -> Union[List[float], List[List[float]]]:
+        if isinstance(content, List):
+            content = [c[:context_window] for c in content]
+        observe_embed_batch(self.model_config, self._batch_size(content))
+        embedding = await self.async_client.embeddings.create(
+            input=content,
+            model=self.model_config.model_name,
+        )
+        observe_tokens(self.model_config, embedding.usage)
+        return self._parse_embedding(content, embedding)
+
+    def _rerank(self, query: str, documents: List[str]) -> List[float]:
+        # the openai SDK has no rerank resource, the request goes through its
+        # generic post so it shares the connection pool and auth of the client
+        response = self.client.post(
+            "/rerank",
+            body=self._rerank_body(query, documents),
+            cast_to=object,
+        )
+        return self._parse_rerank(documents, response)
+
+    async def _arerank(self, query: str, documents: List[str]) -> List[float]:
+        response = await self.async_client.post(
+            "/rerank",
+            body=self._rerank_body(query, documents),
+            cast_to=object,
+        )
+        return self._parse_rerank(documents, response)
+
+    def _rerank_body(self, query: str, documents: List[str]) -> Dict:
+        return {
+            "model": self.model_config.model_name,
+            "query": query,
+            "documents": documents,
+            "return_documents": False,
+        }
+
+    @staticmethod
+    def _parse_rerank(documents: List[str], response: Dict) -> List[float]:
+        """Results of the /rerank endpoint come sorted by score, restore input order"""
+        scores = [0.0] * len(documents)
+        for result in response["results"]:
+            scores[result["index"]] = result["relevance_score"]
+        return scores
+
+    @staticmethod
+    def _batch_size(content: Union[str, List[str]]) -> int:
+        return 1 if isinstance(content, str) else len(content)
+
+    @staticmethod
+    def _parse_embedding(
+        content: Union[str, List[str]], embedding
+    ) -> Union[List[float], List[List[float]]]:
         if isinstance(content, str):
             return embedding.data[0].embedding
         else:
@@ -0,0 +1,192 @@
+import random
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+from rag.server.llm.base import LLM
+from rag.server.llm.client import CircuitOpenError, is_retryable
+from rag.server.llm.proxy_llm import PlatformLLM
+from rag.server.models.model_spec import ChatChunk, ModelConfig
+from rag.settings import Settings
+from rag.utils import build_logger
+
+logger = build_logger()
+
+# smoothing factor of the latency moving average
+LATENCY_ALPHA = 0.2
+# min latency sample recorded for a failed request, so failing platforms are
+# avoided by the latency strategy until they answer again
+FAILURE_LATENCY = 1.0
+
+
+def should_fail_over(e: Exception) -> bool:
+    """Errors another platform may not have: outages, timeouts, 429 and 5xx"""
+    return isinstance(e, CircuitOpenError) or is_retryable(e)
+
+
+class _Backend:
+    def __init__(self, model_config: ModelConfig):
+        self.name = model_config.platform_name
+        self.weight = max(model_config.weight, 0.0)
+        self.llm = PlatformLLM(model_config)
+        # tried before failing over to the next platform, so it does not retry
+        self.failover_llm = PlatformLLM(model_config, max_retries=0)
+        # moving average of the latency, None until the first response
+        self.latency: Optional[float] = None
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def available(self) -> bool:
+        return self.llm.platform.breaker.state != "open"
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "weight": self.weight,
+            "latency": self.latency,
+            "requests": self.requests,
+            "failures": self.failures,
+            "breaker": self.llm.platform.breaker.state,
+        }
+
+
+class RouterLLM(LLM):
+    """
+    Model served by several platforms. Each request goes to a platform picked
+    by weight (``weighted``) or by the power of two choices over weighted
+    latency moving averages (``latency``), and fails over to the other
+    platforms on outages, timeouts, 429 and 5xx. Platforms whose circuit
+    breaker is open are skipped while another one is available. Only the
+    last platform tried retries with backoff.
+    """
+
+    def __init__(self, model_configs: List[ModelConfig], strategy: str = None):
+        self.model_name = model_configs[0].model_name
+        self.backends = [_Backend(config) for config in model_configs]
+        self.strategy = strategy or Settings.model_settings.ROUTER_STRATEGY
+        self._lock = threading.Lock()
+
+    def _pick(self, backends: List[_Backend]) -> _Backend:
+        weights = [b.weight for b in backends]
+        if not any(weights):
+            weights = [1.0] * len(backends)
+        if self.strategy == "latency" and len(backends) > 1:
+            first, second = random.choices(backends, weights, k=2)
+            # platforms not measured yet win, so every platform gets probed
+            return min(
+                (first, second), key=lambda b: (b.latency or 0.0) / (b.weight or 1.0)
+            )
+        return random.choices(backends, weights)[0]
+
+    def _order(self) -> List[_Backend]:
+        """
+        Platforms in the order they are tried for one request. Platforms whose
+        breaker is open are left out while another one is available, so the
+        last available platform is the one retrying.
+        """
+        with self._lock:
+            available = [b for b in self.backends if b.available]
+            if not available:
+                # all open, the calls fail fast with CircuitOpenError
+                available = list(self.backends)
+            ordered = []
+            while available:
+                backend = self._pick(available)
+                available.remove(backend)
+                ordered.append(backend)
+            return ordered
+
+    def _record(self, backend: _Backend, elapsed: float, failed: bool = False):
+        with self._lock:
+            backend.requests += 1
+            if failed:
+                backend.failures += 1
+                elapsed = max(elapsed, FAILURE_LATENCY)
+            if backend.latency is None:
+                backend.latency = elapsed
+            else:
+                backend.latency += LATENCY_ALPHA * (elapsed - backend.latency)
+
+    def _candidates(self):
+        order = self._order()
+        for i, backend in enumerate(order):
+            last = i == len(order) - 1
+            yield backend, backend.llm if last else backend.failover_llm, last
+
+    def _on_failure(self, backend: _Backend, e: Exception, last: bool):
+        if last or not should_fail_over(e):
+            raise e
+        logger.warning(
+            f"{e.__class__.__name__}: {self.model_name} on {backend.name} failed, "
+            "fail over to the next platform"
+        )
+
+    def _route(self, method: str, *args, **kwargs) -> Any:
+        for backend, llm, last in self._candidates():
+            start = time.perf_counter()
+            try:
+                result = getattr(llm, method)(*args, **kwargs)
+            except Exception as e:
+                self._record(backend, time.perf_counter() - start, failed=True)
+                self._on_failure(backend, e, last)
+                continue
+            self._record(backend, time.perf_counter() - start)
+            return result
+
+    async def _aroute(self, method: str, *args, **kwargs) -> Any:
+        for backend, llm, last in self._candidates():
+            start = time.perf_counter()
+            try:
+                result = await getattr(llm, method)(*args, **kwargs)
+            except Exception as e:
+                self._record(backend, time.perf_counter() - start, failed=True)
+                self._on_failure(backend, e, last)
+                continue
+            self._record(backend, time.perf_counter() - start)
+            return result
+
+    def chat(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        return self._route("chat", messages, **kwargs)
+
+    def embed(self, content: Union[str, List[str]], **kwargs) -> List[float]:
+        return self._route("embed", content, **kwargs)
+
+    def rerank(self, query: str, documents: List[str], **kwargs) -> List[float]:
+        return self._route("rerank", query, documents, **kwargs)
+
+    async def achat(self, messages: List[Dict[str, str]], **kwargs) -> str:
+        return await self._aroute("achat", messages, **kwargs)
+
+    async def aembed(self, content: Union[str, List[str]], **kwargs) -> List[float]:
+        return await self._aroute("aembed", content, **kwargs)
+
+    async def arerank(self, query: str, documents: List[str], **kwargs) -> List[float]:
+        return await self._aroute("arerank", query, documents, **kwargs)
+
+    async def astream_chat(
+        self, messages: List[Dict[str, str]], **kwargs
+    ) -> AsyncIterator[ChatChunk]:
+        """Fail over until the first chunk, a stream is not resumed elsewhere"""
+        for backend, llm, last in self._candidates():
+            start = time.perf_counter()
+            stream = llm.astream_chat(messages, **kwargs)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                self._record(backend, time.perf_counter() - start)
+                return
+            except Exception as e:
+                self._record(backend, time.perf_counter() - start, failed=True)
+                await stream.aclose()
+                self._on_failure(backend, e, last)
+                continue
+            # time to first chunk is the latency that matters for streams
+            self._record(backend, time.perf_counter() - start)
+            yield first
+            async for chunk in stream:
+                yield chunk
+            return
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return {b.name: b.stats() for b in self.backends}
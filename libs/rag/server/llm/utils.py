@@ -1,32 +1,69 @@
+import threading
+from typing import Dict, List, Optional, Tuple
+
 from rag.server.models.model_spec import ModelConfig
-from rag.settings import Settings
+from rag.settings import PlatformConfig, Settings
 
+ModelIndex = Dict[str, List[ModelConfig]]
 
-def get_model_configs(model_name: str, platform_name: str = None) -> ModelConfig:
+_index: Optional[Tuple[List[PlatformConfig], ModelIndex]] = None
+_index_lock = threading.Lock()
+
+
+def build_model_index(platforms: List[PlatformConfig]) -> ModelIndex:
+    """Model name -> configs of the platforms serving it, in platform order"""
+    index: ModelIndex = {}
+    for platform in platforms:
+        models = {}
+        for group in (
+            platform.LLM_MODELS,
+            platform.EMBEDDING_MODELS,
+            platform.RERANK_MODELS,
+        ):
+            for model_name, meta_data in group.items():
+                models.setdefault(model_name, meta_data or {})
+        for model_name, meta_data in models.items():
+            index.setdefault(model_name, []).append(
+                ModelConfig(
+                    platform_name=platform.PLATFORM_NAME,
+                    platform_type=platform.PLATFORM_TYPE,
+                    api_base_url=platform.API_BASE_URL,
+                    api_key=platform.API_KEY,
+                    model_name=model_name,
+                    meta_data=meta_data,
+                    weight=platform.WEIGHT,
+                )
+            )
+    return index
+
+
+def model_index() -> ModelIndex:
+    """The model index of MODEL_PLATFORMS, rebuilt when the settings change"""
+    global _index
     platforms = Settings.model_settings.MODEL_PLATFORMS
-    if platform_name is not None:
-        platform = next(p for p in platforms if p.PLATFORM_NAME == platform_name)
-        if platform is None:
-            raise ValueError(f"Platform {platform_name} not found in platforms")
-    else:
-        platform, meta_data = None, {}
-        for p in platforms:
-            for models in (
-                p.LLM_MODELS,
-                p.EMBEDDING_MODELS,
-                p.RERANK_MODELS,
-            ):
-                if model_name in models:
-                    platform = p
-                    meta_data = models.get(model_name)
-        if platform is None:
-            raise ValueError(f"Model {model_name} not found in any platforms")
-
-    return ModelConfig(
-        platform_name=platform.PLATFORM_NAME,
-        platform_type=platform.PLATFORM_TYPE,
-        api_base_url=platform.API_BASE_URL,
-        api_key=platform.API_KEY,
-        model_name=model_name,
-        meta_data=meta_data,
-    )
+    index = _index
+    if index is None or index[0] is not platforms:
+        with _index_lock:
+            index = _index
+            if index is None or index[0] is not platforms:
+                index = _index = (platforms, build_model_index(platforms))
+    return index[1]
+
+
+def get_all_model_configs(model_name: str) -> List[ModelConfig]:
+    """Configs of every platform serving the model"""
+    configs = model_index().get(model_name)
+    if not configs:
+        raise ValueError(f"Model {model_name} not found in any platforms")
+    return configs
+
+
+def get_model_configs(model_name: str, platform_name: str = None) -> ModelConfig:
+    """Config of the model on the given platform, or on the first platform serving it"""
+    configs = get_all_model_configs(model_name)
+    if platform_name is None:
+        return configs[0]
+    for config in configs:
+        if config.platform_name == platform_name:
+            return config
+    raise ValueError(f"Model {model_name} not found in platform {platform_name}")
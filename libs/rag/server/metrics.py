@@ -0,0 +1,175 @@
+"""
+Prometheus metrics of the API server, served at ``/metrics``.
+
+Metrics are plain prometheus_client counters and histograms, an observation
+only takes the lock of its own time series. To run several uvicorn or
+gunicorn workers, point the ``PROMETHEUS_MULTIPROC_DIR`` environment variable
+to an empty directory before the workers start: every worker then writes its
+samples to memory-mapped files there and ``/metrics`` aggregates the files of
+all workers, whichever worker serves the scrape.
+"""
+
+import os
+import time
+from typing import Any, Dict, Optional
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from rag.server.models.model_spec import ModelConfig
+from starlette.responses import Response
+
+# latency buckets in seconds, from an in-memory search to a long generation
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+REQUESTS = Counter(
+    "rag_http_requests_total",
+    "HTTP requests by route, method and status code",
+    ["route", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "rag_http_request_duration_seconds",
+    "HTTP request latency until the response is sent, streams included",
+    ["route", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_LATENCY = Histogram(
+    "rag_request_stage_duration_seconds",
+    "Latency of the stages of a request, as recorded by its RequestTimings",
+    ["kind", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_REQUESTS = Counter(
+    "rag_llm_requests_total",
+    "Model requests by platform, model, method and outcome",
+    ["platform", "model", "method", "status"],
+)
+LLM_LATENCY = Histogram(
+    "rag_llm_request_duration_seconds",
+    "Model request latency, retries included",
+    ["platform", "model", "method"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter(
+    "rag_llm_tokens_total",
+    "Tokens reported by the platforms, prompt (in) and completion (out)",
+    ["platform", "model", "direction"],
+)
+EMBED_BATCH_SIZE = Histogram(
+    "rag_embedding_batch_size",
+    "Texts per embedding request",
+    ["platform", "model"],
+    buckets=BATCH_SIZE_BUCKETS,
+)
+VECTOR_SEARCH_LATENCY = Histogram(
+    "rag_vector_search_duration_seconds",
+    "Vector store search latency, one observation per (batched) search call",
+    ["vs_type"],
+    buckets=LATENCY_BUCKETS,
+)
+CACHE_REQUESTS = Counter(
+    "rag_cache_requests_total",
+    "Cache lookups by cache and result (hit, disk_hit or miss)",
+    ["cache", "result"],
+)
+
+
+def observe_stages(kind: str, stages: Dict[str, float]):
+    for name, seconds in stages.items():
+        STAGE_LATENCY.labels(kind, name).observe(seconds)
+
+
+def observe_llm(model_config: ModelConfig, method: str, seconds: float, error: bool):
+    labels = (model_config.platform_name, model_config.model_name)
+    LLM_REQUESTS.labels(*labels, method, "error" if error else "ok").inc()
+    LLM_LATENCY.labels(*labels, method).observe(seconds)
+
+
+def observe_tokens(model_config: ModelConfig, usage: Optional[Any]):
+    """Count the tokens of an openai usage object, missing usage is ignored"""
+    if usage is None:
+        return
+    labels = (model_config.platform_name, model_config.model_name)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if prompt_tokens:
+        LLM_TOKENS.labels(*labels, "in").inc(prompt_tokens)
+    if completion_tokens:
+        LLM_TOKENS.labels(*labels, "out").inc(completion_tokens)
+
+
+def observe_embed_batch(model_config: ModelConfig, size: int):
+    labels = (model_config.platform_name, model_config.model_name)
+    EMBED_BATCH_SIZE.labels(*labels).observe(size)
+
+
+def count_cache(cache: str, result: str):
+    CACHE_REQUESTS.labels(cache, result).inc()
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware counting requests and timing them until the last body
+    chunk is sent. Requests are labelled by route template, so path parameters
+    do not create new time series, and requests matching no route share the
+    ``unmatched`` label.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            REQUESTS.labels(path, method, str(status)).inc()
+            REQUEST_LATENCY.labels(path, method).observe(time.perf_counter() - start)
+
+
+def metrics() -> Response:
+    """Metrics in the Prometheus text format, of all workers in multiprocess mode"""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
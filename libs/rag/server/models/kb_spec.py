@@ -1,6 +1,6 @@
-from typing import Optional, Union
+from typing import Any, Dict, List, Literal, Optional, Union
 
-from rag.server.pydantic_v2 import BaseModel, Field
+from rag.server.pydantic_v2 import BaseModel, Field, field_validator
 
 
 class ContextMetadata(BaseModel):
@@ -11,8 +11,87 @@ class ContextMetadata(BaseModel):
     end_page: Optional[int] = Field(default=None, description="Content end page")
 
 
+class ContextFilter(BaseModel):
+    """Metadata pre-filter of a search, all the given conditions must hold"""
+
+    series_name: Optional[List[str]] = Field(
+        default=None, description="Keep contexts of one of these series"
+    )
+    file_name: Optional[List[str]] = Field(
+        default=None, description="Keep contexts of one of these files"
+    )
+    title: Optional[List[str]] = Field(
+        default=None, description="Keep contexts with one of these titles"
+    )
+    start_page: Optional[int] = Field(
+        default=None, description="Keep contexts ending on or after this page"
+    )
+    end_page: Optional[int] = Field(
+        default=None, description="Keep contexts starting on or before this page"
+    )
+
+    @field_validator("series_name", "file_name", "title", mode="before")
+    @classmethod
+    def _to_list(cls, value):
+        return [value] if isinstance(value, str) else value
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in self.model_dump().values())
+
+    def matches(self, metadata: ContextMetadata) -> bool:
+        for field in ("series_name", "file_name", "title"):
+            allowed = getattr(self, field)
+            if allowed is not None and getattr(metadata, field) not in allowed:
+                return False
+        # a page range overlaps the filter, contexts without pages are dropped
+        if self.start_page is not None and (
+            metadata.end_page is None or metadata.end_page < self.start_page
+        ):
+            return False
+        if self.end_page is not None and (
+            metadata.start_page is None or metadata.start_page > self.end_page
+        ):
+            return False
+        return True
+
+
 class Context(BaseModel):
     id: Optional[Union[str, int]] = Field(default=None, description="Context ID")
     distance: Optional[float] = Field(default=None, description="Similarity Distance")
     metadata: ContextMetadata = Field(description="Context metadata")
     content: str = Field(description="Context content")
+
+
+class IngestStats(BaseModel):
+    batches: int = Field(default=0, description="Embedding sub-batches sent")
+    embedded: int = Field(default=0, description="Contexts embedded")
+    inserted: int = Field(default=0, description="Contexts inserted")
+    failed: int = Field(default=0, description="Contexts failed to embed or insert")
+    failed_indexes: List[int] = Field(
+        default=[], description="Positions of the failed contexts in the input"
+    )
+    insert_seconds: float = Field(default=0.0, description="Time spent inserting")
+    elapsed: float = Field(default=0.0, description="Wall time of the ingestion")
+    docs_per_sec: float = Field(default=0.0, description="Ingestion throughput")
+
+
+class IngestJob(BaseModel):
+    id: str = Field(description="Job ID")
+    kind: Literal["upload_docs", "add_context"] = Field(description="Job kind")
+    kb_name: str = Field(description="Knowledge base name")
+    collection_name: str = Field(description="Mapped collection name")
+    params: Dict[str, Any] = Field(default={}, description="Ingestion parameters")
+    status: Literal["queued", "running", "succeeded", "failed", "cancelled"] = Field(
+        default="queued", description="Job status"
+    )
+    total: Optional[int] = Field(default=None, description="Expected contexts")
+    processed: int = Field(default=0, description="Contexts inserted or failed")
+    embedded: int = Field(default=0, description="Contexts embedded")
+    inserted: int = Field(default=0, description="Contexts inserted")
+    failed: int = Field(default=0, description="Contexts failed")
+    elapsed: float = Field(default=0.0, description="Seconds spent running")
+    docs_per_sec: float = Field(default=0.0, description="Current throughput")
+    eta: Optional[float] = Field(default=None, description="Estimated seconds left")
+    created_at: float = Field(description="Creation timestamp")
+    updated_at: float = Field(description="Last update timestamp")
+    error: Optional[str] = Field(default=None, description="Error message")
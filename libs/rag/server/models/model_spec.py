@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Tuple, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 from rag.server.pydantic_v2 import BaseModel, Field
 
@@ -24,3 +24,9 @@ class ModelConfig(BaseModel):
     api_key: str = Field("sk-xxx", description="API key")
     model_name: str = Field("deepseek-ai/DeepSeek-V2.5", description="Model name")
     meta_data: Dict[str, Any] = Field({}, description="Meta data")
+    weight: float = Field(1.0, description="Routing weight of the platform")
+
+
+class ChatChunk(BaseModel):
+    content: str = Field("", description="Generated content delta")
+    usage: Optional[Dict[str, int]] = Field(None, description="Token usage")
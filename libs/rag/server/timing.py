@@ -0,0 +1,90 @@
+import json
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, Optional
+
+import loguru
+from rag.server.metrics import observe_stages
+from rag.settings import Settings
+
+_current: ContextVar[Optional["RequestTimings"]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+class RequestTimings:
+    """
+    Stage timings of one request. Stages measured through ``stage`` add up
+    under their name, so a stage run twice (e.g. two embedding calls) reports
+    its total time. The record is written as one json line to requests.jsonl
+    by the background log writer.
+    """
+
+    def __init__(self, kind: str, **fields):
+        self.kind = kind
+        self.start = time.perf_counter()
+        self.fields: Dict[str, Any] = fields
+        self.stages: Dict[str, float] = {}
+        self.finished = False
+
+    def record(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def finish(self, **fields):
+        """
+        Write the record once, sampled by REQUEST_LOG_SAMPLE_RATE except errors.
+        Stage latencies go to the metrics of every request, sampled or not.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        self.fields.update(fields)
+        observe_stages(self.kind, {**self.stages, "total": self.elapsed()})
+        rate = Settings.basic_settings.REQUEST_LOG_SAMPLE_RATE
+        if "error" not in self.fields and random.random() >= rate:
+            return
+        record = {
+            "kind": self.kind,
+            "time": time.time(),
+            **self.fields,
+            "stages": {k: round(v, 6) for k, v in self.stages.items()},
+            "total": round(self.elapsed(), 6),
+        }
+        loguru.logger.bind(request=True).info(
+            json.dumps(record, ensure_ascii=False, default=str)
+        )
+
+
+def start_request(kind: str, **fields) -> RequestTimings:
+    """Start timing the current request, ``stage`` calls below it are recorded"""
+    timings = RequestTimings(kind, **fields)
+    _current.set(timings)
+    return timings
+
+
+def current_request() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time a stage of the current request, a no-op outside of a request"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    with timings.stage(name):
+        yield
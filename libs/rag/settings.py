@@ -15,6 +15,14 @@ CONFIG_ROOT = RAG_ROOT / "configs"
 class BasicSettings(BaseFileSettings):
     model_config = SettingsConfigDict(yaml_file=CONFIG_ROOT / "basic_configs.yaml")
     log_verbose: bool = False
+    LOG_ROTATION: str = "100 MB"
+    """Size ("100 MB") or interval ("1 day") after which a log file is rotated"""
+    LOG_RETENTION: str = "14 days"
+    """How long rotated log files are kept"""
+    LOG_MAX_MESSAGE_LENGTH: int = 2048
+    """Log messages are cut to this many characters, 0 to keep them whole"""
+    REQUEST_LOG_SAMPLE_RATE: float = 1.0
+    """Fraction of requests whose stage timings are written to requests.jsonl"""
     KB_ROOT_PATH: str = str(RAG_ROOT / "data/knowledge_base")
     version: str = __version__
 
@@ -41,9 +49,37 @@ class PlatformConfig(MyBaseModel):
     PLATFORM_TYPE: Literal["openai"] = "openai"
     API_BASE_URL: str = "https://api.siliconflow.cn/v1"
     API_KEY: str = "sk-xxx"
-    LLM_MODELS: Dict[str, Dict[str, Any]] = []
-    EMBEDDING_MODELS: Dict[str, Dict[str, Any]] = []
-    RERANK_MODELS: Dict[str, Dict[str, Any]] = []
+    LLM_MODELS: Dict[str, Dict[str, Any]] = {}
+    EMBEDDING_MODELS: Dict[str, Dict[str, Any]] = {}
+    RERANK_MODELS: Dict[str, Dict[str, Any]] = {}
+    WEIGHT: float = 1.0
+    """Share of the requests sent here when several platforms serve a model"""
+    TIMEOUT: float = 60.0
+    """Seconds to wait for a response of the platform"""
+    CONNECT_TIMEOUT: float = 5.0
+    """Seconds to wait for a connection to the platform"""
+    MAX_RETRIES: int = 3
+    """Retries of a request failing with a connection error, 408, 409, 429 or 5xx"""
+    RETRY_BACKOFF: float = 0.5
+    """Base seconds of the exponential backoff between retries, with full jitter"""
+    RETRY_BACKOFF_MAX: float = 30.0
+    """Max seconds between retries, Retry-After headers are honored up to it"""
+    MAX_CONCURRENCY: int = 32
+    """Max requests in flight to the platform, for each of the sync and async paths"""
+    RATE_LIMIT: float = 0.0
+    """Max requests per second sent to the platform, 0 for no limit"""
+    RATE_BURST: int = 10
+    """Requests which may be sent at once before RATE_LIMIT applies"""
+    MAX_CONNECTIONS: int = 64
+    """Size of the HTTP connection pool"""
+    MAX_KEEPALIVE_CONNECTIONS: int = 32
+    """Idle connections kept open in the pool"""
+    KEEPALIVE_EXPIRY: float = 30.0
+    """Seconds before an idle connection is closed"""
+    BREAKER_FAILURE_THRESHOLD: int = 5
+    """Consecutive connection errors or 5xx opening the circuit breaker, 0 to disable"""
+    BREAKER_RESET_TIMEOUT: float = 30.0
+    """Seconds the circuit stays open before a trial request is let through"""
 
 
 class ModelSettings(BaseFileSettings):
@@ -53,9 +89,49 @@ class ModelSettings(BaseFileSettings):
     DEFAULT_EMBEDDING_SIZE: int = 1024
     DEFAULT_EMBEDDING_CONTEXT_WINDOW: int = 8192
     DEFAULT_RERANK_MODEL: str = "BAAI/bge-reranker-v3-m3"
+    RERANK_ENABLED: bool = False
+    """Rerank the retrieved contexts of kb_chat with DEFAULT_RERANK_MODEL"""
+    RERANK_FETCH_FACTOR: int = 4
+    """Candidates retrieved for reranking, as a multiple of top_k"""
+    RERANK_CACHE_SIZE: int = 16384
+    """Max number of (model, query, context) rerank scores kept in memory"""
+    RERANK_CACHE_TTL: int = 24 * 3600
+    """Seconds before a cached rerank score expires, 0 to never expire"""
+    COMPRESS_ENABLED: bool = False
+    """Reduce the contexts of kb_chat to the sentences relevant to the query"""
+    COMPRESS_TOP_SENTENCES: int = 3
+    """Best matching sentences kept per context by compression"""
+    COMPRESS_NEIGHBOURS: int = 1
+    """Sentences kept on each side of a best matching sentence"""
     HISTORY_LEN: int = 5
+    """Rounds of history (a user and an assistant message) kept in the prompt"""
+    PROMPT_MAX_TOKENS: int = 6144
+    """Token budget of the assembled chat prompt, contexts are trimmed to fit"""
+    PROMPT_HISTORY_TOKENS: int = 1024
+    """Max tokens of history in the prompt, the rest of the budget goes to contexts"""
+    PROMPT_TOKENIZER: str = "cl100k_base"
+    """tiktoken encoding counting prompt tokens, they are estimated without tiktoken"""
     MAX_TOKENS: Optional[int] = 2e5
     TEMPERATURE: float = 0.3
+    EMBED_CACHE_SIZE: int = 4096
+    """Max number of query embeddings kept in memory, 0 to disable the memory tier"""
+    EMBED_CACHE_TTL: int = 7 * 24 * 3600
+    """Seconds before a cached query embedding expires, 0 to never expire"""
+    EMBED_CACHE_DISK: bool = False
+    """Persist query embeddings to a sqlite file under DATA_PATH"""
+    EMBED_CACHE_DISK_SIZE: int = 1000000
+    """Max number of query embeddings kept on disk"""
+    ANSWER_CACHE_ENABLED: bool = False
+    """Reuse kb_chat answers of semantically similar questions"""
+    ANSWER_CACHE_SIZE: int = 1024
+    """Max number of cached kb_chat answers"""
+    ANSWER_CACHE_TTL: int = 24 * 3600
+    """Seconds before a cached answer expires, 0 to never expire"""
+    ANSWER_CACHE_THRESHOLD: float = 0.95
+    """Min cosine similarity between query embeddings for an answer cache hit"""
+    ROUTER_STRATEGY: Literal["weighted", "latency"] = "latency"
+    """How requests of a model served by several platforms are spread:
+    by WEIGHT only, or by WEIGHT and the observed latency of each platform"""
     MODEL_PLATFORMS: List[PlatformConfig] = [
         PlatformConfig(
             **{
@@ -80,12 +156,64 @@ class KBSettings(BaseFileSettings):
     model_config = SettingsConfigDict(yaml_file=CONFIG_ROOT / "kb_configs.yaml")
     MILVUS_HOST: str = "http://localhost:19530"
     MILVUS_TOKEN: str = "root:Milvus"
+    MILVUS_VECTOR_PRECISION: Literal[
+        "float32", "float16", "bfloat16", "int8", "binary"
+    ] = "float32"
+    """Precision of the embeddings of new Milvus collections, quantized embeddings keep a memory-mapped full precision copy to rescore with, bfloat16 needs ml_dtypes"""
+    MILVUS_RESCORE_FACTOR: int = 4
+    """Candidates fetched per result from quantized Milvus collections, rescored at full precision"""
     DEFAULT_COLLECTION_NAME: str = "default"
-    DEFAULT_VS_TYPE: Literal["faiss", "milvus"] = "milvus"
+    DEFAULT_VS_TYPE: Literal["faiss", "milvus", "numpy"] = "milvus"
+    FAISS_INDEX_TYPE: Literal["flat", "ivf", "hnsw"] = "flat"
+    """Index of new faiss collections: exact flat, IVF inverted lists, or HNSW graph"""
+    FAISS_IVF_NLIST: int = 1024
+    """Max number of IVF lists, the index is trained once a collection holds 39 vectors per list"""
+    FAISS_IVF_NPROBE: int = 16
+    """Number of IVF lists visited per search"""
+    FAISS_HNSW_M: int = 32
+    """Neighbours per node of the HNSW graph"""
+    FAISS_HNSW_EF_SEARCH: int = 64
+    """Candidate list size of HNSW searches"""
+    FAISS_MMAP: bool = False
+    """Memory-map faiss indexes from disk instead of loading them into RAM"""
+    NUMPY_MMAP: bool = True
+    """Memory-map numpy vector matrices from disk, they are copied into RAM on the first write"""
     CHUNK_SIZE: int = 1024
     OVERLAP_SIZE: int = 200
     VS_TOP_K: int = 10
     SCORE_THRESHOLD: float = 0.0
+    BATCH_SEARCH_MAX_QUERIES: int = 256
+    """Max number of queries of one /kb/batch_search request"""
+    LEXICAL_INDEX: bool = True
+    """Build a BM25 index over the content of collections while ingesting"""
+    HYBRID_SEARCH: bool = False
+    """
+    Fuse BM25 hits with vector hits by reciprocal rank fusion in search. Fused
+    results carry the RRF score as distance, and BM25 hits are not subject to
+    score_threshold, so thresholds tuned on cosine similarity do not apply
+    """
+    HYBRID_CANDIDATES: int = 20
+    """Candidates fetched from each of the dense and lexical paths before fusion"""
+    RRF_K: int = 60
+    """Rank offset k of reciprocal rank fusion, 1 / (k + rank)"""
+    EMBED_BATCH_SIZE: int = 32
+    """Max number of contexts sent in one embedding request"""
+    EMBED_BATCH_TOKENS: int = 16384
+    """Max estimated tokens sent in one embedding request"""
+    EMBED_CONCURRENCY: int = 4
+    """Number of embedding requests in flight while ingesting"""
+    EMBED_MAX_RETRIES: int = 3
+    """Retries of a failed embedding request before it is split"""
+    EMBED_MAX_ATTEMPTS: int = 24
+    """Max embedding requests of one sub-batch, over its retries and splits"""
+    EMBED_MAX_CONSECUTIVE_FAILURES: int = 8
+    """Failed embedding requests in a row after which ingestion fails fast"""
+    INGEST_JOB_WORKERS: int = 2
+    """Number of background ingestion jobs running at the same time"""
+    KB_POOL_SIZE: int = 16
+    """Max number of KB services kept alive in the process-wide pool"""
+    WARMUP_KBS: List[str] = ["default"]
+    """Knowledge bases whose services are built at API server startup"""
 
 
 # 关于prompt_name
@@ -1,6 +1,8 @@
 import os
+import sys
+import threading
 from functools import partial
-from typing import Dict
+from typing import Any, Dict
 
 import loguru
 import loguru._logger
@@ -8,6 +10,65 @@ from memoization import CachingAlgorithmFlag, cached
 from rag.settings import Settings
 
 
+REQUEST_LOG_FILE = "requests.jsonl"
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+def shorten(value: Any, max_length: int = None) -> str:
+    """str of value cut to max_length (LOG_MAX_MESSAGE_LENGTH) characters"""
+    if max_length is None:
+        max_length = Settings.basic_settings.LOG_MAX_MESSAGE_LENGTH
+    text = str(value)
+    if max_length <= 0 or len(text) <= max_length:
+        return text
+    return f"{text[:max_length]}...({len(text) - max_length} more chars)"
+
+
+def _is_request_record(record: Dict) -> bool:
+    return "request" in record["extra"]
+
+
+def _truncate_record(record: Dict):
+    if not _is_request_record(record):
+        record["message"] = shorten(record["message"])
+
+
+def _configure_sinks():
+    """
+    Process-wide sinks, set up once: the console and the structured request
+    log are written by background threads (enqueue), so logging on the event
+    loop only costs a queue put, and long messages are truncated beforehand.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        basic_settings = Settings.basic_settings
+        loguru.logger.configure(patcher=_truncate_record)
+        try:
+            # replace the default synchronous stderr sink
+            loguru.logger.remove(0)
+        except ValueError:
+            pass
+        loguru.logger.add(
+            sys.stderr,
+            level="DEBUG" if basic_settings.log_verbose else "INFO",
+            filter=lambda record: not _is_request_record(record),
+            enqueue=True,
+        )
+        loguru.logger.add(
+            str(basic_settings.LOG_PATH / REQUEST_LOG_FILE),
+            format="{message}",
+            filter=_is_request_record,
+            enqueue=True,
+            rotation=basic_settings.LOG_ROTATION,
+            retention=basic_settings.LOG_RETENTION,
+        )
+        _configured = True
+
+
 @cached(max_size=100, algorithm=CachingAlgorithmFlag.LRU)
 def build_logger(log_file: str = "chatchat"):
     """
@@ -18,7 +79,11 @@ def build_logger(log_file: str = "chatchat"):
 
     user can set basic_settings.log_verbose=True to output debug logs
     use logger.exception to log errors with exceptions
+
+    file sinks are written by a background thread, rotated at LOG_ROTATION
+    and kept for LOG_RETENTION
     """
+    _configure_sinks()
     logger = loguru.logger.opt(colors=True)
     logger.opt = partial(loguru.logger.opt, colors=True)
     logger.warn = logger.warning
@@ -29,6 +94,13 @@ def build_logger(log_file: str = "chatchat"):
             log_file = f"{log_file}.log"
         if not os.path.isabs(log_file):
             log_file = str((Settings.basic_settings.LOG_PATH / log_file).resolve())
-        logger.add(log_file, colorize=False)
+        logger.add(
+            log_file,
+            colorize=False,
+            filter=lambda record: not _is_request_record(record),
+            enqueue=True,
+            rotation=Settings.basic_settings.LOG_ROTATION,
+            retention=Settings.basic_settings.LOG_RETENTION,
+        )
 
     return logger
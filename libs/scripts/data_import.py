@@ -1,18 +1,39 @@
 # ENSURE YOU HAVE RUN THE HISTORY_RAG APP
 
 import argparse
+import itertools
 import json
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 
 import requests
-from tqdm import trange
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.exceptions import NewConnectionError
 
 # https://milvus.io/docs/string.md
 MAX_CONTENT_LENGTH = 64000
 
 
-def import_data(data: List[Dict], url: str, kb_name: str, collection_name: str):
+def build_session(pool_size: int) -> requests.Session:
+    """A session keeps connections alive, so batches do not pay the TCP handshake"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def import_data(
+    data: List[Dict],
+    url: str,
+    kb_name: str,
+    collection_name: str,
+    session: requests.Session = None,
+):
     info_list = []
     for d in data:
         info = {
@@ -32,33 +53,141 @@ def import_data(data: List[Dict], url: str, kb_name: str, collection_name: str):
         "collection_name": collection_name,
         "context": info_list,
     }
-    response = requests.post(f"{url}/kb/add_context", json=payload)
+    response = (session or requests).post(f"{url}/kb/add_context", json=payload)
     return response
 
 
-def load_data(fpath: Path, limit: int = 0):
+def import_with_retry(
+    data: List[Dict],
+    args: argparse.Namespace,
+    session: requests.Session,
+) -> int:
+    """
+    Post a batch until the server accepts all of it, returns the number of
+    records. The server inserts what it can of a batch, so only the records it
+    reports as failed are posted again. Errors leaving the outcome unknown,
+    e.g. a read timeout while the server keeps inserting, are not retried
+    since a repost would duplicate the inserted records.
+    """
+    pending = data
+    for attempt in range(args.retries + 1):
+        try:
+            response = import_data(
+                pending, args.server_url, args.kb_name, args.collection_name, session
+            )
+        except requests.RequestException as e:
+            # nothing was sent if the connection could not be made
+            if not _not_connected(e):
+                raise RuntimeError(f"Batch outcome unknown, not retried: {e}")
+            error = e
+        else:
+            try:
+                response.raise_for_status()
+                result = response.json()
+            except (requests.RequestException, ValueError) as e:
+                raise RuntimeError(f"Batch outcome unknown, not retried: {e}")
+            if result.get("code") == 200:
+                return len(data)
+            failed = (result.get("data") or {}).get("failed_indexes")
+            if not failed:
+                raise RuntimeError(f"Batch failed: {result.get('msg')}")
+            pending = [pending[i] for i in failed]
+            error = result.get("msg")
+        if attempt == args.retries:
+            raise RuntimeError(
+                f"{len(pending)} records failed after {args.retries} retries: {error}"
+            )
+        delay = min(2**attempt, 60) * (0.5 + random.random())
+        tqdm.write(f"{len(pending)} records failed: {error}, retry in {delay:.1f}s")
+        time.sleep(delay)
+
+
+def _not_connected(error: requests.RequestException) -> bool:
+    """Whether the request failed while connecting, before sending anything"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, requests.ConnectionError) and isinstance(
+        reason, NewConnectionError
+    )
+
+
+def load_data(fpath: Path, limit: int = 0, skip: int = 0) -> Iterator[Dict]:
+    """Lazily yield records, jsonl files are never loaded into memory at once"""
     with open(fpath, "r", encoding="utf-8") as f:
         if fpath.suffix == ".jsonl":
-            if limit == 0:
-                lines = f.readlines()
-            else:
-                lines = [f.readline() for _ in range(limit)]
-            data = [json.loads(line) for line in lines]
+            records = (json.loads(line) for line in f if line.strip())
         elif fpath.suffix == ".json":
-            data = json.load(f)
-            if limit > 0:
-                data = data[:limit]
-    return data
+            records = iter(json.load(f))
+        else:
+            raise ValueError(f"Unsupported data file {fpath}")
+        stop = limit if limit > 0 else None
+        yield from itertools.islice(records, skip, stop)
+
+
+def batched(records: Iterator[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    while batch := list(itertools.islice(records, batch_size)):
+        yield batch
+
+
+def load_checkpoint(path: Path) -> int:
+    if path.is_file():
+        return json.loads(path.read_text(encoding="utf-8"))["offset"]
+    return 0
+
+
+def save_checkpoint(path: Path, offset: int):
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps({"offset": offset}), encoding="utf-8")
+    tmp.replace(path)
 
 
 def main(args: argparse.Namespace):
-    data = load_data(args.data_path, args.limit)
-    for i in trange(0, len(data), args.batch_size):
-        batch = data[i : i + args.batch_size]
-        response = import_data(
-            batch, args.server_url, args.kb_name, args.collection_name
-        )
-        print(response)
+    checkpoint = args.checkpoint or args.data_path.with_name(
+        args.data_path.name + ".ckpt"
+    )
+    offset = 0 if args.restart else load_checkpoint(checkpoint)
+    if offset:
+        print(f"Resume from record {offset}, checkpoint {checkpoint}")
+    batches = batched(load_data(args.data_path, args.limit, offset), args.batch_size)
+    session = build_session(args.concurrency)
+
+    # batches finish out of order, the checkpoint only advances over a finished prefix
+    in_flight: Dict[Future, Tuple[int, int]] = {}
+    finished: Dict[int, int] = {}
+    committed, imported, start = offset, 0, time.perf_counter()
+    progress = tqdm(initial=offset, unit="doc")
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        batch_start = offset
+        for batch in itertools.chain(batches, [None]):
+            if batch is not None:
+                future = executor.submit(import_with_retry, batch, args, session)
+                in_flight[future] = (batch_start, len(batch))
+                batch_start += len(batch)
+                if len(in_flight) < args.concurrency:
+                    continue
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    begin, size = in_flight.pop(future)
+                    future.result()  # a batch out of retries aborts the import
+                    finished[begin] = size
+                    imported += size
+                    progress.update(size)
+                while committed in finished:
+                    committed += finished.pop(committed)
+                save_checkpoint(checkpoint, committed)
+                progress.set_postfix(
+                    docs_per_sec=f"{imported / (time.perf_counter() - start):.1f}"
+                )
+                if batch is not None:
+                    break
+    progress.close()
+    elapsed = time.perf_counter() - start
+    print(
+        f"Imported {imported} records in {elapsed:.1f}s, "
+        f"{imported / max(elapsed, 1e-9):.1f} docs/s"
+    )
 
 
 def parse_args():
@@ -71,6 +200,21 @@ def parse_args():
         "--limit", type=int, help="Number of examples to import", default=0
     )
     parser.add_argument("--batch_size", type=int, help="Batch size", default=16)
+    parser.add_argument(
+        "--concurrency", type=int, help="Batches posted concurrently", default=4
+    )
+    parser.add_argument(
+        "--retries", type=int, help="Retries of a failed batch", default=5
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        help="Checkpoint file, defaults to <data_path>.ckpt",
+        default=None,
+    )
+    parser.add_argument(
+        "--restart", action="store_true", help="Ignore the checkpoint and start over"
+    )
     args = parser.parse_args()
     return args
 
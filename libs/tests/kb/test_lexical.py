@@ -0,0 +1,15 @@
+from rag.server.kb.lexical import BM25Index
+
+
+def test_scores_stay_positive_with_tombstones(tmp_path):
+    index = BM25Index(tmp_path)
+    index.add(
+        [1, 2, 3, 4],
+        ["apple pie", "apple tart", "apple cake", "banana bread"],
+        ["a.txt", "a.txt", "b.txt", "c.txt"],
+    )
+    index.delete_file("a.txt")
+    # the term of the deleted docs would outnumber the live docs
+    hits = index.search("apple banana", 10)
+    assert all(score > 0 for _, score in hits)
+    assert {key for key, _ in index.search("apple", 10)} == {3}
@@ -0,0 +1,51 @@
+import json
+
+import numpy as np
+from rag.server.kb.numpy_kb_service import INFO_FILE, _NumpyCollection
+
+DIM = 4
+
+
+def _rows(file_name: str, n: int):
+    rng = np.random.default_rng(0)
+    return [
+        {
+            "content": f"{file_name} {i}",
+            "metadata": {"file_name": file_name},
+            "embedding": rng.random(DIM).tolist(),
+        }
+        for i in range(n)
+    ]
+
+
+def _open(path) -> _NumpyCollection:
+    info = json.loads((path / INFO_FILE).read_text(encoding="utf-8"))
+    return _NumpyCollection(path, info)
+
+
+def test_reload_after_delete_following_snapshot(tmp_path):
+    info = {"description": "", "dim": DIM, "embed_model": "test", "next_id": 0}
+    (tmp_path / INFO_FILE).write_text(json.dumps(info), "utf-8")
+    collection = _open(tmp_path)
+    collection.add(_rows("a.txt", 3) + _rows("b.txt", 2))
+    collection.save(0)
+    # logged to contexts.log only, there is no vectors.log after the snapshot
+    collection.delete_file("a.txt")
+
+    reloaded = _open(tmp_path)
+    assert [row["content"] for row in reloaded.rows] == ["b.txt 0", "b.txt 1"]
+    np.testing.assert_allclose(reloaded.vectors, collection.vectors)
+
+
+def test_reload_replays_adds_and_deletes(tmp_path):
+    info = {"description": "", "dim": DIM, "embed_model": "test", "next_id": 0}
+    (tmp_path / INFO_FILE).write_text(json.dumps(info), "utf-8")
+    collection = _open(tmp_path)
+    collection.add(_rows("a.txt", 2))
+    collection.delete_file("a.txt")
+    collection.add(_rows("a.txt", 1) + _rows("b.txt", 1))
+
+    reloaded = _open(tmp_path)
+    assert [row["id"] for row in reloaded.rows] == [3, 4]
+    assert reloaded.info["next_id"] == 4
+    np.testing.assert_allclose(reloaded.vectors, collection.vectors)
@@ -1,25 +1,52 @@
+import json
+
 import gradio as gr
 import requests
 
 from web.utils.constants import *
 
+def iter_sse(response):
+    """解析后端返回的 server-sent events，逐个产出 (event, data)"""
+    event = "message"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            event = "message"
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            yield event, json.loads(line[len("data:"):].strip())
+
+
 def chat_with_backend(messages, history):
 
     if not messages.strip():  # 检查用户消息是否为空
-        return Empty_QUERY_REPLY, gr.update(visible=False)
+        yield Empty_QUERY_REPLY, gr.update(visible=False)
+        return
 
     url = "http://0.0.0.0:19198/chat/kb_chat"  # 后端接口
     headers = {"Content-Type": "application/json"}
-    payload = {"query": messages, "history": history}
+    payload = {"query": messages, "history": history, "stream": True}
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        data = response.json()
-        reply = data.get("data", SERVER_REPLY_INVALID)
-        return reply, gr.update(visible=False)
+        with requests.post(url, json=payload, headers=headers, stream=True) as response:
+            response.raise_for_status()
+            if not response.headers.get("content-type", "").startswith("text/event-stream"):
+                # 检索等阶段失败时后端直接返回 json
+                data = response.json()
+                yield data.get("data") or data.get("msg", SERVER_REPLY_INVALID), gr.update(visible=False)
+                return
+            reply = ""
+            for event, data in iter_sse(response):
+                if event == "token":  # 逐 token 渲染
+                    reply += data["content"]
+                    yield reply, gr.update(visible=False)
+                elif event == "error":
+                    yield reply or data.get("msg", SERVER_REPLY_INVALID), gr.update(visible=False)
+                    return
+            if not reply:
+                yield SERVER_REPLY_INVALID, gr.update(visible=False)
     except requests.exceptions.RequestException as e:
-        return SERVER_CONNECT_FAILED, gr.update(visible=False)
+        yield SERVER_CONNECT_FAILED, gr.update(visible=False)
 
 
 with gr.Blocks(theme="soft", css=